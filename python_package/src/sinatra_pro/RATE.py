@@ -1,8 +1,59 @@
 #!/bin/python3
 
-import sys
+import sys, os, shutil, tempfile
 import numpy as np
 from scipy.linalg import pinv
+from scipy.sparse import issparse
+
+class posterior_moments:
+    """
+    Running mean and covariance of posterior draws, the sufficient statistics of the draws used by `RATE`.
+
+    Draws are added in blocks and merged into the running statistics with the pairwise update of Welford's algorithm (Chan et al. 1979), 
+    so the memory usage is O(n^2) for n latent variables regardless of the number of draws.
+
+    `n` is the number of latent variables (dimension of each draw).
+    """
+
+    def __init__(self, n):
+        self.n_sample = 0
+        """Number of draws accumulated"""
+        self.mean = np.zeros(n,dtype=float)
+        """Running mean of the draws"""
+        self.M2 = np.zeros((n,n),dtype=float)
+        """Running sum of outer products of deviations from the mean"""
+        return
+
+    def update(self, draws):
+        """Add a block of draws (one draw per row)"""
+        draws = np.atleast_2d(draws)
+        m = draws.shape[0]
+        if m == 0:
+            return
+        block_mean = np.mean(draws,axis=0)
+        centered = draws - block_mean
+        self.merge_moments(m,block_mean,centered.T @ centered)
+        return
+
+    def merge(self, other):
+        """Merge the statistics of another `posterior_moments`, e.g. from another chain"""
+        self.merge_moments(other.n_sample,other.mean,other.M2)
+        return
+
+    def merge_moments(self, m, mean, M2):
+        """Merge the statistics of `m` draws with mean `mean` and sum of outer products of deviations `M2`"""
+        if m == 0:
+            return
+        total = self.n_sample + m
+        delta = mean - self.mean
+        self.M2 += M2 + np.outer(delta,delta) * (self.n_sample*m/total)
+        self.mean += delta * (m/total)
+        self.n_sample = total
+        return
+
+    def covariance(self, ddof=1):
+        """Covariance matrix of the draws, same as `np.cov(draws,rowvar=False)` for `ddof` = 1"""
+        return self.M2 / (self.n_sample - ddof)
 
 def sherman_r(A,u,v):
     """ Sherman-Morrisoni formula to compute the inverse of the sum of an invertible matrix A and the outer product of vectors u and v."""
@@ -21,15 +72,148 @@ def calc_kld(mu,Lambda,V,q,verbose=False):
     kld = mu[q]**2 * alpha * .5
     return kld
 
-def RATE(X,f_draws=None,prop_var=1,low_rank=False,parallel=False,n_core=-1,verbose=False):    
+def calc_kld_block(mu,Lambda,V,q_start,q_end,Lambda_sum=None,Lambda_sum2=None):
+    """
+    Calculate KLD for columns `q_start` to `q_end`-1 at once, giving the same values as `calc_kld`.
+
+    The update from `sherman_r` in `calc_kld` subtracts c_q = |Lambda V_q|^2 / (1 + V_q^T Lambda V_q) from every entry of `Lambda`, 
+    so the quadratic form with row and column q deleted is expanded in closed form in terms of column q of `Lambda`, Lambda^2 and Lambda^3, 
+    the row sums of `Lambda` (`Lambda_sum`) and the row sums of Lambda^2 (`Lambda_sum2`), without forming the deleted matrices. 
+    This costs two (p x p) by (p x m) matrix products for m columns.
+
+    `Lambda_sum` and `Lambda_sum2` are computed if not provided, they can be precomputed once for all blocks.
+    """
+    p = mu.size
+    if Lambda_sum is None:
+        Lambda_sum = np.sum(Lambda,axis=0)
+    if Lambda_sum2 is None:
+        Lambda_sum2 = Lambda @ Lambda_sum
+    Lambda_B = Lambda[:,q_start:q_end]
+    LV = Lambda @ V[:,q_start:q_end]
+    c = np.sum(LV**2,axis=0) / (1. + np.sum(V[:,q_start:q_end]*LV,axis=0))
+    diag1 = np.diagonal(Lambda)[q_start:q_end]
+    diag2 = np.sum(Lambda_B**2,axis=0)
+    diag3 = np.sum(Lambda_B*(Lambda @ Lambda_B),axis=0)
+    r = Lambda_sum[q_start:q_end]
+    g = Lambda_sum2[q_start:q_end]
+    b = diag1 - c
+    # quadratic form of the full column q of the updated matrix, minus the contributions of row and column q
+    quad = diag3 - 2*c*g + c**2*np.sum(Lambda_sum) - 2*b*(diag2 - c*r) + b**2*diag1
+    total = r - (p-1)*c - diag1
+    alpha = quad - c*total**2
+    kld = mu[q_start:q_end]**2 * alpha * .5
+    return kld
+
+def calc_kld_batched(mu,Lambda,V,block_size=None,verbose=False):
+    """Calculate KLD for all columns with `calc_kld_block`, in blocks of `block_size` columns (all columns at once if not provided) to limit the memory usage."""
+    p = mu.size
+    if block_size == None:
+        block_size = p
+    Lambda_sum = np.sum(Lambda,axis=0)
+    Lambda_sum2 = Lambda @ Lambda_sum
+    kld = np.zeros(p,dtype=float)
+    for q_start in range(0,p,block_size):
+        q_end = min(q_start+block_size,p)
+        if verbose:
+            sys.stdout.write("Calculating KLD(%d-%d)...\r"%(q_start,q_end-1))
+            sys.stdout.flush()
+        kld[q_start:q_end] = calc_kld_block(mu,Lambda,V,q_start,q_end,Lambda_sum,Lambda_sum2)
+    return kld
+
+def calc_kld_shared(mu,lambda_file,v_file,q_start,q_end,Lambda_sum,Lambda_sum2,block_size=None,verbose=False):
+    """
+    Calculate KLD for columns `q_start` to `q_end`-1 with `calc_kld_block`, in blocks of `block_size` columns, 
+    where `Lambda` and `V` are memory-mapped read-only from the .npy files `lambda_file` and `v_file`, 
+    such that all parallel workers share one copy of the matrices in the page cache.
+    """
+    Lambda = np.load(lambda_file,mmap_mode='r')
+    V = np.load(v_file,mmap_mode='r')
+    if block_size == None:
+        block_size = q_end - q_start
+    kld = np.zeros(q_end-q_start,dtype=float)
+    for i_start in range(q_start,q_end,block_size):
+        i_end = min(i_start+block_size,q_end)
+        if verbose:
+            sys.stdout.write("Calculating KLD(%d-%d)...\r"%(i_start,i_end-1))
+            sys.stdout.flush()
+        kld[i_start-q_start:i_end-q_start] = calc_kld_block(mu,Lambda,V,i_start,i_end,Lambda_sum,Lambda_sum2)
+    return kld
+
+def calc_kld_parallel(mu,Lambda,V,n_core=-1,block_size=None,temp_dir=None,verbose=False):
+    """
+    Calculate KLD for all columns on `n_core` processes, each worker handles a contiguous range of columns with `calc_kld_shared`. 
+
+    `Lambda` and `V` are written once to .npy files in a temporary directory under `temp_dir` (system default if not provided), 
+    which is removed afterwards, instead of being pickled to the workers, so the memory usage stays about the size of the matrices regardless of `n_core`.
+
+    `block_size` is the number of columns each worker calculates at once (the whole range if not provided).
+    """
+    import multiprocessing
+    from joblib import Parallel, delayed
+    if n_core == -1:
+        n_core = multiprocessing.cpu_count()
+    p = mu.size
+    Lambda_sum = np.sum(Lambda,axis=0)
+    Lambda_sum2 = Lambda @ Lambda_sum
+    directory = tempfile.mkdtemp(prefix='sinatra_rate_',dir=temp_dir)
+    try:
+        lambda_file = os.path.join(directory,'Lambda.npy')
+        v_file = os.path.join(directory,'V.npy')
+        np.save(lambda_file,Lambda)
+        np.save(v_file,V)
+        bounds = np.linspace(0,p,min(n_core,p)+1).astype(int)
+        kld = Parallel(n_jobs=n_core)(delayed(calc_kld_shared)(mu,lambda_file,v_file,bounds[i],bounds[i+1],Lambda_sum,Lambda_sum2,block_size,verbose) for i in range(bounds.size-1))
+    finally:
+        shutil.rmtree(directory,ignore_errors=True)
+    return np.concatenate(kld)
+
+def randomized_svd(A,rank,n_oversample=10,n_power_iter=2,seed=None):
+    """
+    Truncated SVD of the matrix `A` of rank `rank` by randomized range finding (Halko, Martinsson and Tropp 2011).
+
+    The range of `A` is sampled by the product with a Gaussian random matrix of `rank` + `n_oversample` columns, 
+    refined by `n_power_iter` power iterations (with QR re-orthonormalization at each step), 
+    and the exact SVD of the projection of `A` onto the sampled range is taken. `seed` is the seed of the random number generator.
+
+    It returns u, s, vh as `np.linalg.svd` with `full_matrices` set to False, truncated to the first `rank` singular values.
+    """
+    rng = np.random.default_rng(seed)
+    m, n = A.shape
+    k = min(rank+n_oversample,m,n)
+    Q, R = np.linalg.qr(A @ rng.standard_normal((n,k)))
+    for i in range(n_power_iter):
+        Z, R = np.linalg.qr(A.T @ Q)
+        Q, R = np.linalg.qr(A @ Z)
+    u, s, vh = np.linalg.svd(Q.T @ A,full_matrices=False,compute_uv=True)
+    u = Q @ u
+    return u[:,:rank], s[:rank], vh[:rank]
+
+def prop_var_components(s,total,prop_var):
+    """
+    Boolean mask of the leading components with singular values `s` (in decreasing order) kept for the proportion of variance `prop_var`, 
+    i.e. those for which the cumulative proportion of the total variance `total` is below `prop_var`.
+
+    `total` is the sum of squares of the decomposed matrix. If the components hold all of it up to rounding errors, it is taken as the sum of `s`**2, 
+    so the cumulative proportions are the same for a full and for a truncated SVD at full rank.
+    """
+    cumulative = np.cumsum(s**2)
+    if cumulative.size > 0 and cumulative[-1] >= total*(1-s.size*np.finfo(float).eps):
+        total = cumulative[-1]
+    return cumulative/total < prop_var
+
+def RATE(X,f_draws=None,prop_var=1,low_rank=False,parallel=False,n_core=-1,verbose=False,f_mean=None,f_cov=None,block_size=None,temp_dir=None,svd_rank=None,n_oversample=10,n_power_iter=2,seed=0):    
     """
     Variable Prioritization via RelATive cEntrality (RATE) centrality measures.
 
     This function assumes that one has already obtained (posterior) draws/estimates of a nonparametric or nonlinear function as suggested in Crawford et al. (2018)
 
-    'X' is the nxp design matrix (e.g. genotypes) where n is the number of samples and p is the number of dimensions. This is the original input data
+    'X' is the nxp design matrix (e.g. genotypes) where n is the number of samples and p is the number of dimensions. This is the original input data, 
+    it can also be a scipy sparse matrix of features scaled but not centered (see `compute_ec_curve_folder`), which is centered here
     
-    'f_draws' is the Bxn matrix of the nonparametric model estimates (i.e. f.hat) with B being the number of sampled (posterior) draws;
+    'f_draws' is the Bxn matrix of the nonparametric model estimates (i.e. f.hat) with B being the number of sampled (posterior) draws, 
+    or a `posterior_moments` with the mean and covariance of the draws;
+
+    'f_mean' and 'f_cov' are the mean and the covariance matrix of the draws, which can be provided in place of 'f_draws';
     
     'prop_var' is the desired proportion of variance that the user wants to explain when applying singular value decomposition (SVD) to the design matrix X (this is preset to 1);
     
@@ -39,28 +223,80 @@ def RATE(X,f_draws=None,prop_var=1,low_rank=False,parallel=False,n_core=-1,verbo
     then `n_core` will be the number of cores used (the program uses all detected cores if `n_core` is not provided).
 
     If `verbose` is set to True, the program prints progress on command prompt.
+
+    `block_size` is the number of columns for which the KLD is calculated at once by each process (all at once if not provided), see `calc_kld_batched`.
+
+    In parallel mode, `Lambda` and `V` are shared with the workers through memory-mapped files in a temporary directory under `temp_dir`, see `calc_kld_parallel`.
+
+    If `svd_rank` is provided, the design matrix is decomposed by a randomized truncated SVD of rank `svd_rank` (see `randomized_svd`, 
+    with `n_oversample`, `n_power_iter` and `seed`) instead of the full SVD, and no other decomposition of a matrix with p rows is taken: 
+    with `low_rank`, the components are further truncated by `prop_var` (relative to the total variance of X); 
+    otherwise the pseudo-inverses of X and of the covariance V of the effect sizes are obtained from the truncated SVD of X 
+    and the eigendecomposition of the (rank x rank) covariance of V in the basis of the right singular vectors, instead of `pinv` of the (p x p) matrix V.
  
     """
     if verbose:
         sys.stdout.write("Calculating RATE...\n")
 
-    if parallel:
-        import multiprocessing
-        from joblib import Parallel, delayed
-        if n_core == -1:
-            n_core = multiprocessing.cpu_count()
+    ### Sparse features are scaled but not centered, center them as in the dense standardized design matrix ###
+    if issparse(X):
+        X = X.toarray()
+        X -= np.mean(X,axis=0)
+
+    ### Only the mean and the covariance of the posterior draws are needed ###
+    if isinstance(f_draws,posterior_moments):
+        f_mean = f_draws.mean
+        f_cov = f_draws.covariance()
+    elif f_draws is not None:
+        f_mean = np.average(f_draws,axis=0)
+        f_cov = np.cov(f_draws,rowvar=False)
 
-    if low_rank:
+    if svd_rank != None:
+        ### Randomized truncated SVD of the Design Matrix ###
+        u, s, vh = randomized_svd(X,svd_rank,n_oversample=n_oversample,n_power_iter=n_power_iter,seed=seed)
+        if low_rank:
+            dx = s > 1e-10
+            # the total variance is taken from X since s only holds the leading singular values
+            px = prop_var_components(s,np.sum(X**2),prop_var)
+            r_X = np.logical_and(dx,px)
+        else:
+            r_X = s > np.amax(s)*max(X.shape)*np.finfo(float).eps # same cutoff as pinv
+        s = s[r_X]
+        u = u[:,r_X]
+        v = vh[r_X].T # orthonormal columns, pinv(v).T = v
+    if svd_rank != None and low_rank:
+        u = ((1. / s) * u).T
+        Sigma_star = u @ f_cov @ u.T 
+        u_Sigma_star, s_Sigma_star, vh_Sigma_star = np.linalg.svd(Sigma_star,full_matrices=False,compute_uv=True)
+        r = s_Sigma_star > 1e-10
+        tmp = 1./np.sqrt(s_Sigma_star[r]) * u_Sigma_star[:,r].T
+        U = v @ tmp.T
+        V = v @ Sigma_star @ v.T #Variances
+        mu = v @ u @ f_mean #Effect Size Analogues
+    elif svd_rank != None:
+        # pinv(X) = v diag(1/s) u^T, so V = v M v^T with M = diag(1/s) u^T f_cov u diag(1/s), and pinv(V) = v pinv(M) v^T
+        M = (u.T @ f_cov @ u) / np.outer(s,s)
+        V = v @ M @ v.T
+        M_s, M_u = np.linalg.eigh(M)
+        keep = M_s > np.amax(M_s)*V.shape[0]*np.finfo(float).eps # same cutoff as pinv(V)
+        D_s = 1./M_s[keep]
+        D_u = v @ M_u[:,keep]
+        order = np.argsort(D_s)[::-1]
+        D_s = D_s[order]
+        D_u = D_u[:,order]
+        r = np.sum(D_s > 1e-10)
+        U = np.multiply(np.sqrt(D_s[:r]),D_u[:,:r])
+        mu = v @ ((u.T @ f_mean) / s)
+    elif low_rank:
         ### Take the SVD of the Design Matrix for Low Rank Approximation ###
         u, s, vh = np.linalg.svd(X,full_matrices=False,compute_uv=True)
         dx = s > 1e-10
-        s_sq = s**2
-        px = np.cumsum(s_sq/np.sum(s_sq)) < prop_var
+        px = prop_var_components(s,np.sum(s**2),prop_var)
         r_X = np.logical_and(dx,px)
         u = ((1. / s[r_X]) * u[:,r_X]).T
         v = vh.T[:,r_X]
         # Now, calculate Sigma_star
-        SigmaFhat = np.cov(f_draws, rowvar=False)
+        SigmaFhat = f_cov
         Sigma_star = u @ SigmaFhat @ u.T 
         # Now, calculate U st Lambda = U %*% t(U)
         u_Sigma_star, s_Sigma_star, vh_Sigma_star = np.linalg.svd(Sigma_star,full_matrices=False,compute_uv=True)
@@ -68,15 +304,16 @@ def RATE(X,f_draws=None,prop_var=1,low_rank=False,parallel=False,n_core=-1,verbo
         tmp = 1./np.sqrt(s_Sigma_star[r]) * u_Sigma_star[:,r].T
         U = pinv(v).T @ tmp.T
         V = v @ Sigma_star @ v.T #Variances
-        mu = v @ u @ np.average(f_draws,axis=0) #Effect Size Analogues
+        mu = v @ u @ f_mean #Effect Size Analogues
     else:
-        beta_draws = (pinv(X) @ f_draws.T).T
-        V = np.cov(beta_draws,rowvar=False)
+        # beta_draws = pinv(X) @ f_draws.T, so their covariance and mean follow from the ones of f_draws
+        X_inv = pinv(X)
+        V = X_inv @ f_cov @ X_inv.T
         D = pinv(V)
         D_u, D_s, D_vh = np.linalg.svd(D,full_matrices=False,compute_uv=True)
         r = np.sum(D_s > 1e-10)
         U = np.multiply(np.sqrt(D_s[:r]),D_u[:,:r])
-        mu = np.average(beta_draws,axis=0)
+        mu = X_inv @ f_mean
     
     mu = np.fabs(mu)
 
@@ -85,12 +322,9 @@ def RATE(X,f_draws=None,prop_var=1,low_rank=False,parallel=False,n_core=-1,verbo
 
     ### Compute the Kullback-Leibler divergence (KLD) for Each Predictor ###
     if parallel:
-        kld = Parallel(n_jobs=n_core)(delayed(calc_kld)(mu,Lambda,V,q,verbose) for q in range(mu.size))     
-        kld = np.array(kld)
+        kld = calc_kld_parallel(mu,Lambda,V,n_core=n_core,block_size=block_size,temp_dir=temp_dir,verbose=verbose)
     else:
-        kld = np.zeros(mu.size,dtype=float)
-        for q in range(mu.size):
-            kld[q] = calc_kld(mu,Lambda,V,q,verbose)
+        kld = calc_kld_batched(mu,Lambda,V,block_size=block_size,verbose=verbose)
     if verbose: 
         sys.stdout.write("\n")
         sys.stdout.write("KLD calculation Completed.\n")
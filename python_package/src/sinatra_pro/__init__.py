@@ -13,4 +13,5 @@ from sinatra_pro.traj_reader import *
 from sinatra_pro.euler import *
 from sinatra_pro.gp import *
 from sinatra_pro.reconstruction import *
+from sinatra_pro.pipeline import *
 
@@ -7,6 +7,7 @@ from sinatra_pro.traj_reader import *
 from sinatra_pro.euler import *
 from sinatra_pro.gp import *
 from sinatra_pro.reconstruction import *
+from sinatra_pro.pipeline import *
 
 ##########################################################################
 
@@ -32,26 +33,41 @@ parser.add_argument('-nc','--n_core', type=int, help='number of core for paralle
 
 parser.add_argument('-n' ,'--n_sample', type=int, help='number of sample drawn from trajectory, default: 10',default=10)
 parser.add_argument('-of','--offset', type=int, help='starting frame for sample drawn from trajectory, default: 0',default=0)
+parser.add_argument('-fs','--frame_sampling', type=str, help='strategy for drawing samples from trajectory (stride/uniform/random/rmsd_cluster), default: stride', default='stride')
+parser.add_argument('-fsd','--frame_seed', type=int, help='seed for random sampling of frames, default: None', default=None)
 parser.add_argument('-s' ,'--selection', type=str, help='selection for protein, default: all protein', default='protein')
 parser.add_argument('-r' ,'--radius', type=float, help='radius for simplicial construction, default: 2.0', default=2.0)
+parser.add_argument('-bm','--binary_mesh', help='write meshes as binary .bmsh files instead of text .msh files', dest='binary_mesh', action='store_true')
+parser.add_argument('-es','--ensemble_mesh', help='store meshes of each protein in a single mesh ensemble file (.emsh) instead of one file per structure', dest='ensemble_mesh', action='store_true')
+parser.add_argument('-im','--in_memory', help='convert trajectories directly to meshes in memory without writing PDB files of all frames', dest='in_memory', action='store_true')
 parser.add_argument('-hs','--hemisphere', help='distribute directions over hemisphere instead of whole sphere', dest='hemisphere', action='store_true')
 
 parser.add_argument('-et','--ec_type', type=str, help='type of Euler characteristic measure (DECT/ECT/SECT), default: DECT', default='DECT')
 parser.add_argument('-c' ,'--n_cone', type=int, help='number of cone, default: 1', default=1)
 parser.add_argument('-d' ,'--n_direction_per_cone', type=int, help='number of direction per cone, default: 1', default=1)
 parser.add_argument('-t' ,'--cap_radius', type=float, help='cap radius, default: 0.8', default=0.80)
+parser.add_argument('-cd','--cache_dir', type=str, help='directory for caching EC curves of meshes across runs, default: no cache', default=None)
+parser.add_argument('-cs','--cache_size', type=float, help='maximum size of EC cache in MB, least recently used entries are removed, default: no limit', default=None)
+parser.add_argument('-sp','--sparse', help='keep EC features as sparse matrix, scaled but not centered', dest='sparse', action='store_true')
 parser.add_argument('-l' ,'--n_filtration', type=int, help='number of filtration step, default: 20', default=20)
 
 parser.add_argument('-bw','--bandwidth', type=float, help='bandwidth for elliptical slice sampling, default: 0.01',default=0.01)
 parser.add_argument('-sm','--sampling_method', type=str, help='sampling method, default: ESS', default='ESS')
 parser.add_argument('-nm','--n_mcmc', type=int, help='number of sample from ESS', default=100000)
+parser.add_argument('-th','--thin', type=int, help='thinning interval of samples from ESS, default: 1', default=1)
+parser.add_argument('-ol','--online', help='keep running mean and covariance of samples from ESS instead of all samples', dest='online', action='store_true')
+parser.add_argument('-ch','--n_chain', type=int, help='number of independent chains for ESS, default: 1', default=1)
+parser.add_argument('-rh','--rhat_threshold', type=float, help='stop ESS early once max. R-hat across chains is below threshold', default=None)
 parser.add_argument('-ll' ,'--logistic_likelihood', help='use logistic likelihood instead of probit likelihood', dest='probit', action='store_false')
+parser.add_argument('-sr','--svd_rank', type=int, help='use randomized truncated SVD of given rank for RATE calculation, default: exact SVD', default=None)
 parser.add_argument('-lr' ,'--low_rank', help='use low rank matrix approximations to compute the RATE values', dest='low_rank', action='store_true')
 
+parser.add_argument('-fr','--force_rerun', type=str, nargs='*', help='rerun the given stages (trajectory/mesh/directions/ec/rate/reconstruction) even if unchanged, all stages if none given, default: resume from the first changed stage', default=None)
+
 parser.add_argument('-v' ,'--verbose', help='verbose', dest='verbose', action='store_true')
 parser.add_argument('-no','--name_offset', help='name folder with offset', dest='single', action='store_false')
 
-parser.set_defaults(from_pdb=False,hemisphere=False,probit=True,low_rank=False,parallel=False,verbose=False,single=True)
+parser.set_defaults(from_pdb=False,binary_mesh=False,ensemble_mesh=False,in_memory=False,hemisphere=False,sparse=False,online=False,probit=True,low_rank=False,parallel=False,verbose=False,single=True)
 args = parser.parse_args()
 
 from_pdb = args.from_pdb # if True, start from PDB files
@@ -77,8 +93,13 @@ n_core = args.n_core
 # Sample from trajectory
 n_sample = args.n_sample
 offset = args.offset
+frame_sampling = args.frame_sampling
+frame_seed = args.frame_seed
 selection = args.selection
 sm_radius = args.radius
+binary_mesh = args.binary_mesh
+ensemble_mesh = args.ensemble_mesh
+in_memory = args.in_memory and not from_pdb
 
 ## EC calculation 
 ec_type = args.ec_type
@@ -87,20 +108,83 @@ n_direction_per_cone = args.n_direction_per_cone
 cap_radius = args.cap_radius
 n_filtration = args.n_filtration
 hemisphere = args.hemisphere
+sparse = args.sparse
+cache_dir = args.cache_dir
+cache_size = None if args.cache_size == None else int(args.cache_size*2**20)
 
 ## Variable selection parameters
 bandwidth = args.bandwidth
 sampling_method = args.sampling_method
 n_mcmc = args.n_mcmc
+thin = args.thin
+online = args.online
+n_chain = args.n_chain
+rhat_threshold = args.rhat_threshold
 probit = args.probit
 low_rank = args.low_rank
+svd_rank = args.svd_rank
 single = args.single
+force_rerun = args.force_rerun
 verbose = args.verbose
 
 ##########################################################################
 
-## Read trajectory file and output aligned protein structures in pdb format
+## Each calculation is run as a named stage of a pipeline, with a manifest of its parameters, inputs and outputs in "directory/manifest/".
+## Rerunning the program skips the stages whose inputs and parameters are unchanged, and resumes from the first stage that changed.
+runner = pipeline("%s/manifest"%directory, force=force_rerun, verbose=verbose)
+
 if not from_pdb:
+    ## same folder names as written by convert_traj_pdb_aligned and convert_traj_mesh
+    if single:
+        directory_pdb_A = "%s/pdb/%s/"%(directory,protA)
+        directory_pdb_B = "%s/pdb/%s/"%(directory,protB)
+    else:
+        directory_pdb_A = "%s/pdb/%s_offset_%d/"%(directory,protA,offset)
+        directory_pdb_B = "%s/pdb/%s_offset_%d/"%(directory,protB,offset)
+    reference_pdb_file = "%s/%s_frame0.pdb"%(directory_pdb_A,protA) ## which pdb to use for visualization
+else:
+    # directories for files if start from PDB files
+    directory_pdb_A = args.pdbpath_A
+    directory_pdb_B = args.pdbpath_B
+    reference_pdb_file = args.pdb_reference 
+
+## Meshes are stored as folders of mesh files, or as single mesh ensemble files 
+directory_mesh_A = "%s/msh/%s_%.1f"%(directory,protA,sm_radius)
+directory_mesh_B = "%s/msh/%s_%.1f"%(directory,protB,sm_radius)
+if ensemble_mesh:
+    directory_mesh_A += ".emsh"
+    directory_mesh_B += ".emsh"
+
+## outputs of each stage are removed before it is rerun, so frames of an earlier run (e.g. with larger n_sample) are not left in the folders
+traj_outputs = [directory_pdb_A,directory_pdb_B,"%s_frames.txt"%directory_pdb_A.rstrip('/'),"%s_frames.txt"%directory_pdb_B.rstrip('/')]
+traj_parameters = {'protA':protA, 'protB':protB, 'n_sample':n_sample, 'offset':offset, 'selection':selection, 'sampling':frame_sampling, 'seed':frame_seed, 'single':single}
+mesh_parameters = {'sm_radius':sm_radius, 'binary':binary_mesh, 'ensemble':ensemble_mesh}
+
+## Read trajectory file and convert aligned protein structures to simplicial meshes in memory
+def run_traj_mesh():
+    convert_traj_mesh(protA, protB, 
+            struct_file_A=struct_file_A, 
+            traj_file_A=traj_file_A, 
+            struct_file_B=struct_file_B, 
+            traj_file_B=traj_file_B, 
+            sm_radius=sm_radius,
+            align_frame=offset, 
+            n_sample=n_sample, 
+            selection=selection, 
+            offset=offset, 
+            sampling=frame_sampling,
+            seed=frame_seed,
+            directory=directory,
+            single=single,
+            binary=binary_mesh,
+            ensemble=ensemble_mesh,
+            directory_mesh="%s/msh/"%(directory), 
+            parallel=parallel, 
+            n_core=n_core, 
+            verbose=verbose)
+
+## Read trajectory file and output aligned protein structures in pdb format
+def run_traj_pdb():
     convert_traj_pdb_aligned(protA, protB, 
             struct_file_A=struct_file_A, 
             traj_file_A=traj_file_A, 
@@ -110,93 +194,163 @@ if not from_pdb:
             n_sample=n_sample, 
             selection=selection, 
             offset=offset, 
+            sampling=frame_sampling,
+            seed=frame_seed,
             directory=directory,
             single=single, ## single="True" is for single run purpose, "False" for duplicate runs purpose which groups and names file with the frame offset.
+            parallel=parallel, 
+            n_core=n_core, 
             verbose=verbose)
 
+if in_memory:
+    runner.run('trajectory', run_traj_mesh,
+            parameters=dict(traj_parameters,**mesh_parameters),
+            inputs=[struct_file_A,traj_file_A,struct_file_B,traj_file_B],
+            outputs=traj_outputs+[directory_mesh_A,directory_mesh_B])
+elif not from_pdb:
+    runner.run('trajectory', run_traj_pdb,
+            parameters=traj_parameters,
+            inputs=[struct_file_A,traj_file_A,struct_file_B,traj_file_B],
+            outputs=traj_outputs)
+
 #####################
 ### IF you already have your own aligned structure, start here
 #####################
 
-if not from_pdb:
-    directory_pdb_A = "%s/pdb/%s/"%(directory,protA)
-    directory_pdb_B = "%s/pdb/%s/"%(directory,protB)
-    reference_pdb_file = "%s/%s_frame0.pdb"%(directory_pdb_A,protA) ## which pdb to use for visualization
-else:
-    # directories for files if start from PDB files
-    directory_pdb_A = args.pdbpath_A
-    directory_pdb_B = args.pdbpath_B
-    reference_pdb_file = args.pdb_reference 
-
 ## Converted protein structures into simplicial mesehes
+def run_mesh():
+    convert_pdb_mesh(protA,protB,
+            n_sample=n_sample, 
+            sm_radius=sm_radius, 
+            directory_pdb_A=directory_pdb_A, 
+            directory_pdb_B=directory_pdb_B, 
+            directory_mesh="%s/msh/"%(directory), 
+            binary=binary_mesh,
+            ensemble=ensemble_mesh,
+            parallel=parallel, 
+            n_core=n_core, 
+            verbose=verbose)
 
-convert_pdb_mesh(protA,protB,
-        n_sample=n_sample, 
-        sm_radius=sm_radius, 
-        directory_pdb_A=directory_pdb_A, 
-        directory_pdb_B=directory_pdb_B, 
-        directory_mesh="%s/msh/"%(directory), 
-        parallel=parallel, 
-        n_core=n_core, 
-        verbose=verbose)
+if not in_memory:
+    runner.run('mesh', run_mesh,
+            parameters=dict(mesh_parameters,protA=protA,protB=protB,n_sample=n_sample),
+            inputs=[directory_pdb_A,directory_pdb_B],
+            outputs=[directory_mesh_A,directory_mesh_B])
+
+## Output files of the later stages, which are read back by the stages that follow
+directions_file = "%s/directions_%d_%d_%.2f.txt"%(directory,n_cone,n_direction_per_cone,cap_radius)
+suffix = "%s_%s_%s_%.1f_%d_%d_%.2f_%d"%(ec_type,protA,protB,sm_radius,n_cone,n_direction_per_cone,cap_radius,n_filtration)
+if sparse:
+    ec_file = "%s/%s_norm_all.npz"%(directory,suffix)
+else:
+    ec_file = "%s/%s_norm_all.txt"%(directory,suffix)
+notvacuum_file = "%s/notvacuum_%s_norm_all.txt"%(directory,suffix)
+label_file = '%s/%s_%s_label_all.txt'%(directory,protA,protB)
+rate_file = "%s/rate_%s.txt"%(directory,suffix)
+rate_atom_file = "%s/rate_atom_%s.txt"%(directory,suffix)
+rate_atom_pdb_file = "%s/rate_atom_%s_all.pdb"%(directory,suffix)
 
 ## Calculate distributed cones of directions for EC calculations
-directions = generate_equidistributed_cones(n_cone=n_cone,
-        n_direction_per_cone=n_direction_per_cone,
-        cap_radius=cap_radius,
-        hemisphere=hemisphere)
-np.savetxt("%s/directions_%d_%d_%.2f.txt"%(directory,n_cone,n_direction_per_cone,cap_radius),directions)
+def run_directions():
+    directions = load_equidistributed_cones(n_cone=n_cone,
+            n_direction_per_cone=n_direction_per_cone,
+            cap_radius=cap_radius,
+            hemisphere=hemisphere,
+            cache_dir=None if cache_dir == None else os.path.join(cache_dir,'directions'))
+    np.savetxt(directions_file,directions)
+
+runner.run('directions', run_directions,
+        parameters={'n_cone':n_cone, 'n_direction_per_cone':n_direction_per_cone, 'cap_radius':cap_radius, 'hemisphere':hemisphere},
+        outputs=[directions_file])
 
 ## EC calculations to convert simplicial meshes to topological summary statistics
-X, y, not_vacuum = compute_ec_curve_folder(protA,protB,directions,
-        n_sample=n_sample,
-        ec_type=ec_type,
-        n_filtration=n_filtration,
-        sm_radius=sm_radius,
-        directory_mesh_A = "%s/msh/%s_%.1f"%(directory,protA,sm_radius), 
-        directory_mesh_B = "%s/msh/%s_%.1f"%(directory,protB,sm_radius), 
-        parallel=parallel, 
-        n_core=n_core, 
-        verbose=verbose)
-
-np.savetxt("%s/%s_%s_%s_%.1f_%d_%d_%.2f_%d_norm_all.txt"%(directory,ec_type,protA,protB,sm_radius,n_cone,n_direction_per_cone,cap_radius,n_filtration),X)
-np.savetxt("%s/notvacuum_%s_%s_%s_%.1f_%d_%d_%.2f_%d_norm_all.txt"%(directory,ec_type,protA,protB,sm_radius,n_cone,n_direction_per_cone,cap_radius,n_filtration),not_vacuum)
-np.savetxt('%s/%s_%s_label_all.txt'%(directory,protA,protB),y)    
+def run_ec():
+    directions = np.loadtxt(directions_file,ndmin=2)
+    X, y, not_vacuum = compute_ec_curve_folder(protA,protB,directions,
+            n_sample=n_sample,
+            ec_type=ec_type,
+            n_filtration=n_filtration,
+            sm_radius=sm_radius,
+            directory_mesh_A = directory_mesh_A, 
+            directory_mesh_B = directory_mesh_B, 
+            parallel=parallel, 
+            n_core=n_core, 
+            cache_dir=cache_dir,
+            cache_size=cache_size,
+            sparse=sparse,
+            verbose=verbose)
+    if sparse:
+        from scipy.sparse import save_npz
+        save_npz(ec_file,X)
+    else:
+        np.savetxt(ec_file,X)
+    np.savetxt(notvacuum_file,not_vacuum)
+    np.savetxt(label_file,y)    
+
+runner.run('ec', run_ec,
+        parameters={'protA':protA, 'protB':protB, 'n_sample':n_sample, 'ec_type':ec_type, 'n_filtration':n_filtration, 'sparse':sparse},
+        inputs=[directory_mesh_A,directory_mesh_B,directions_file],
+        outputs=[ec_file,notvacuum_file,label_file])
 
 ## RATE calculation for variable selections from the topological summary statistics
-kld, rates, delta, eff_samp_size = calc_rate(X,y,
-        bandwidth=bandwidth,
-        n_mcmc=n_mcmc,
-        low_rank=low_rank,
-        parallel=parallel,
-        n_core=n_core,
-        verbose=verbose)
+def run_rate():
+    if sparse:
+        from scipy.sparse import load_npz
+        X = load_npz(ec_file)
+    else:
+        X = np.loadtxt(ec_file,ndmin=2)
+    y = np.loadtxt(label_file)
+    kld, rates, delta, eff_samp_size = calc_rate(X,y,
+            bandwidth=bandwidth,
+            n_mcmc=n_mcmc,
+            thin=thin,
+            online=online,
+            n_chain=n_chain,
+            rhat_threshold=rhat_threshold,
+            low_rank=low_rank,
+            svd_rank=svd_rank,
+            parallel=parallel,
+            n_core=n_core,
+            verbose=verbose)
+    np.savetxt(rate_file,rates)
 
-np.savetxt("%s/rate_%s_%s_%s_%.1f_%d_%d_%.2f_%d.txt"%(directory,ec_type,protA,protB,sm_radius,n_cone,n_direction_per_cone,cap_radius,n_filtration),rates)
+runner.run('rate', run_rate,
+        parameters={'bandwidth':bandwidth, 'n_mcmc':n_mcmc, 'thin':thin, 'online':online, 'n_chain':n_chain, 'rhat_threshold':rhat_threshold, 'low_rank':low_rank, 'svd_rank':svd_rank},
+        inputs=[ec_file,label_file],
+        outputs=[rate_file])
 
 ## reconstruct the RATE values onto the protein structures for visualization
 ## reconstruct probabilities are stored in "Temperature factor" column in the pdb format
 ## can then be visualized using Chimera or Pymol  
-vert_prob = reconstruct_on_multiple_mesh(protA,protB,directions,
-        rates=rates,
-        not_vacuum=not_vacuum,
-        n_sample=n_sample,
-        n_direction_per_cone=n_direction_per_cone,
-        n_filtration=n_filtration,
-        sm_radius=sm_radius,
-        directory_mesh="%s/msh/%s_%.1f"%(directory,protA,sm_radius),
-        parallel=parallel,
-        n_core=n_core
-        verbose=verbose)
-
-np.savetxt("%s/rate_atom_%s_%s_%s_%.1f_%d_%d_%.2f_%d.txt"%(directory,ec_type,protA,protB,sm_radius,n_cone,n_direction_per_cone,cap_radius,n_filtration),vert_prob)
-
-write_vert_prob_on_pdb(vert_prob,
-        protA=protA,
-        protB=protB,
-        selection=selection, 
-        pdb_in_file=reference_pdb_file, 
-        pdb_out_file="%s/rate_atom_%s_%s_%s_%.1f_%d_%d_%.2f_%d_all.pdb"%(directory,ec_type,protA,protB,sm_radius,n_cone,n_direction_per_cone,cap_radius,n_filtration))
+def run_reconstruction():
+    directions = np.loadtxt(directions_file,ndmin=2)
+    rates = np.loadtxt(rate_file,ndmin=1)
+    not_vacuum = np.loadtxt(notvacuum_file,ndmin=1).astype(bool)
+    vert_prob = reconstruct_on_multiple_mesh(protA,protB,directions,
+            rates=rates,
+            not_vacuum=not_vacuum,
+            n_sample=n_sample,
+            n_direction_per_cone=n_direction_per_cone,
+            n_filtration=n_filtration,
+            sm_radius=sm_radius,
+            directory_mesh=directory_mesh_A,
+            parallel=parallel,
+            n_core=n_core,
+            verbose=verbose)
+
+    np.savetxt(rate_atom_file,vert_prob)
+
+    write_vert_prob_on_pdb(vert_prob,
+            protA=protA,
+            protB=protB,
+            selection=selection, 
+            pdb_in_file=reference_pdb_file, 
+            pdb_out_file=rate_atom_pdb_file)
+
+runner.run('reconstruction', run_reconstruction,
+        parameters={'n_sample':n_sample, 'n_direction_per_cone':n_direction_per_cone, 'n_filtration':n_filtration, 'selection':selection},
+        inputs=[rate_file,notvacuum_file,directions_file,directory_mesh_A,reference_pdb_file],
+        outputs=[rate_atom_file,rate_atom_pdb_file])
 
 print("SINATRA Pro calculation completed.")
 
@@ -0,0 +1,163 @@
+#!/bin/python3
+
+import sys, time
+import numpy as np
+from sinatra_pro.mesh import *
+from sinatra_pro.gp import *
+from sinatra_pro.RATE import *
+
+def generate_random_protein_vertices(n_vertices, density = 0.1, seed = 0):
+    """
+    Generate random vertices in a cube with the given number density (per cubic Angstrom), for benchmarking purpose.
+
+    The default `density` of 0.1 atom per cubic Angstrom is about the atom density of a protein with hydrogens.
+    """
+    rng = np.random.RandomState(seed)
+    length = (n_vertices/density)**(1./3.)
+    return rng.uniform(low = 0, high = length, size = (n_vertices,3))
+
+def benchmark_edge_to_face_list(n_vertices = (1000,10000,100000), sm_radius = 4.0, density = 0.1, run_old = True, verbose = True):
+    """
+    Benchmark the face construction of `mesh.edge_to_face_list` against the set-based `mesh.edge_to_face_list_old`.
+
+    `n_vertices` is the list of number of vertices of the random meshes.
+
+    `sm_radius` is the radius cutoff (in Angstrom) for connecting edges.
+
+    `density` is the number density of the random vertices (per cubic Angstrom).
+
+    If `run_old` is set to False, only the new implementation is timed.
+
+    It returns a list of (number of vertices, number of edges, number of faces, time of new implementation, time of old implementation).
+    """
+    results = []
+    if verbose:
+        sys.stdout.write('%10s %10s %10s %12s %12s %8s\n'%('n_vertex','n_edge','n_face','new (s)','old (s)','speedup'))
+    for n_vertex in n_vertices:
+        meshA = mesh()
+        meshA.vertices = generate_random_protein_vertices(n_vertex,density=density)
+        lmax = np.amax(meshA.vertices,axis=0)
+        lmin = np.amin(meshA.vertices,axis=0)
+        box = np.append((lmax-lmin)*1.2,[90.0,90.0,90.0])
+        meshA.neighbor_search_new(coords=(meshA.vertices-lmin).astype(np.float32),box=box.astype(np.float32),cutoff=sm_radius)
+        t_start = time.time()
+        meshA.edge_to_face_list()
+        t_new = time.time() - t_start
+        faces = meshA.faces
+        t_old = np.nan
+        if run_old:
+            t_start = time.time()
+            meshA.edge_to_face_list_old()
+            t_old = time.time() - t_start
+            faces_old = np.asarray(meshA.faces).reshape(-1,3)
+            if not np.array_equal(faces_old[np.lexsort(faces_old.T[::-1])],faces):
+                print("Faces from edge_to_face_list and edge_to_face_list_old differ for %d vertices!"%n_vertex)
+        results.append((n_vertex,len(meshA.edges),len(faces),t_new,t_old))
+        if verbose:
+            sys.stdout.write('%10d %10d %10d %12.4f %12.4f %8.1f\n'%(n_vertex,len(meshA.edges),len(faces),t_new,t_old,t_old/t_new))
+    return results
+
+def benchmark_covariance_matrix(n_samples = (100,500,2000), n_features = (1000,5000,20000), bandwidth = 1.0, block_size = None, n_core = 1, n_old = 100, verbose = True):
+    """
+    Benchmark the vectorized Gaussian kernel `CovarianceMatrix` against the loop over pairs in `CovarianceMatrix_old`, on random standardized data.
+
+    `n_samples` and `n_features` are the lists of number of observations n and number of features p, all combinations are benchmarked.
+
+    `bandwidth`, `block_size` and `n_core` are passed to `CovarianceMatrix`. 
+
+    The old implementation is timed on the first `n_old` observations only, and its time is extrapolated by the number of pairs n(n-1)/2.
+
+    It returns a list of (n, p, time in double precision, time in single precision, extrapolated time of old implementation, max. error in double precision, max. error in single precision), 
+    where the errors are computed against the old implementation on the first `n_old` observations.
+    """
+    results = []
+    if verbose:
+        sys.stdout.write('%8s %8s %12s %12s %12s %10s %10s\n'%('n','p','fp64 (s)','fp32 (s)','old (s)','err fp64','err fp32'))
+    rng = np.random.RandomState(0)
+    for n in n_samples:
+        for p in n_features:
+            x = rng.standard_normal((p,n))
+            t_start = time.time()
+            K = CovarianceMatrix(x,bandwidth=bandwidth,block_size=block_size,n_core=n_core)
+            t_double = time.time() - t_start
+            t_start = time.time()
+            K_single = CovarianceMatrix(x,bandwidth=bandwidth,block_size=block_size,single_precision=True,n_core=n_core)
+            t_single = time.time() - t_start
+            m = min(n,n_old)
+            t_start = time.time()
+            K_old = CovarianceMatrix_old(x[:,:m],bandwidth=bandwidth)
+            t_old = (time.time() - t_start) * (n*(n-1.))/max(m*(m-1.),1.)
+            err_double = np.amax(np.fabs(K[:m,:m]-K_old))
+            err_single = np.amax(np.fabs(K_single[:m,:m]-K_old))
+            results.append((n,p,t_double,t_single,t_old,err_double,err_single))
+            if verbose:
+                sys.stdout.write('%8d %8d %12.4f %12.4f %12.4f %10.2e %10.2e\n'%(n,p,t_double,t_single,t_old,err_double,err_single))
+    return results
+
+def benchmark_kld(n_features = (1000,5000,20000), rank = 100, block_size = None, n_old = 10, verbose = True):
+    """
+    Benchmark the closed-form KLD of all columns in `calc_kld_batched` against the loop over columns with `calc_kld`, on random Lambda and V of rank `rank`.
+
+    `n_features` is the list of number of features p.
+
+    `block_size` is passed to `calc_kld_batched`. 
+
+    The old implementation is timed on the first `n_old` columns only, and its time is extrapolated by the number of columns p.
+
+    It returns a list of (p, time of new implementation, extrapolated time of old implementation, max. relative error), 
+    where the error is computed against the old implementation on the first `n_old` columns.
+    """
+    results = []
+    if verbose:
+        sys.stdout.write('%8s %12s %12s %8s %10s\n'%('p','new (s)','old (s)','speedup','rel. err'))
+    rng = np.random.RandomState(0)
+    for p in n_features:
+        U = rng.standard_normal((p,rank))/np.sqrt(p)
+        Lambda = U @ U.T
+        U = rng.standard_normal((p,rank))/np.sqrt(p)
+        V = U @ U.T
+        del U
+        mu = np.fabs(rng.standard_normal(p))
+        t_start = time.time()
+        kld = calc_kld_batched(mu,Lambda,V,block_size=block_size)
+        t_new = time.time() - t_start
+        m = min(p,n_old)
+        t_start = time.time()
+        kld_old = np.array([calc_kld(mu,Lambda,V,q) for q in range(m)])
+        t_old = (time.time() - t_start) * p / m
+        err = np.amax(np.fabs(kld[:m]-kld_old))/np.amax(np.fabs(kld_old))
+        results.append((p,t_new,t_old,err))
+        if verbose:
+            sys.stdout.write('%8d %12.4f %12.4f %8.1f %10.2e\n'%(p,t_new,t_old,t_old/t_new,err))
+    return results
+
+def benchmark_rate_svd(X, f_draws, ranks = (10,20,50), low_rank = False, n_oversample = 10, n_power_iter = 2, top_fraction = 0.05, verbose = True):
+    """
+    Benchmark the accuracy and time of `RATE` with the randomized truncated SVD of rank `svd_rank` against the exact `RATE`, 
+    on the design matrix `X` (n x p, e.g. standardized EC curves from `compute_ec_curve_folder`) and the posterior draws `f_draws` (e.g. from `Elliptical_Slice_Sampling`).
+
+    `ranks` is the list of target ranks. `low_rank`, `n_oversample` and `n_power_iter` are passed to `RATE`.
+
+    It returns a list of (rank, time of exact RATE, time of randomized RATE, max. error of RATE values relative to the max. RATE value, 
+    correlation of RATE values, fraction of the top `top_fraction` features by exact RATE values also in the top features by randomized RATE values).
+    """
+    results = []
+    if verbose:
+        sys.stdout.write('%8s %12s %12s %10s %12s %8s\n'%('rank','exact (s)','random (s)','rel. err','correlation','top'))
+    t_start = time.time()
+    rates = RATE(X,f_draws=f_draws,low_rank=low_rank)[1]
+    t_exact = time.time() - t_start
+    n_top = max(int(top_fraction*rates.size),1)
+    top = np.argsort(rates)[::-1][:n_top]
+    for rank in ranks:
+        t_start = time.time()
+        rates_svd = RATE(X,f_draws=f_draws,low_rank=low_rank,svd_rank=rank,n_oversample=n_oversample,n_power_iter=n_power_iter)[1]
+        t_svd = time.time() - t_start
+        err = np.amax(np.fabs(rates_svd-rates))/np.amax(rates)
+        corr = np.corrcoef(rates,rates_svd)[0,1]
+        overlap = np.intersect1d(top,np.argsort(rates_svd)[::-1][:n_top]).size/n_top
+        results.append((rank,t_exact,t_svd,err,corr,overlap))
+        if verbose:
+            sys.stdout.write('%8d %12.4f %12.4f %10.2e %12.6f %8.2f\n'%(rank,t_exact,t_svd,err,corr,overlap))
+    return results
+
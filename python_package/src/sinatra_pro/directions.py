@@ -1,7 +1,12 @@
 #!/bin/python3
 
+import os
 import numpy as np
 
+def norms(x):
+    """Euclidean norms of the vectors along the last axis of `x`, computed as dot products to match `np.linalg.norm` of each vector exactly."""
+    return np.sqrt((x[...,None,:] @ x[...,:,None])[...,0,0])
+
 def rodrigues(z,r,j):
     """
     Compute the directions about a cone using the rodrigues angle formula.
@@ -14,34 +19,40 @@ def rodrigues(z,r,j):
 
     """
     z /= np.linalg.norm(z)
-    z0 = np.zeros(3)
-    if np.any(z == 0):
-        z0[z == 0] = 1
-    else:
-        z0[0] = 2/z[0]
-        z0[1] = -1/z[1]
-        z0[2] = -1/z[2]
-    z0 /= np.linalg.norm(z0)
+    return rodrigues_cones(z[None,:],r,j)[0]
+
+def rodrigues_cones(z,r,j):
+    """
+    Compute the directions about several cones at once using the rodrigues angle formula, same as `rodrigues` for each cone.
+
+   `z` is the array of shape (n_cone, 3) of the unit vectors of the central axes of the cones.
+
+   `r` is the radius of the cones that controls the size of the cones.
+
+   `j` is the number of directions in each cone.
+
+    It returns an array of shape (n_cone, `j`, 3).
+    """
+    z = np.asarray(z,dtype=float).reshape(-1,3)
+    is_zero = z == 0
+    has_zero = np.any(is_zero,axis=1)
+    with np.errstate(divide='ignore'):
+        z0 = np.stack((2/z[:,0],-1/z[:,1],-1/z[:,2]),axis=1)
+    z0[has_zero] = is_zero[has_zero].astype(float)
+    z0 /= norms(z0)[:,None]
     z0 *= r
     z0 = z + z0
-    z0 /= np.linalg.norm(z0)
+    z0 /= norms(z0)[:,None]
     B = np.cross(z,z0)
-    C = np.dot(z,z0)*z
-    directions = np.zeros((j,3))
-    for i in range(j):
-        x = 2*np.pi*(i+1)/j
-        directions[i,:] = z0*np.cos(x)+B*np.sin(x)+C*(1-np.cos(x))
-    return directions
+    C = (z[:,None,:] @ z0[:,:,None])[:,0]*z
+    x = 2*np.pi*np.arange(1,j+1)/j
+    cos = np.cos(x)[None,:,None]
+    sin = np.sin(x)[None,:,None]
+    return z0[:,None,:]*cos+B[:,None,:]*sin+C[:,None,:]*(1-cos)
 
-def generate_equidistributed_points(desired_number, N, hemisphere=False):
+def equidistributed_rings(N, hemisphere=False):
     """
-    Generate Equidistributed points on a sphere / hemi-sphere.
-    
-    `desired_number` is the desired number of equidistributed points on the 2-sphere.
-    
-    `N` is the initial number of points that the algorithm will try to generate. If the number of points generated is less than the desired number, the function will increment `N`.
-    
-    If `hemisphere` is set to true, it generates points over hemisphere instead of over whole sphere.
+    Polar angles and number of points of the rings of latitude of `generate_equidistributed_points` for `N` points.
     """
     if hemisphere:
         a = 2*np.pi/N
@@ -54,23 +65,33 @@ def generate_equidistributed_points(desired_number, N, hemisphere=False):
         M_theta = int(round(np.pi/d))
         d_theta = np.pi/M_theta
     d_phi = a/d_theta
-    points = []
-    for i in range(M_theta):
-        if hemisphere:
-            theta = np.pi * .5 * i / M_theta
-        else:
-            theta = np.pi * (i + 0.5) / M_theta
-        M_phi = int(round(2*np.pi*np.sin(theta)/d_phi))
-        for j in range(M_phi):
-            phi = 2*np.pi*j/M_phi
-            point = [np.sin(theta)*np.cos(phi),np.sin(theta)*np.sin(phi),np.cos(theta)]
-            point /= np.linalg.norm(point)
-            points.append(point)
-    points = np.array(points)
-    if points.shape[0] < desired_number:
-        return generate_equidistributed_points(desired_number,N+1,hemisphere)
+    if hemisphere:
+        theta = np.pi * .5 * np.arange(M_theta) / M_theta
     else:
-        return points
+        theta = np.pi * (np.arange(M_theta) + 0.5) / M_theta
+    M_phi = np.round(2*np.pi*np.sin(theta)/d_phi).astype(int)
+    return theta, M_phi
+
+def generate_equidistributed_points(desired_number, N, hemisphere=False):
+    """
+    Generate Equidistributed points on a sphere / hemi-sphere.
+    
+    `desired_number` is the desired number of equidistributed points on the 2-sphere.
+    
+    `N` is the initial number of points that the algorithm will try to generate. If the number of points generated is less than the desired number, the function will increment `N`.
+    The number of points for each `N` is counted from the rings of latitude only (see `equidistributed_rings`), and the points are generated once for the first sufficient `N`.
+    
+    If `hemisphere` is set to true, it generates points over hemisphere instead of over whole sphere.
+    """
+    theta, M_phi = equidistributed_rings(N,hemisphere)
+    while np.sum(M_phi) < desired_number:
+        N += 1
+        theta, M_phi = equidistributed_rings(N,hemisphere)
+    theta = np.repeat(theta,M_phi)
+    phi = 2*np.pi*(np.arange(theta.size) - np.repeat(np.cumsum(M_phi)-M_phi,M_phi)) / np.repeat(M_phi,M_phi)
+    points = np.stack((np.sin(theta)*np.cos(phi),np.sin(theta)*np.sin(phi),np.cos(theta)),axis=1)
+    points /= norms(points)[:,None]
+    return points
 
 def generate_equidistributed_cones(n_cone, cap_radius = 0.1, n_direction_per_cone = 1, hemisphere=False):
     """
@@ -86,14 +107,41 @@ def generate_equidistributed_cones(n_cone, cap_radius = 0.1, n_direction_per_con
     
     If `hemisphere` is set to True, it generates points over hemisphere instead of over whole sphere.
     """
-    sphere = generate_equidistributed_points(n_cone, n_cone, hemisphere)
-    directions = []
-    for i in range(n_cone):
-        directions.append(sphere[i]/np.linalg.norm(sphere[i]))
-        if n_direction_per_cone > 1:
-            for direction in rodrigues(sphere[i],cap_radius,n_direction_per_cone-1):
-                direction /= np.linalg.norm(direction)
-                directions.append(direction)
-    return np.array(directions)
+    sphere = generate_equidistributed_points(n_cone, n_cone, hemisphere)[:n_cone]
+    sphere /= norms(sphere)[:,None]
+    if n_direction_per_cone <= 1:
+        return sphere
+    cones = rodrigues_cones(sphere,cap_radius,n_direction_per_cone-1)
+    cones /= norms(cones)[:,:,None]
+    return np.concatenate((sphere[:,None,:],cones),axis=1).reshape(-1,3)
+
+cone_cache = {}
+"""Direction sets from `load_equidistributed_cones`, keyed by (n_cone, n_direction_per_cone, cap_radius, hemisphere)"""
 
+def load_equidistributed_cones(n_cone, cap_radius = 0.1, n_direction_per_cone = 1, hemisphere=False, cache_dir = None):
+    """
+    Return the equidistributed cones from `generate_equidistributed_cones`, generated once per set of parameters 
+    (n_cone, n_direction_per_cone, cap_radius, hemisphere) and kept in memory for later calls, 
+    such that the EC calculation and the reconstruction use the same directions.
 
+    If `cache_dir` is provided, the directions are also stored in and read from a .npy file in `cache_dir`, shared between runs.
+    """
+    key = (int(n_cone),int(n_direction_per_cone),float(cap_radius),bool(hemisphere))
+    if key in cone_cache:
+        return cone_cache[key].copy()
+    directions = None
+    if cache_dir != None:
+        filename = os.path.join(cache_dir,'directions_%d_%d_%r_%d.npy'%key)
+        if os.path.exists(filename):
+            directions = np.load(filename)
+    if directions is None:
+        directions = generate_equidistributed_cones(n_cone,cap_radius=cap_radius,n_direction_per_cone=n_direction_per_cone,hemisphere=hemisphere)
+        if cache_dir != None:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir,exist_ok=True)
+            temp_file = '%s.%d.tmp'%(filename,os.getpid())
+            with open(temp_file,'wb') as f:
+                np.save(f,directions)
+            os.replace(temp_file,filename)
+    cone_cache[key] = directions
+    return directions.copy()
@@ -1,6 +1,6 @@
 #!/bin/python3
 
-import os, sys
+import os, sys, shutil, tempfile, hashlib
 from sinatra_pro.mesh import *
 from fast_histogram import histogram1d
 import multiprocessing
@@ -69,17 +69,452 @@ def compute_ec_curve(mesh, directions, n_filtration = 25, ball_radius = 1.0, ec_
     radius = np.linspace(-ball_radius,ball_radius,n_filtration)
     return radius, eulers
 
+def compute_ec_curves_batched(mesh, directions, n_filtration = 25, ball_radius = 1.0, ec_type = "ECT", include_faces = True, n_direction_block = 32):
+    """
+    Computes the Euler Characteristics (EC) curves in all given directions at once for a given mesh 
+
+    The heights of the vertices in a block of directions are computed with one matrix multiplication, 
+    the heights of edges and faces are reduced from them for all directions in the block together, 
+    and the sub-level set counts of vertices, edges and faces for all directions are obtained with a single `np.bincount`. 
+    The EC curves are identical to the ones from `compute_ec_curve_single` called once per direction.
+
+    `mesh` is the `mesh` class containing vertices, edges, and faces of the mesh.
+
+    `directions` is the list of vectors containing all directions for EC curves to be calculated on.
+
+    `n_filtration` is the number of sub-level sets for which to compute the EC curve on in a given direction.
+
+    `ball_radius` is the radius of the bounding ball.
+
+    `ec_type` is the type of EC transform (ECT), available options: DECT / ECT / SECT. 
+
+    If `included_faces` is set to False, it ignore faces from the EC calculations.
+
+    `n_direction_block` is the number of directions processed together, which bounds the memory usage to 
+    about `n_direction_block` times the number of simplices, set to None to process all directions in one block.
+    """
+    directions = np.asarray(directions,dtype=float).reshape(-1,3)
+    vertices = np.asarray(mesh.vertices,dtype=float).reshape(-1,3)
+    edges = np.asarray(mesh.edges,dtype=int).reshape(-1,2)
+    if include_faces:
+        faces = np.asarray(mesh.faces,dtype=int).reshape(-1,3)
+    else:
+        faces = np.zeros((0,3),dtype=int)
+    n_direction = directions.shape[0]
+    n_vertex = vertices.shape[0]
+    n_edge = edges.shape[0]
+    n_face = faces.shape[0]
+    if n_direction_block == None:
+        n_direction_block = max(n_direction,1)
+    
+    # one bin below and one bin above [-ball_radius,ball_radius) for values outside the range, which are dropped as in histogram1d 
+    n_bin = n_filtration+1
+    scale = (n_filtration-1)/(ball_radius-(-ball_radius))
+    eulers = np.zeros((n_direction,n_filtration),dtype=float)
+    for i_start in range(0,n_direction,n_direction_block):
+        direction = directions[i_start:i_start+n_direction_block]
+        n_block = direction.shape[0]
+        function = np.empty((n_vertex+n_edge+n_face,n_block),dtype=float)
+        vertex_function = function[:n_vertex]
+        edge_function = function[n_vertex:n_vertex+n_edge]
+        face_function = function[n_vertex+n_edge:]
+        np.dot(vertices,direction.T,out=vertex_function)
+        np.maximum(vertex_function[edges[:,0]],vertex_function[edges[:,1]],out=edge_function)
+        np.maximum(vertex_function[faces[:,0]],vertex_function[faces[:,1]],out=face_function)
+        np.maximum(face_function,vertex_function[faces[:,2]],out=face_function)
+        # filtration index of each simplex in each direction, same binning as histogram1d
+        function -= -ball_radius
+        function *= scale
+        np.clip(function,-1,n_filtration-1,out=function)
+        np.floor(function,out=function)
+        index = function.astype(np.intp)
+        del function, vertex_function, edge_function, face_function
+        index += (np.arange(n_block)*n_bin+1)[None,:]
+        index[n_vertex:n_vertex+n_edge] += n_block*n_bin
+        index[n_vertex+n_edge:] += 2*n_block*n_bin
+        counts = np.bincount(index.ravel(),minlength=3*n_block*n_bin).reshape(3,n_block,n_bin)
+        del index
+        eulers[i_start:i_start+n_block,1:] = (counts[0] - counts[1] + counts[2])[:,1:-1]
+
+    radius = np.linspace(-ball_radius,ball_radius,n_filtration)
+    return radius, transform_ec_curves(eulers,radius,ec_type)
+
+def transform_ec_curves(eulers, radius, ec_type = "ECT"):
+    """
+    Convert the EC changes `eulers` of shape (n_direction, n_filtration), i.e. the sum of vertices - edges + faces entering 
+    the sub-level set at each filtration step `radius` (the first column is zero), to EC curves of type `ec_type` (DECT / ECT / SECT), 
+    as in `compute_ec_curve_single`. It returns None for an unknown `ec_type`.
+    """
+    n_filtration = radius.size
+    if ec_type == "ECT":
+        eulers = np.cumsum(eulers,axis=1)
+    elif ec_type == "DECT":
+        eulers[:,1:] = eulers[:,1:] / (radius[1:]-radius[:-1])
+    elif ec_type == "SECT":
+        eulers = np.cumsum(eulers,axis=1)
+        eulers -= np.mean(eulers,axis=1)[:,None]
+        eulers = np.cumsum(eulers,axis=1)*((radius[-1]-radius[0])/n_filtration)
+    else:
+        eulers = None
+    return eulers
+
+class ec_step_function:
+    """
+    Exact Euler characteristics of the sub-level sets of a mesh in a set of directions, stored as step functions. 
+
+    For each direction, the heights of all vertices, edges (max. height of the 2 vertices) and faces (max. height of the 3 vertices) are sorted once, 
+    and only the critical values, i.e. the distinct heights where the EC changes, are kept together with the jump of the EC at each of them 
+    (+1 per vertex, -1 per edge, +1 per face entering the sub-level set). The EC at any threshold, EC curves on any filtration grid 
+    and integrals of the EC are then evaluated from the critical values without revisiting the mesh.
+
+    The critical values and jumps of all directions are concatenated, those of direction `i` are in `offsets[i]:offsets[i+1]`.
+    Use `compute_ec_step_function` to construct it from a mesh.
+    """
+
+    def __init__(self, values, jumps, offsets):
+        self.values = values
+        """Sorted critical values of each direction, concatenated"""
+        self.jumps = jumps
+        """Jump of the EC at each critical value"""
+        self.offsets = offsets
+        """Start of the critical values of each direction, and end of the last direction"""
+        self.n_direction = offsets.size - 1
+        """Number of directions"""
+        return
+
+    def ect(self, thresholds):
+        """
+        Exact EC of the sub-level sets {height <= t} for each threshold t in `thresholds`, 
+        it returns an array of shape (n_direction, number of thresholds).
+        """
+        thresholds = np.asarray(thresholds,dtype=float)
+        eulers = np.zeros((self.n_direction,thresholds.size),dtype=float)
+        for i in range(self.n_direction):
+            cum = np.cumsum(self.jumps[self.offsets[i]:self.offsets[i+1]])
+            index = np.searchsorted(self.values[self.offsets[i]:self.offsets[i+1]],thresholds,side='right')
+            eulers[i,index > 0] = cum[index[index > 0]-1]
+        return eulers
+
+    def curves(self, n_filtration = 25, ball_radius = 1.0, ec_type = "ECT"):
+        """
+        EC curves on the grid of `n_filtration` steps from -`ball_radius` to `ball_radius`, of type `ec_type` (DECT / ECT / SECT), 
+        identical to the ones from `compute_ec_curves_batched`, i.e. the changes of EC are binned into the `n_filtration`-1 intervals [r_k, r_k+1) 
+        and values outside [-`ball_radius`, `ball_radius`) are dropped. It returns the grid and the curves of shape (n_direction, `n_filtration`).
+        """
+        scale = (n_filtration-1)/(ball_radius-(-ball_radius))
+        index = (self.values - (-ball_radius)) * scale
+        np.clip(index,-1,n_filtration-1,out=index)
+        index = np.floor(index).astype(np.intp)
+        keep = np.logical_and(index >= 0, index < n_filtration-1)
+        direction = np.repeat(np.arange(self.n_direction),np.diff(self.offsets))
+        eulers = np.zeros((self.n_direction,n_filtration),dtype=float)
+        eulers[:,1:] = np.bincount(direction[keep]*(n_filtration-1)+index[keep],weights=self.jumps[keep],minlength=self.n_direction*(n_filtration-1)).reshape(self.n_direction,n_filtration-1)
+        radius = np.linspace(-ball_radius,ball_radius,n_filtration)
+        return radius, transform_ec_curves(eulers,radius,ec_type)
+
+    def integral(self, lower = -1.0, upper = 1.0):
+        """Exact integral of the EC of the sub-level sets over thresholds from `lower` to `upper` in each direction."""
+        direction = np.repeat(np.arange(self.n_direction),np.diff(self.offsets))
+        offset = self.jumps * (upper - np.maximum(self.values,lower))
+        offset[self.values >= upper] = 0
+        return np.bincount(direction,weights=offset,minlength=self.n_direction)
+
+def compute_ec_step_function(mesh, directions, include_faces = True, n_direction_block = 32):
+    """
+    Computes the exact EC step functions (see `ec_step_function`) of a mesh in all given directions, 
+    by sorting the heights of all simplices once per direction.
+
+    `mesh` is the `mesh` class containing vertices, edges, and faces of the mesh.
+
+    `directions` is the list of vectors containing all directions.
+
+    If `included_faces` is set to False, it ignore faces from the EC calculations.
+
+    `n_direction_block` is the number of directions processed together, see `compute_ec_curves_batched`.
+    """
+    directions = np.asarray(directions,dtype=float).reshape(-1,3)
+    vertices = np.asarray(mesh.vertices,dtype=float).reshape(-1,3)
+    edges = np.asarray(mesh.edges,dtype=int).reshape(-1,2)
+    if include_faces:
+        faces = np.asarray(mesh.faces,dtype=int).reshape(-1,3)
+    else:
+        faces = np.zeros((0,3),dtype=int)
+    n_direction = directions.shape[0]
+    n_vertex = vertices.shape[0]
+    n_edge = edges.shape[0]
+    weight = np.concatenate((np.ones(n_vertex,dtype=np.int64),-np.ones(n_edge,dtype=np.int64),np.ones(faces.shape[0],dtype=np.int64)))
+    if n_direction_block == None:
+        n_direction_block = max(n_direction,1)
+    values = []
+    jumps = []
+    offsets = np.zeros(n_direction+1,dtype=np.intp)
+    for i_start in range(0,n_direction,n_direction_block):
+        direction = directions[i_start:i_start+n_direction_block]
+        vertex_function = np.dot(vertices,direction.T)
+        function = np.concatenate((vertex_function,
+                np.maximum(vertex_function[edges[:,0]],vertex_function[edges[:,1]]),
+                np.maximum(np.maximum(vertex_function[faces[:,0]],vertex_function[faces[:,1]]),vertex_function[faces[:,2]])),axis=0)
+        order = np.argsort(function,axis=0,kind='stable')
+        for j in range(direction.shape[0]):
+            height = function[order[:,j],j]
+            starts = np.flatnonzero(np.concatenate(([True],height[1:] != height[:-1])))
+            jump = np.add.reduceat(weight[order[:,j]],starts) if starts.size > 0 else np.zeros(0,dtype=np.int64)
+            critical = jump != 0
+            values.append(height[starts][critical])
+            jumps.append(jump[critical])
+            offsets[i_start+j+1] = offsets[i_start+j] + np.count_nonzero(critical)
+    values = np.concatenate(values) if len(values) > 0 else np.zeros(0,dtype=float)
+    jumps = np.concatenate(jumps) if len(jumps) > 0 else np.zeros(0,dtype=np.int64)
+    return ec_step_function(values,jumps,offsets)
+
 def compute_ec_curve_parallel(mesh, directions, n_filtration = 25, ball_radius = 1.0, ec_type = "ECT", include_faces = True, n_core = -1):
-    """Computes the Euler Characteristics (EC) curves in a given direction with single multiple core"""
-    parameter = (ball_radius,n_filtration,ec_type,include_faces)
+    """
+    Computes the Euler Characteristics (EC) curves in a given direction with single multiple core
+
+    The directions are split into one contiguous block per core, such that the mesh is sent to each worker only once.
+    """
+    parameter = (n_filtration,ball_radius,ec_type,include_faces)
     if n_core == -1:    
         n_core = multiprocessing.cpu_count()
-    processed_list = Parallel(n_jobs=n_core)(delayed(compute_ec_curve_single)(mesh,direction,*parameter) for direction in directions)
-    processed_list = np.array(processed_list)
+    blocks = np.array_split(directions,min(n_core,len(directions)))
+    processed_list = Parallel(n_jobs=n_core)(delayed(compute_ec_curves_batched)(mesh,block,*parameter) for block in blocks)
+    processed_list = np.vstack([eulers for radius, eulers in processed_list])
     radius = np.linspace(-ball_radius,ball_radius,n_filtration)
     return radius, processed_list
 
-def compute_ec_curve_folder(protA = "protA", protB = "protB", directions = None, n_sample = 101, ec_type = "ECT", n_filtration = 25, ball_radius = 1.0, include_faces = True, directory_mesh_A = None, directory_mesh_B = None, sm_radius = 4.0, hemisphere=False, parallel = False, n_core = -1, verbose = False):
+def list_mesh_frames(directory_mesh, prot = None, n_sample = None):
+    """
+    List the meshes in a folder of .msh / .bmsh files, or in a mesh ensemble (.emsh) file, as pairs of (mesh file, frame), 
+    where frame is the frame number in the mesh ensemble file, or None for a mesh file. 
+
+    If `prot` and `n_sample` are provided, the meshes are the files `prot`_frame`i` in the folder for `i` = 0, ..., `n_sample`-1, 
+    otherwise the meshes are listed in the same order as `read_meshes`.
+    """
+    if prot != None and n_sample != None:
+        return [(find_mesh_file('%s/%s_frame%d'%(directory_mesh,prot,i_sample)),None) for i_sample in range(n_sample)]
+    if is_mesh_ensemble_file(directory_mesh):
+        with mesh_ensemble(directory_mesh) as ensemble:
+            return [(directory_mesh,i) for i in range(len(ensemble))]
+    return [(directory_mesh + '/' + filename,None) for filename in list_mesh_files(directory_mesh)]
+
+class ec_cache:
+    """
+    Persistent on-disk cache of the EC curves of meshes, shared between runs, e.g. for parameter sweeps, 
+    or for an ensemble of one protein compared against several other proteins.
+
+    The EC curves of each mesh are stored as a .npy file in `directory`, named by a hash of the content of the mesh 
+    (the bytes of the mesh file, or of the vertices, edges and faces of a frame of a mesh ensemble) together with 
+    the parameters of the EC calculation (directions, `n_filtration`, `ball_radius`, `ec_type`, `include_faces`), 
+    so a mesh is only recomputed when its content or the parameters change.
+
+    Reading an entry updates its modification time, and `evict` removes the least recently used entries 
+    until the total size of the cache is below `max_size` bytes (no limit if None).
+    Entries are written to a temporary file then renamed, so several processes can share the cache.
+    """
+
+    def __init__(self, directory, max_size = None):
+        self.directory = directory
+        """Folder of the cache entries"""
+        self.max_size = max_size
+        """Maximum total size of the cache entries in bytes"""
+        if not os.path.exists(directory):
+            os.makedirs(directory,exist_ok=True)
+        return
+
+    def parameter_key(self, directions, n_filtration, ball_radius, ec_type, include_faces):
+        """Hash of the parameters of the EC calculation"""
+        h = hashlib.blake2b(digest_size=20)
+        h.update(np.ascontiguousarray(directions,dtype='<f8').tobytes())
+        h.update(repr((int(n_filtration),float(ball_radius),str(ec_type),bool(include_faces))).encode())
+        return h.hexdigest()
+
+    def mesh_key(self, mesh_file = None, meshA = None):
+        """Hash of the content of the mesh file `mesh_file`, or of the arrays of the mesh `meshA` if provided"""
+        h = hashlib.blake2b(digest_size=20)
+        if meshA != None:
+            for array in mesh_arrays_to_write(meshA):
+                h.update(array.tobytes())
+        else:
+            with open(mesh_file,'rb') as f:
+                for block in iter(lambda: f.read(1<<20),b''):
+                    h.update(block)
+        return h.hexdigest()
+
+    def filename(self, mesh_key, parameter_key):
+        """Name of the file of a cache entry"""
+        return os.path.join(self.directory,'%s_%s.npy'%(mesh_key,parameter_key))
+
+    def get(self, mesh_key, parameter_key):
+        """Return the cached EC curves, or None if the entry is missing"""
+        filename = self.filename(mesh_key,parameter_key)
+        try:
+            ec = np.load(filename)
+        except (OSError, ValueError):
+            return None
+        os.utime(filename)
+        return ec
+
+    def put(self, mesh_key, parameter_key, ec):
+        """Store the EC curves `ec`"""
+        filename = self.filename(mesh_key,parameter_key)
+        temp_file = '%s.%d.tmp'%(filename,os.getpid())
+        with open(temp_file,'wb') as f:
+            np.save(f,ec)
+        os.replace(temp_file,filename)
+        return
+
+    def evict(self):
+        """Remove the least recently used entries until the total size is below `max_size`"""
+        if self.max_size == None:
+            return
+        entries = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.npy'):
+                stat = os.stat(os.path.join(self.directory,filename))
+                entries.append((stat.st_mtime,stat.st_size,filename))
+        entries.sort()
+        size = sum([entry[1] for entry in entries])
+        for mtime, entry_size, filename in entries:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory,filename))
+            except OSError:
+                pass
+            size -= entry_size
+        return
+
+def iterate_ec_curve_frames(mesh_frames, directions, n_filtration = 25, ball_radius = 1.0, ec_type = "ECT", include_faces = True, cache_dir = None, verbose = False):
+    """
+    Computes the Euler Characteristics (EC) curves in all directions for whole meshes one after another (see `compute_ec_curves_batched`), 
+    and yields the flattened EC curves of each mesh.
+
+    `mesh_frames` is the list of (mesh file, frame) pairs from `list_mesh_frames`.
+
+    If `cache_dir` is provided, EC curves are looked up in and added to the `ec_cache` in `cache_dir`, 
+    only the meshes missing from the cache are read and computed.
+    """
+    if cache_dir != None:
+        cache = ec_cache(cache_dir)
+        parameter_key = cache.parameter_key(directions,n_filtration,ball_radius,ec_type,include_faces)
+    ensembles = {}
+    for i, (mesh_file, frame) in enumerate(mesh_frames):
+        if verbose:
+            sys.stdout.write('Calculating EC for %s %s...\r'%(mesh_file,'' if frame == None else 'frame %d'%frame))
+            sys.stdout.flush()
+        meshProtein = None
+        if frame != None:
+            if mesh_file not in ensembles:
+                ensembles[mesh_file] = mesh_ensemble(mesh_file)
+            meshProtein = ensembles[mesh_file][frame]
+        if cache_dir != None:
+            mesh_key = cache.mesh_key(mesh_file,meshProtein)
+            ec = cache.get(mesh_key,parameter_key)
+            if ec is not None:
+                yield ec.ravel()
+                continue
+        if meshProtein == None:
+            meshProtein = mesh()
+            meshProtein.read_mesh_file(filename=mesh_file)
+        t, ec = compute_ec_curves_batched(meshProtein, directions, n_filtration = n_filtration, ball_radius = ball_radius, ec_type = ec_type, include_faces = include_faces)
+        if cache_dir != None:
+            cache.put(mesh_key,parameter_key,ec)
+        yield ec.ravel()
+    for ensemble in ensembles.values():
+        ensemble.close()
+    return
+
+def compute_ec_curve_frames(mesh_frames, directions, n_filtration = 25, ball_radius = 1.0, ec_type = "ECT", include_faces = True, out = None, row_start = 0, cache_dir = None, verbose = False):
+    """
+    Computes the Euler Characteristics (EC) curves in all directions for whole meshes one after another (see `iterate_ec_curve_frames`).
+
+    The flattened EC curves of the `i`-th mesh are written to row `row_start` + `i` of the sample x feature matrix `out`, 
+    which is either an array or the name of a .npy file, opened as a memory map so that worker processes write their rows directly into the shared file. 
+    If `out` is not provided, the matrix of EC curves of `mesh_frames` is allocated and returned.
+    """
+    n_feature = len(directions)*n_filtration
+    if out is None:
+        out = np.zeros((len(mesh_frames),n_feature),dtype=float)
+        row_start = 0
+    elif isinstance(out,str):
+        out = np.load(out,mmap_mode='r+')
+    for i, ec in enumerate(iterate_ec_curve_frames(mesh_frames,directions,n_filtration,ball_radius,ec_type,include_faces,cache_dir=cache_dir,verbose=verbose)):
+        out[row_start+i] = ec
+    if isinstance(out,np.memmap):
+        out.flush()
+    return out
+
+def compute_ec_curve_frames_sparse(mesh_frames, directions, n_filtration = 25, ball_radius = 1.0, ec_type = "ECT", include_faces = True, cache_dir = None, verbose = False):
+    """
+    Computes the Euler Characteristics (EC) curves in all directions for whole meshes one after another (see `iterate_ec_curve_frames`), 
+    and keeps only the non-zero entries of each mesh as it is computed. 
+
+    It returns the sample x feature matrix of the flattened EC curves as a CSR sparse matrix (`scipy.sparse.csr_matrix`), 
+    and the boolean mask of the features which are non-zero for at least one mesh, updated mesh by mesh.
+    """
+    from scipy.sparse import csr_matrix
+    n_feature = len(directions)*n_filtration
+    not_vacuum = np.zeros(n_feature,dtype=bool)
+    indptr = [0]
+    indices = []
+    data = []
+    for ec in iterate_ec_curve_frames(mesh_frames,directions,n_filtration,ball_radius,ec_type,include_faces,cache_dir=cache_dir,verbose=verbose):
+        index = np.flatnonzero(ec)
+        not_vacuum[index] = True
+        indices.append(index)
+        data.append(ec[index])
+        indptr.append(indptr[-1]+index.size)
+    if len(indices) > 0:
+        indices = np.concatenate(indices)
+        data = np.concatenate(data)
+    ecs = csr_matrix((np.asarray(data,dtype=float),np.asarray(indices,dtype=np.intp),np.asarray(indptr,dtype=np.intp)),shape=(len(mesh_frames),n_feature))
+    return ecs, not_vacuum
+
+def standardize_ec_features_sparse(ecs, not_vacuum = None):
+    """
+    Remove the vacuum columns of the sparse sample x feature matrix `ecs` (columns outside the mask `not_vacuum`, or with no non-zero entry if not provided), 
+    and scale the remaining columns to unit variance, without centering to keep the matrix sparse. Columns with zero variance are set to zero. 
+
+    The standardized features of `standardize_ec_features` are the columns of the returned matrix minus their mean, 
+    the Gaussian kernel (see `gp.CovarianceMatrix`) is the same for both, as centering does not change distances between observations.
+
+    It returns the scaled matrix in CSR format and the boolean mask of the non-vacuum columns.
+    """
+    from scipy.sparse import csr_matrix, diags
+    ecs = csr_matrix(ecs)
+    if not_vacuum is None:
+        not_vacuum = np.zeros(ecs.shape[1],dtype=bool)
+        not_vacuum[ecs.indices] = True
+    data = ecs[:,np.flatnonzero(not_vacuum)].tocsr()
+    n = data.shape[0]
+    mean = np.asarray(data.sum(axis=0)).ravel() / n
+    # sum of squared deviations from the mean over the non-zero entries, plus the zero entries which each deviate by the mean
+    n_nonzero = np.bincount(data.indices,minlength=data.shape[1])
+    deviation = np.bincount(data.indices,weights=(data.data-mean[data.indices])**2,minlength=data.shape[1])
+    std = np.sqrt((deviation + (n-n_nonzero)*mean**2) / n)
+    scale = np.zeros_like(std)
+    np.divide(1.,std,out=scale,where=(std > 0))
+    data = (data @ diags(scale)).tocsr()
+    data.eliminate_zeros()
+    return data, not_vacuum
+
+def standardize_ec_features(ecs):
+    """
+    Remove the columns of the sample x feature matrix `ecs` which are zero for all samples (vacuum), and standardize the remaining columns 
+    to zero mean and unit variance, with column reductions over the whole matrix. Columns with zero variance are set to zero. 
+
+    It returns the standardized matrix and the boolean mask of the non-vacuum columns.
+    """
+    not_vacuum = np.any(ecs != 0,axis=0)
+    data = np.array(ecs[:,not_vacuum],dtype=float)
+    mean = np.mean(data,axis=0)
+    std = np.std(data,axis=0)
+    data -= mean
+    np.divide(data,std,out=data,where=(std > 0))
+    data[:,std == 0] = 0
+    return data, not_vacuum
+
+def compute_ec_curve_folder(protA = "protA", protB = "protB", directions = None, n_sample = 101, ec_type = "ECT", n_filtration = 25, ball_radius = 1.0, include_faces = True, directory_mesh_A = None, directory_mesh_B = None, sm_radius = 4.0, hemisphere=False, parallel = False, n_core = -1, temp_dir = None, cache_dir = None, cache_size = None, sparse = False, verbose = False):
     """
     Computes the Euler Characteristics (EC) curves for a set of directions for the data set. 
     
@@ -87,8 +522,9 @@ def compute_ec_curve_folder(protA = "protA", protB = "protB", directions = None,
     DECT (differential ECT) is the default method used for protein. 
     ECT is the standard ECT and SECT is the smoothe ECT.
 
-    `directory_mesh_A` and `directory_mesh_B` are the folders that contain the .msh files for meshes for class A and B respectively. 
+    `directory_mesh_A` and `directory_mesh_B` are the folders that contain the .msh (or binary .bmsh) files for meshes for class A and B respectively. 
     If `directory_mesh_A` and `directory_mesh_B` are provided, the function calculates EC curves of all meshes in the two folders.
+    They can also be mesh ensemble (.emsh) files (see `mesh_ensemble`), then EC curves of all frames in the two files are calculated.
     
     `directions` is the list of vectors containing all directions for EC curves to be calculated on.
         
@@ -98,8 +534,20 @@ def compute_ec_curve_folder(protA = "protA", protB = "protB", directions = None,
 
     If `included_faces` is set to False, it ignore faces from the EC calculations.
 
-    If `parallel` is set to True, the program runs on multiple cores for EC calculations, 
+    The EC curves of each mesh are written straight into a preallocated sample x feature matrix (see `compute_ec_curve_frames`), 
+    then the vacuum columns are removed and the features are standardized (see `standardize_ec_features`).
+
+    If `parallel` is set to True, the meshes of both classes are split into contiguous chunks of whole meshes, one per core, 
     then `n_core` will be the number of cores used (the program uses all detected cores if `n_core` is not provided`).
+    The workers write their rows into a memory-mapped matrix in a temporary directory under `temp_dir` (system default if not provided), which is removed afterwards.
+
+    If `cache_dir` is provided, the EC curves of each mesh are cached in `cache_dir` across runs (see `ec_cache`), 
+    so only meshes or parameters not seen before are computed. 
+    The least recently used entries are removed after the calculation to keep the cache below `cache_size` bytes (no limit if None).
+
+    If `sparse` is set to True, only the non-zero entries of the EC curves are kept as the meshes are computed (see `compute_ec_curve_frames_sparse`), 
+    and the returned data is a CSR sparse matrix with the features scaled to unit variance but not centered (see `standardize_ec_features_sparse`), 
+    which `calc_rate` accepts in place of the dense standardized matrix. 
 
     If `verbose` is set to True, the program prints progress in command prompt. 
     """
@@ -114,70 +562,59 @@ def compute_ec_curve_folder(protA = "protA", protB = "protB", directions = None,
             os.mkdir(directory_mesh_A)
         if not os.path.exists(directory_mesh_B):
             os.mkdir(directory_mesh_B)
-
-        ecss = []
-        for prot, directory_mesh in zip([protA,protB],[directory_mesh_A,directory_mesh_B]):
-            ecs = []
-            for i_sample in range(n_sample):
-                if verbose:
-                    sys.stdout.write('Calculating EC for %s Frame %d...\r'%(prot,i_sample))
-                    sys.stdout.flush()
-                meshProtein = mesh()
-                meshProtein.read_mesh_file(filename='%s/%s_frame%d.msh'%(directory_mesh,prot,i_sample))
-                if parallel:
-                    t, ec = compute_ec_curve_parallel(meshProtein, directions, n_filtration = n_filtration, ball_radius = ball_radius,ec_type = ec_type, include_faces = include_faces, n_core = n_core)
-                else:
-                    t, ec = compute_ec_curve(meshProtein, directions, n_filtration = n_filtration, ball_radius = ball_radius,ec_type = ec_type, include_faces = include_faces)
-                ecs.append(ec.flatten())
-            ecs = np.array(ecs)
-            ecss.append(ecs)
-
+        mesh_frames_A = list_mesh_frames(directory_mesh_A,prot=protA,n_sample=n_sample)
+        mesh_frames_B = list_mesh_frames(directory_mesh_B,prot=protB,n_sample=n_sample)
     else:
-        directory = '.'
-        ecss = []
-        for prot, directory_mesh in zip([protA,protB],[directory_mesh_A,directory_mesh_B]):
-            ecs = []
-            for filename in os.listdir(directory_mesh):
-                if filename.endswith(".msh"):
-                    if verbose:
-                        sys.stdout.write('Calculating EC for %s %s...\r'%(prot,filename))
-                        sys.stdout.flush()
-                    meshProtein = mesh()
-                    meshProtein.read_mesh_file(filename=directory_mesh + '/' + filename)
-                    if parallel:
-                        t, ec = compute_ec_curve_parallel(meshProtein, directions, n_filtration = n_filtration, ball_radius = ball_radius,ec_type = ec_type, include_faces = include_faces, n_core = n_core)
-                    else:
-                        t, ec = compute_ec_curve(meshProtein, directions, n_filtration = n_filtration, ball_radius = ball_radius,ec_type = ec_type, include_faces = include_faces) 
-                    ecs.append(ec.flatten())
-            ecs = np.array(ecs)
-            ecss.append(ecs)
-            
-    data_A = ecss[0]
-    data_B = ecss[1]
-    
-    vacuum = np.ones(data_A.shape[1],dtype=bool)
-    for a in data_A:
-        vacuum = np.logical_and(vacuum,a == 0)
-    for a in data_B:
-        vacuum = np.logical_and(vacuum,a == 0)
+        mesh_frames_A = list_mesh_frames(directory_mesh_A)
+        mesh_frames_B = list_mesh_frames(directory_mesh_B)
 
-    not_vacuum = np.logical_not(vacuum)
-    data = np.vstack((data_A,data_B))[:,not_vacuum]
+    mesh_frames = mesh_frames_A + mesh_frames_B
+    n_A = len(mesh_frames_A)
+    n_B = len(mesh_frames_B)
+    n_feature = len(directions)*n_filtration
+    parameter = (n_filtration,ball_radius,ec_type,include_faces)
 
-    mean = np.average(data,axis=0)
-    std = np.std(data,axis=0)
-
-    data = np.subtract(data,mean)
-    data = np.divide(data,std)
-    data[np.isnan(data)] = 0
+    if sparse:
+        from scipy.sparse import vstack
+        if parallel:
+            if n_core == -1:    
+                n_core = multiprocessing.cpu_count()
+            bounds = np.linspace(0,n_A+n_B,min(n_core,n_A+n_B)+1).astype(int)
+            processed_list = Parallel(n_jobs=n_core)(delayed(compute_ec_curve_frames_sparse)(mesh_frames[bounds[i]:bounds[i+1]],directions,*parameter,cache_dir) for i in range(bounds.size-1))
+        else:
+            processed_list = [compute_ec_curve_frames_sparse(mesh_frames,directions,*parameter,cache_dir=cache_dir,verbose=verbose)]
+        not_vacuum = np.any([mask for ecs, mask in processed_list],axis=0)
+        ecs = vstack([ecs for ecs, mask in processed_list],format='csr')
+        data, not_vacuum = standardize_ec_features_sparse(ecs,not_vacuum)
+        del ecs
+    elif parallel:
+        if n_core == -1:    
+            n_core = multiprocessing.cpu_count()
+        directory = tempfile.mkdtemp(prefix='sinatra_ec_',dir=temp_dir)
+        try:
+            ec_file = os.path.join(directory,'ec.npy')
+            ecs = np.lib.format.open_memmap(ec_file,mode='w+',dtype=float,shape=(n_A+n_B,n_feature))
+            del ecs
+            bounds = np.linspace(0,n_A+n_B,min(n_core,n_A+n_B)+1).astype(int)
+            if verbose:
+                sys.stdout.write('Calculating EC for %d meshes in %d chunks...\n'%(n_A+n_B,bounds.size-1))
+            Parallel(n_jobs=n_core)(delayed(compute_ec_curve_frames)(mesh_frames[bounds[i]:bounds[i+1]],directions,*parameter,ec_file,bounds[i],cache_dir) for i in range(bounds.size-1))
+            ecs = np.load(ec_file,mmap_mode='r')
+            data, not_vacuum = standardize_ec_features(ecs)
+            del ecs
+        finally:
+            shutil.rmtree(directory,ignore_errors=True)
+    else:
+        ecs = np.zeros((n_A+n_B,n_feature),dtype=float)
+        compute_ec_curve_frames(mesh_frames,directions,*parameter,out=ecs,cache_dir=cache_dir,verbose=verbose)
+        data, not_vacuum = standardize_ec_features(ecs)
+        del ecs
          
-    n_A = data_A.shape[0]
-    n_B = data_B.shape[0]
+    if cache_dir != None:
+        ec_cache(cache_dir,max_size=cache_size).evict()
+
     label = np.zeros(n_A+n_B,dtype=int)
     label[:n_A].fill(0)
     label[n_A:].fill(1)
 
     return data, label, not_vacuum
-
-
-
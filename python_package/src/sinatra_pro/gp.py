@@ -3,14 +3,86 @@
 import sys
 import numpy as np
 from scipy.stats import norm
+from scipy.sparse import issparse
 from sinatra_pro.RATE import *
 
-def CovarianceMatrix(x,bandwidth=0.01):
+def CovarianceMatrix(x,bandwidth=0.01,block_size=None,single_precision=False,n_core=1):
     """
     Computes the covariance matrix given by the Gaussian kernel.
     
     `X` is the design matrix where columns are observations.
 
+    `bandwidth` is the free parameter for the Gaussian kernel.
+
+    The squared distances between observations are computed with matrix products by ||a-b||^2 = ||a||^2 + ||b||^2 - 2 a.b, 
+    after centering the features (which does not change the distances) to reduce round-off errors.
+
+    `block_size` is the number of observations per block, such that the kernel is computed block by block 
+    with temporary memory about `block_size` x `block_size`, default: whole matrix in one block.
+
+    If `single_precision` is set to True, the distances are computed in single precision (float32), 
+    which is faster and uses half of the memory for the design matrix, with relative error of the order 1e-7 x `bandwidth` parameter.
+
+    `n_core` is the number of threads to compute blocks in parallel (-1 to use all detected cores).
+
+    `x` can also be a scipy sparse matrix (e.g. from `compute_ec_curve_folder` with `sparse` set to True), 
+    then the features are not centered and the products are computed on the non-zero entries only.
+    """
+    bandwidth = 1./(2*bandwidth**2)
+    p, n = x.shape
+    if single_precision:
+        dtype = np.float32
+    else:
+        dtype = np.float64
+    if issparse(x):
+        x = x.T.tocsr().astype(dtype)
+        sq_norm = np.asarray(x.multiply(x).sum(axis=1)).ravel()
+    else:
+        x = np.asarray(x,dtype=dtype).T
+        x = x - np.mean(x,axis=0)
+        sq_norm = np.einsum('ij,ij->i',x,x)
+    if block_size == None:
+        block_size = n
+    block_size = max(int(block_size),1)
+    K = np.zeros((n,n),dtype=float)
+
+    def compute_block(i_start,j_start):
+        i_end = min(i_start+block_size,n)
+        j_end = min(j_start+block_size,n)
+        sq_dist = x[i_start:i_end] @ x[j_start:j_end].T
+        if issparse(sq_dist):
+            sq_dist = sq_dist.toarray()
+        sq_dist *= -2
+        sq_dist += sq_norm[i_start:i_end,None]
+        sq_dist += sq_norm[None,j_start:j_end]
+        np.maximum(sq_dist,0,out=sq_dist)
+        K[i_start:i_end,j_start:j_end] = np.exp(sq_dist*(-bandwidth/p))
+        if i_start != j_start:
+            K[j_start:j_end,i_start:i_end] = K[i_start:i_end,j_start:j_end].T
+        else: # keep the diagonal block exactly symmetric
+            block = K[i_start:i_end,i_start:i_end]
+            block[np.tril_indices(i_end-i_start,-1)] = block.T[np.tril_indices(i_end-i_start,-1)]
+        return
+
+    blocks = [(i_start,j_start) for i_start in range(0,n,block_size) for j_start in range(i_start,n,block_size)]
+    if n_core == 1 or len(blocks) == 1:
+        for i_start, j_start in blocks:
+            compute_block(i_start,j_start)
+    else:
+        import multiprocessing
+        from joblib import Parallel, delayed
+        if n_core == -1:
+            n_core = multiprocessing.cpu_count()
+        Parallel(n_jobs=n_core,prefer='threads')(delayed(compute_block)(i_start,j_start) for i_start, j_start in blocks)
+    np.fill_diagonal(K,1)
+    return K
+
+def CovarianceMatrix_old(x,bandwidth=0.01):
+    """
+    Computes the covariance matrix given by the Gaussian kernel, with loops over all pairs of observations (original implementation, kept for benchmarking).
+    
+    `X` is the design matrix where columns are observations.
+
     `bandwidth` is the free parameter for the Gaussian kernel.
     """
     bandwidth = 1./(2*bandwidth**2)
@@ -31,7 +103,158 @@ def logistic_log_likelihood(latent_variables, class_labels):
     """Logistic link function"""
     return(-np.sum(np.log(1.0+np.exp(latent_variables*class_labels))))
 
-def Elliptical_Slice_Sampling(K,y,n_mcmc=100000,burn_in=1000,probit=True,seed=None,verbose=False):
+def cholesky_factor(K,jitter=1e-10,max_tries=8):
+    """
+    Computes a factor L of the covariance matrix K such that K = L L^T, used to draw samples from the Gaussian prior N(0,K).
+
+    It first tries the Cholesky decomposition of K. If K is not numerically positive definite, 
+    a jitter of `jitter` x mean(diag(K)) is added to the diagonal and increased tenfold for up to `max_tries` attempts. 
+    If all attempts fail, the factor is computed from the eigendecomposition of K, with negative eigenvalues set to zero.
+    """
+    scale = np.mean(np.diag(K))
+    for i in range(max_tries+1):
+        try:
+            if i == 0:
+                return np.linalg.cholesky(K)
+            else:
+                return np.linalg.cholesky(K + np.eye(K.shape[0])*jitter*scale*10**(i-1))
+        except np.linalg.LinAlgError:
+            continue
+    s, u = np.linalg.eigh(K)
+    return u * np.sqrt(np.maximum(s,0))
+
+def count_kept_steps(step_start,step_end,burn_in=0,thin=1):
+    """Number of steps i in [`step_start`,`step_end`) kept as MCMC samples, i.e. i >= `burn_in` and (i - `burn_in`) divisible by `thin`"""
+    if step_end <= burn_in:
+        return 0
+    k_start = max(0,-(-(step_start-burn_in)//thin))
+    k_end = -(-(step_end-burn_in)//thin)
+    return max(0,k_end-k_start)
+
+def ess_chain(f,y,L,step_start,step_end,burn_in=0,thin=1,probit=True,rng=np.random,block_size=1000,online=False,verbose=False):
+    """
+    Runs the steps `step_start` to `step_end`-1 of an elliptical slice sampling chain, where `f` is the state of the chain after step `step_start`-1. 
+    Step 0 is the initial state `f` itself, so a chain starts from `step_start` = 0.
+
+    `rng` is the random number generator, either `np.random` or a `np.random.Generator`.
+
+    The function returns the state after the last step, the random number generator, the kept samples (None if `online` is set to True), 
+    the `posterior_moments` of the kept samples (None if `online` is set to False), 
+    and the list of (number of samples, mean, sum of squared deviations from the mean) of each batch of `block_size` kept samples for convergence diagnostics.
+
+    See `Elliptical_Slice_Sampling` for the other arguments.
+    """
+    if probit:
+        log_lik = probit_log_likelihood
+    else:
+        log_lik = logistic_log_likelihood
+    n = L.shape[0]
+    N = y.size
+    n_keep = count_kept_steps(step_start,step_end,burn_in,thin)
+    moments = None
+    if online:
+        moments = posterior_moments(N)
+        samples = np.zeros((max(min(block_size,n_keep),1),N),dtype=float)
+    else:
+        samples = np.zeros((n_keep,N),dtype=float)
+    batches = []
+    i_sample = 0
+    i_batch = 0
+    for i_start in range(step_start,step_end,block_size):
+        i_end = min(i_start+block_size,step_end)
+        norm_samples = rng.standard_normal(size=(i_end-i_start,n)) @ L.T
+        unif_samples = rng.uniform(low = 0, high = 1, size = i_end-i_start)
+        thetas = rng.uniform(low = 0, high = 2*np.pi, size = i_end-i_start)
+        for i in range(i_start,i_end):
+            if i > 0:
+                if verbose:
+                    if i < burn_in:
+                        sys.stdout.write('Burning in...\r')
+                    else:
+                        sys.stdout.write('Elliptical slice sampling Step %d...\r'%(i-burn_in+1))
+                    sys.stdout.flush()
+                nu = norm_samples[i-i_start,:]
+                theta = thetas[i-i_start]
+                theta_min = theta - 2*np.pi
+                theta_max = theta + 2*np.pi
+                llh_thresh = log_lik(f,y) + np.log(unif_samples[i-i_start])
+                f_star = f * np.cos(theta) + nu * np.sin(theta)
+                while(log_lik(f_star,y) < llh_thresh):
+                    if theta < 0:
+                        theta_min = theta
+                    else:
+                        theta_max = theta
+                    theta = rng.uniform(low = theta_min,high = theta_max)
+                    f_star = f * np.cos(theta) + nu * np.sin(theta)
+                f = f_star
+            if i >= burn_in and (i-burn_in) % thin == 0:
+                samples[i_sample,:] = f
+                i_sample += 1
+                if i_sample - i_batch == block_size or i_sample == samples.shape[0]:
+                    batch = samples[i_batch:i_sample]
+                    batch_mean = np.mean(batch,axis=0)
+                    batches.append((batch.shape[0],batch_mean,np.sum((batch-batch_mean)**2,axis=0)))
+                    if online:
+                        moments.update(batch)
+                        i_sample = 0
+                    i_batch = i_sample
+    if online:
+        batch = samples[i_batch:i_sample]
+        if batch.shape[0] > 0:
+            batch_mean = np.mean(batch,axis=0)
+            batches.append((batch.shape[0],batch_mean,np.sum((batch-batch_mean)**2,axis=0)))
+            moments.update(batch)
+        samples = None
+    return f, rng, samples, moments, batches
+
+def convergence_diagnostics(chain_batches):
+    """
+    Computes the split potential scale reduction factor (R-hat) and the effective sample size of each latent variable from multiple MCMC chains.
+
+    `chain_batches` is the list of batches of each chain from `ess_chain`, i.e. (number of samples, mean, sum of squared deviations from the mean) of each batch. 
+
+    R-hat is computed with each chain split into two halves (Gelman et al. 2013). 
+    The effective sample size is estimated from the variance of the batch means of each chain (batch means method, Flegal and Jones 2010), 
+    using complete batches only, and summed over all chains.
+    """
+    def combine(batches):
+        count = np.sum([b[0] for b in batches])
+        mean = np.sum([b[0]*b[1] for b in batches],axis=0)/count
+        m2 = np.sum([b[2] + b[0]*(b[1]-mean)**2 for b in batches],axis=0)
+        return count, mean, m2
+
+    half_means = []
+    half_vars = []
+    half_counts = []
+    ess = 0
+    for batches in chain_batches:
+        if len(batches) < 2:
+            return np.full(batches[0][1].size,np.nan), np.full(batches[0][1].size,np.nan)
+        for half in [batches[:len(batches)//2],batches[len(batches)//2:]]:
+            count, mean, m2 = combine(half)
+            half_counts.append(count)
+            half_means.append(mean)
+            half_vars.append(m2/max(count-1,1))
+        count, mean, m2 = combine(batches)
+        variance = m2/max(count-1,1)
+        size = batches[0][0]
+        full = [b for b in batches if b[0] == size]
+        if len(full) >= 2:
+            var_batch = np.var([b[1] for b in full],axis=0,ddof=1)
+            with np.errstate(divide='ignore',invalid='ignore'):
+                ess_one = np.where(var_batch > 0,count*variance/(size*var_batch),count)
+            ess = ess + np.minimum(ess_one,count)
+        else:
+            ess = ess + np.full(mean.size,np.nan)
+    n = np.mean(half_counts)
+    W = np.mean(half_vars,axis=0)
+    B = np.var(half_means,axis=0,ddof=1)
+    var_plus = (n-1)/n*W + B
+    with np.errstate(divide='ignore',invalid='ignore'):
+        rhat = np.where(W > 0,np.sqrt(var_plus/W),1.)
+    return rhat, ess
+
+def Elliptical_Slice_Sampling(K,y,n_mcmc=100000,burn_in=1000,probit=True,seed=None,verbose=False,L=None,block_size=1000,online=False,thin=1,n_chain=1,n_core=-1,rhat_threshold=None,ess_threshold=None,check_interval=10000,return_diagnostics=False):
     """
     Elliptical slice sampling algorithm adopted from FastGP::ess from FastGP R package. 
     The function returns the desired number of MCMC samples. 
@@ -49,51 +272,98 @@ def Elliptical_Slice_Sampling(K,y,n_mcmc=100000,burn_in=1000,probit=True,seed=No
     If `seed` is provided, it will be set as the seed for the random number generator (for testing purpose).
 
     If `verbose` is set to True, the program prints progress on command prompt.
+
+    `L` is a factor of `K` such that K = L L^T (e.g. from `cholesky_factor`), computed from `K` if not provided. 
+
+    Draws from the Gaussian prior are generated from `L` in blocks of `block_size` steps, 
+    such that only `block_size` prior draws are kept in memory at a time. Burn in steps are not stored.
+
+    `thin` is the thinning interval, only every `thin`-th sample after burn in is kept, giving n_mcmc / `thin` samples. 
+
+    If `online` is set to True, the samples are not stored. Instead, the function returns a `posterior_moments` 
+    with the running mean and covariance of the samples, updated once every `block_size` steps.
+
+    `n_chain` is the number of independent chains, run in parallel on `n_core` processes (all detected cores if `n_core` is -1). 
+    Each chain has its own burn in and draws n_mcmc / `n_chain` steps after burn in, with independent random number streams spawned from `seed` by `np.random.SeedSequence`. 
+    The samples of all chains are concatenated (or their moments merged if `online` is set to True).
+
+    If `rhat_threshold` or `ess_threshold` is provided, the chains are checked for convergence every `check_interval` steps after burn in, 
+    and stop early once the largest R-hat is below `rhat_threshold` and the smallest effective sample size reaches `ess_threshold`.
+
+    If `return_diagnostics` is set to True, the function also returns a dictionary of convergence diagnostics 
+    with R-hat ('rhat') and effective sample size ('ess') of each latent variable, and the number of samples ('n_sample'), see `convergence_diagnostics`.
     """
 
     if verbose:
         print("Running elliptical slice sampling...")
-    if probit:
-        log_lik = probit_log_likelihood
-    else:
-        log_lik = logistic_log_likelihood
-    n = K.shape[0]
     N = y.size
-    if isinstance(seed, int):
-        np.random.seed(seed)
-    mcmc_samples = np.zeros((burn_in+n_mcmc,N),dtype=float)
-    norm_samples = np.random.multivariate_normal(mean = np.zeros(n), cov = K, size = burn_in+n_mcmc)
-    unif_samples = np.random.uniform(low = 0, high = 1, size = burn_in+n_mcmc)
-    theta = np.random.uniform(low = 0, high = 2*np.pi, size = burn_in+n_mcmc)
-    theta_min = theta - 2*np.pi
-    theta_max = theta + 2*np.pi
-    for i in range(1,burn_in+n_mcmc):
+    if L is None:
+        L = cholesky_factor(K)
+
+    if n_chain == 1 and rhat_threshold == None and ess_threshold == None:
+        if isinstance(seed, int):
+            np.random.seed(seed)
+        f, rng, samples, moments, batches = ess_chain(np.zeros(N,dtype=float),y,L,0,burn_in+n_mcmc,burn_in=burn_in,thin=thin,probit=probit,rng=np.random,block_size=block_size,online=online,verbose=verbose)
+        chains = [(samples,moments,batches)]
         if verbose:
-            if i < burn_in:
-                sys.stdout.write('Burning in...\r')
-            else:
-                sys.stdout.write('Elliptical slice sampling Step %d...\r'%(i-burn_in+1))
-            sys.stdout.flush()
-        f = mcmc_samples[i-1,:]
-        llh_thresh = log_lik(f,y) + np.log(unif_samples[i])
-        f_star = f * np.cos(theta[i]) + norm_samples[i,:] * np.sin(theta[i])
-        while(log_lik(f_star,y) < llh_thresh):
-            if theta[i] < 0:
-                theta_min[i] = theta[i]
-            else:
-                theta_max[i] = theta[i]
-            theta[i] = np.random.uniform(low = theta_min[i],high = theta_max[i], size = 1)
-            f_star = f * np.cos(theta[i]) + norm_samples[i,:] * np.sin(theta[i])
-        mcmc_samples[i,:] = f_star
-    if verbose:
-        sys.stdout.write('\n')
-    return mcmc_samples[burn_in:,:]
+            sys.stdout.write('\n')
+    else:
+        import multiprocessing
+        from joblib import Parallel, delayed
+        if n_core == -1:
+            n_core = multiprocessing.cpu_count()
+        rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(n_chain)]
+        states = [np.zeros(N,dtype=float) for i in range(n_chain)]
+        chains = [([],posterior_moments(N) if online else None,[]) for i in range(n_chain)]
+        n_step = burn_in + -(-n_mcmc//n_chain)
+        if rhat_threshold == None and ess_threshold == None:
+            check_interval = n_step
+        else:
+            check_interval = max(-(-check_interval//(block_size*thin)),1)*block_size*thin # whole batches per check
+        step_start = 0
+        with Parallel(n_jobs=min(n_core,n_chain)) as parallel:
+            while step_start < n_step:
+                if step_start == 0:
+                    step_end = min(burn_in+check_interval,n_step)
+                else:
+                    step_end = min(step_start+check_interval,n_step)
+                results = parallel(delayed(ess_chain)(states[c],y,L,step_start,step_end,burn_in=burn_in,thin=thin,probit=probit,rng=rngs[c],block_size=block_size,online=online) for c in range(n_chain))
+                for c, (f, rng, samples, moments, batches) in enumerate(results):
+                    states[c] = f
+                    rngs[c] = rng
+                    if online:
+                        chains[c][1].merge(moments)
+                    else:
+                        chains[c][0].append(samples)
+                    chains[c][2].extend(batches)
+                step_start = step_end
+                if (rhat_threshold != None or ess_threshold != None) and step_start < n_step:
+                    rhat, ess = convergence_diagnostics([chain[2] for chain in chains])
+                    if verbose:
+                        sys.stdout.write('Elliptical slice sampling Step %d of %d chains, max R-hat = %.4f, min ESS = %.1f\n'%(step_start-burn_in,n_chain,np.nanmax(rhat),np.nanmin(ess)))
+                    if (rhat_threshold == None or np.nanmax(rhat) < rhat_threshold) and (ess_threshold == None or np.nanmin(ess) >= ess_threshold):
+                        if verbose:
+                            sys.stdout.write('Chains converged, stopping early.\n')
+                        break
+        chains = [(None if online else np.vstack(samples),moments,batches) for samples, moments, batches in chains]
 
-def calc_rate(X,y,bandwidth=0.01,sampling_method='ESS',n_mcmc=100000,burn_in=1000,probit=True,seed=None,prop_var=1,low_rank=False,parallel=False,n_core=-1,verbose=False):
+    if online:
+        output = chains[0][1]
+        for samples, moments, batches in chains[1:]:
+            output.merge(moments)
+    else:
+        output = np.vstack([samples for samples, moments, batches in chains])
+    if return_diagnostics:
+        rhat, ess = convergence_diagnostics([batches for samples, moments, batches in chains])
+        diagnostics = {'rhat':rhat,'ess':ess,'n_sample':int(np.sum([b[0] for samples, moments, batches in chains for b in batches]))}
+        return output, diagnostics
+    return output
+
+def calc_rate(X,y,bandwidth=0.01,sampling_method='ESS',n_mcmc=100000,burn_in=1000,probit=True,seed=None,prop_var=1,low_rank=False,parallel=False,n_core=-1,verbose=False,online=False,thin=1,n_chain=1,rhat_threshold=None,ess_threshold=None,svd_rank=None):
     """
     Calculate RelATive cEntrality (RATE) centrality measures from data.
     
-    `X` is the design matrix where columns are observations.
+    `X` is the design matrix where columns are observations, or a scipy sparse matrix of scaled features (see `compute_ec_curve_folder`).
 
     `y` is the list of the class labels for each data points, 0 or 1. 
 
@@ -117,14 +387,27 @@ def calc_rate(X,y,bandwidth=0.01,sampling_method='ESS',n_mcmc=100000,burn_in=100
     then `n_core` will be the number of cores used (the program uses all detected cores if `n_core` is not provided).
 
     If `verbose` is set to True, the program prints progress on command prompt.
+
+    If `online` is set to True, only the running mean and covariance of the MCMC samples are kept instead of all samples (see `Elliptical_Slice_Sampling`),
+    and `thin` is the thinning interval of the MCMC samples.
+
+    `n_chain` is the number of independent MCMC chains, run on `n_core` processes if `parallel` is set to True, 
+    and `rhat_threshold` and `ess_threshold` are the convergence criteria for stopping the chains early (see `Elliptical_Slice_Sampling`).
+
+    If `svd_rank` is provided, RATE uses a randomized truncated SVD of rank `svd_rank` of the design matrix (see `RATE`).
    
     """
     n = X.shape[0]
     f = np.zeros(n)
     if verbose:
         sys.stdout.write('Calculating Covariance Matrix...\n')
-    Kn = CovarianceMatrix(X.T,bandwidth)
-    samples = Elliptical_Slice_Sampling(Kn,y,n_mcmc=n_mcmc,burn_in=burn_in,probit=probit,seed=seed,verbose=verbose)
-    kld, rates, delta, eff_samp_size = RATE(X=X,f_draws=samples,prop_var=prop_var,low_rank=low_rank,parallel=parallel,n_core=n_core,verbose=verbose)
+    if parallel:
+        Kn = CovarianceMatrix(X.T,bandwidth,block_size=1024,n_core=n_core)
+    else:
+        Kn = CovarianceMatrix(X.T,bandwidth)
+    samples, diagnostics = Elliptical_Slice_Sampling(Kn,y,n_mcmc=n_mcmc,burn_in=burn_in,probit=probit,seed=seed,verbose=verbose,online=online,thin=thin,n_chain=n_chain,n_core=n_core if parallel else 1,rhat_threshold=rhat_threshold,ess_threshold=ess_threshold,return_diagnostics=True)
+    if verbose:
+        sys.stdout.write('MCMC diagnostics: %d samples, max R-hat = %.4f, min effective sample size = %.1f\n'%(diagnostics['n_sample'],np.nanmax(diagnostics['rhat']),np.nanmin(diagnostics['ess'])))
+    kld, rates, delta, eff_samp_size = RATE(X=X,f_draws=samples,prop_var=prop_var,low_rank=low_rank,parallel=parallel,n_core=n_core,verbose=verbose,svd_rank=svd_rank)
     return kld, rates, delta, eff_samp_size
  
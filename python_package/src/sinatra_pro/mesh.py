@@ -1,5 +1,6 @@
 #!/bin/python3
 
+import os, sys
 import numpy as np
 from scipy.spatial import distance
 import MDAnalysis
@@ -7,6 +8,17 @@ from MDAnalysis.lib.nsgrid import FastNS, NSResults
 import multiprocessing
 from joblib import Parallel, delayed
 
+BINARY_MESH_MAGIC = b'SINMSH01'
+"""Magic bytes at the start of binary mesh (.bmsh) files"""
+BINARY_MESH_HEADER = 32
+"""Size of header of binary mesh files in bytes: magic bytes followed by number of vertices, edges and faces as 64-bit integers"""
+ENSEMBLE_MESH_MAGIC = b'SINENS01'
+"""Magic bytes at the start and the end of mesh ensemble (.emsh) files"""
+ENSEMBLE_MESH_HEADER = 16
+"""Size of header of mesh ensemble files in bytes: magic bytes followed by 8 reserved bytes"""
+ENSEMBLE_MESH_TRAILER = 24
+"""Size of trailer of mesh ensemble files in bytes: offset of the frame index and number of frames as 64-bit integers, followed by magic bytes"""
+
 class mesh:
     
     def __init__(self):
@@ -93,10 +105,61 @@ class mesh:
         self.edges = result.get_pairs()
         return 
    
-    def edge_to_face_list(self):
+    def edge_to_face_list(self, chunk_size = 1000000):
         """
         Convert edge list to face list
 
+        Look for any 3 edges that enclose a triangle, and construct such enclosed triangles as faces.
+        
+        The edges are stored as a compressed sparse row (CSR) adjacency, where each vertex keeps its sorted list of neighbors with larger indices. 
+        For each edge (u,v) with u < v, every neighbor s > v of v is a candidate, and it encloses a triangle if (u,s) is also an edge, 
+        which is checked by binary search over the sorted edge keys. 
+        Faces are listed as [u,v,s] with u < v < s in lexicographical order. 
+
+        `chunk_size` is the maximum number of candidate triangles checked at once, which bounds the peak memory usage.
+        """
+        self.n_vertices = self.vertices.shape[0]
+        n = self.n_vertices
+        edges = np.sort(np.asarray(self.edges,dtype=np.int64).reshape(-1,2),axis=1)
+        edges = edges[edges[:,0] != edges[:,1]]
+        keys = np.unique(edges[:,0]*n + edges[:,1]) # sorted by (u,v), duplicated edges removed
+        heads = keys // n
+        tails = keys % n
+        # CSR adjacency, neighbors with larger indices only
+        indptr = np.zeros(n+1,dtype=np.int64)
+        np.cumsum(np.bincount(heads,minlength=n),out=indptr[1:])
+        # number of candidates s for each edge (u,v) = number of neighbors of v larger than v 
+        n_candidate = indptr[tails+1] - indptr[tails]
+        cum_candidate = np.cumsum(n_candidate)
+        faces = []
+        i_start = 0
+        while i_start < keys.size:
+            i_end = max(np.searchsorted(cum_candidate,cum_candidate[i_start]-n_candidate[i_start]+chunk_size,side='right'),i_start+1)
+            u = heads[i_start:i_end]
+            v = tails[i_start:i_end]
+            count = n_candidate[i_start:i_end]
+            total = np.sum(count)
+            if total > 0:
+                # expand neighbors of v for every edge (u,v) in the chunk 
+                start = np.repeat(indptr[v] - np.cumsum(count) + count,count)
+                s = tails[start + np.arange(total)]
+                u = np.repeat(u,count)
+                v = np.repeat(v,count)
+                key = u*n + s
+                position = np.minimum(np.searchsorted(keys,key),keys.size-1)
+                found = keys[position] == key
+                faces.append(np.column_stack((u[found],v[found],s[found])))
+            i_start = i_end
+        if len(faces) > 0:
+            self.faces = np.concatenate(faces).astype(int)
+        else:
+            self.faces = np.zeros((0,3),dtype=int)
+        return
+
+    def edge_to_face_list_old(self):
+        """
+        Convert edge list to face list (original implementation with sets of neighbors, kept for benchmarking)
+
         Iterate through list of connected edges to look for any 3 edges that enclose a triangle. 
         Such enclosed triangles are constructed as faces.
         """
@@ -116,8 +179,16 @@ class mesh:
         self.faces = np.array(self.faces)
         return
      
-    def read_mesh_file(self,filename='output.mesh'):
-        """Read topology from .msh file"""
+    def read_mesh_file(self,filename='output.mesh',mmap=True):
+        """
+        Read topology from .msh file
+
+        Binary mesh files (see `write_mesh_file_binary`) are detected from the file header and read by `read_mesh_file_binary`, 
+        with memory mapping if `mmap` is set to True.
+        """
+        if is_binary_mesh_file(filename):
+            self.read_mesh_file_binary(filename=filename,mmap=mmap)
+            return
         n_line = 0
         i_v = 0
         i_e = 0
@@ -152,7 +223,14 @@ class mesh:
         return 
    
     def write_mesh_file(self,filename='output.mesh'):
-        """Write topology into .msh file"""
+        """
+        Write topology into .msh file
+        
+        If `filename` ends with .bmsh, the mesh is written in binary format by `write_mesh_file_binary` instead.
+        """
+        if filename.endswith('.bmsh'):
+            self.write_mesh_file_binary(filename=filename)
+            return
         with open(filename,'w') as f:
             f.write('%d %d %d\n'%(self.vertices.shape[0],self.edges.shape[0],self.faces.shape[0]))
             for vertex in self.vertices:
@@ -163,6 +241,41 @@ class mesh:
                 f.write('%d  %d %d %d  \n'%(len(face),face[0],face[1],face[2]))
         return
    
+    def read_mesh_file_binary(self,filename='output.bmsh',mmap=True):
+        """
+        Read topology from binary .bmsh file
+        
+        If `mmap` is set to True, vertices, edges and faces are memory-mapped views of the file without copying. 
+        The mapping is copy-on-write, so changes to the arrays (e.g. `normalize`) never modify the file.
+        """
+        with open(filename,'rb') as f:
+            header = f.read(BINARY_MESH_HEADER)
+        if header[:len(BINARY_MESH_MAGIC)] != BINARY_MESH_MAGIC:
+            raise ValueError("%s is not a binary mesh file"%filename)
+        self.n_vertex, self.n_edge, self.n_face = [int(a) for a in np.frombuffer(header,dtype='<i8',count=3,offset=len(BINARY_MESH_MAGIC))]
+        if mmap:
+            data = np.memmap(filename,dtype=np.uint8,mode='c')
+        else:
+            data = np.fromfile(filename,dtype=np.uint8)
+        self.vertices, self.edges, self.faces = mesh_arrays_from_buffer(data,BINARY_MESH_HEADER,self.n_vertex,self.n_edge,self.n_face)
+        return
+
+    def write_mesh_file_binary(self,filename='output.bmsh'):
+        """
+        Write topology into binary .bmsh file
+        
+        The file contains a 32-byte header (magic bytes, number of vertices, edges and faces), 
+        followed by the vertices as 64-bit floats, then the edges and the faces as 64-bit integers, all in little-endian byte order.
+        """
+        vertices, edges, faces = mesh_arrays_to_write(self)
+        with open(filename,'wb') as f:
+            f.write(BINARY_MESH_MAGIC)
+            f.write(np.array([vertices.shape[0],edges.shape[0],faces.shape[0]],dtype='<i8').tobytes())
+            f.write(vertices.tobytes())
+            f.write(edges.tobytes())
+            f.write(faces.tobytes())
+        return
+
     def write_off_file(self,filename='output.off'):
         """Write topology into .off file for visualization"""
         with open(filename,'w') as f:
@@ -181,7 +294,7 @@ class mesh:
         `sm_radius` is the radius cutoff for constructing simplicial complices. 
         Pairs of vertices closer than `sm_radius` Angstrom apart are connected to form edges. 
 
-        `msh_file` is the filename for output .msh files.
+        `msh_file` is the filename for output .msh files, the mesh is not written to file if `msh_file` is None.
 
         `rmax` is the radius of the largest mesh used to normalize all meshes to the same unit sphere. 
         """
@@ -195,14 +308,15 @@ class mesh:
         mda_version = [int(a) for a in MDAnalysis.__version__.split('.')]
         if mda_version[0] == 0 and mda_version[1] >= 19:
             self.neighbor_search_old(cutoff=sm_radius,coords=temp,box=box) # neighbor grid search to identify vertex pairs within r < cutoff apart
-        elif mda_version[0] == 1 and (mda_version[2] >= 2 or mda_version[1] >= 1):
-            self.neighbor_search_new(cutoff=sm_radius,coords=temp,box=box) # neighbor grid search to identify vertex pairs within r < cutoff apart  
+        elif (mda_version[0] == 1 and (mda_version[2] >= 2 or mda_version[1] >= 1)) or mda_version[0] >= 2:
+            self.neighbor_search_new(cutoff=sm_radius,coords=temp.astype(np.float32),box=box.astype(np.float32)) # neighbor grid search to identify vertex pairs within r < cutoff apart  
         else:
             self.calc_distance_matrix()
             self.edges, distances = self.get_edge_list(radius=sm_radius)
         self.edge_to_face_list() # generate faces enclosed by any 3 edges    
         self.vertices /= rmax # normalized generated meshes to the specified unit sphere
-        self.write_mesh_file(filename=msh_file)
+        if msh_file != None:
+            self.write_mesh_file(filename=msh_file)
         return
     
     def generate_random_vertices(self, n_vertices):
@@ -218,3 +332,305 @@ class mesh:
         vertices = np.array(vertices)
         self.vertices = vertices
         return
+
+class mesh_ensemble:
+    """
+    Store of the meshes of a whole ensemble (e.g. all frames of one protein) in a single .emsh file.
+
+    The file contains a 16-byte header, followed by the vertices, edges and faces of each frame in the binary mesh layout (see `mesh.write_mesh_file_binary`), 
+    concatenated frame after frame. The frame index, i.e. the byte offset and the number of vertices, edges and faces of each frame, is stored after the last frame, 
+    followed by a 24-byte trailer. Frames are read as memory-mapped views of the file.
+
+    `filename` is the name of the .emsh file.
+
+    `mode` is 'r' to read an existing store, 'a' to append frames to a store (created if it does not exist), or 'w' to create a new empty store.
+    Frames appended in 'a' or 'w' mode are only visible in the file after `flush` or `close`.
+    """
+
+    def __init__(self, filename, mode = 'r'):
+        self.filename = filename
+        """Name of the .emsh file"""
+        self.mode = mode
+        """'r' for read only, 'a' or 'w' for appending frames"""
+        self.index = np.zeros((0,4),dtype='<i8')
+        """Frame index, byte offset and number of vertices, edges and faces of each frame"""
+        self.appended = []
+        """Frame index of frames appended but not yet merged into `index`"""
+        self.data = None
+        """Memory map of the file"""
+        self.file = None
+        """File object for appending frames"""
+        if mode == 'w' or (mode == 'a' and not os.path.exists(filename)):
+            with open(filename,'wb') as f:
+                f.write(ENSEMBLE_MESH_MAGIC)
+                f.write(bytes(ENSEMBLE_MESH_HEADER-len(ENSEMBLE_MESH_MAGIC)))
+            self.end = ENSEMBLE_MESH_HEADER
+            """Byte offset of the end of the last frame"""
+            self.flush()
+        else:
+            self.read_index()
+        if mode != 'r':
+            self.file = open(filename,'r+b')
+        return
+
+    def read_index(self):
+        """Read the frame index from the end of the file"""
+        with open(self.filename,'rb') as f:
+            header = f.read(len(ENSEMBLE_MESH_MAGIC))
+            f.seek(-ENSEMBLE_MESH_TRAILER,os.SEEK_END)
+            trailer = f.read(ENSEMBLE_MESH_TRAILER)
+            if header != ENSEMBLE_MESH_MAGIC or trailer[16:] != ENSEMBLE_MESH_MAGIC:
+                raise ValueError("%s is not a mesh ensemble file or it was not closed properly"%self.filename)
+            self.end, n_frame = [int(a) for a in np.frombuffer(trailer,dtype='<i8',count=2)]
+            f.seek(self.end)
+            self.index = np.frombuffer(f.read(n_frame*4*8),dtype='<i8').reshape(n_frame,4).copy()
+        self.data = None
+        return
+
+    def merge_index(self):
+        """Merge index of appended frames into the frame index"""
+        if len(self.appended) > 0:
+            self.index = np.vstack((self.index,np.array(self.appended,dtype='<i8')))
+            self.appended = []
+        return
+
+    def __len__(self):
+        return self.index.shape[0] + len(self.appended)
+
+    def __getitem__(self, i):
+        """Return frame `i` as a `mesh` with memory-mapped (copy-on-write) vertices, edges and faces."""
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("frame %d out of range for mesh ensemble with %d frames"%(i,len(self)))
+        self.merge_index()
+        if self.data is None:
+            if self.file is not None:
+                self.file.flush()
+            self.data = np.memmap(self.filename,dtype=np.uint8,mode='c')
+        offset, n_vertex, n_edge, n_face = [int(a) for a in self.index[i]]
+        meshA = mesh()
+        meshA.n_vertex, meshA.n_edge, meshA.n_face = n_vertex, n_edge, n_face
+        meshA.vertices, meshA.edges, meshA.faces = mesh_arrays_from_buffer(self.data,offset,n_vertex,n_edge,n_face)
+        return meshA
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, meshA):
+        """Append a `mesh` as the next frame."""
+        if self.file is None:
+            raise ValueError("mesh ensemble %s is opened as read only"%self.filename)
+        vertices, edges, faces = mesh_arrays_to_write(meshA)
+        self.file.seek(self.end)
+        for array in [vertices, edges, faces]:
+            self.file.write(array.tobytes())
+        self.appended.append([self.end,vertices.shape[0],edges.shape[0],faces.shape[0]])
+        self.end += vertices.nbytes + edges.nbytes + faces.nbytes
+        self.data = None
+        return
+
+    def extend(self, meshes):
+        """Append a list of `mesh` as frames."""
+        for meshA in meshes:
+            self.append(meshA)
+        return
+
+    def flush(self):
+        """Write the frame index and the trailer after the last frame."""
+        if self.file is None:
+            f = open(self.filename,'r+b')
+        else:
+            f = self.file
+        self.merge_index()
+        f.seek(self.end)
+        f.write(self.index.tobytes())
+        f.write(np.array([self.end,len(self)],dtype='<i8').tobytes())
+        f.write(ENSEMBLE_MESH_MAGIC)
+        f.truncate()
+        f.flush()
+        if self.file is None:
+            f.close()
+        self.data = None
+        return
+
+    def close(self):
+        """Flush appended frames and close the file."""
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+        self.data = None
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return
+
+def mesh_arrays_to_write(meshA):
+    """Return vertices, edges and faces of a mesh as contiguous little-endian arrays for binary output."""
+    vertices = np.ascontiguousarray(meshA.vertices,dtype='<f8').reshape(-1,3)
+    edges = np.ascontiguousarray(meshA.edges,dtype='<i8').reshape(-1,2)
+    faces = np.ascontiguousarray(meshA.faces,dtype='<i8').reshape(-1,3)
+    return vertices, edges, faces
+
+def mesh_arrays_from_buffer(data, offset, n_vertex, n_edge, n_face):
+    """Return vertices, edges and faces as views of a byte buffer (e.g. memory map) starting from `offset`."""
+    n_byte = [n_vertex*3*8,n_edge*2*8,n_face*3*8]
+    arrays = []
+    for n, shape, dtype in zip(n_byte,[(n_vertex,3),(n_edge,2),(n_face,3)],['<f8','<i8','<i8']):
+        arrays.append(data[offset:offset+n].view(dtype).reshape(shape))
+        offset += n
+    return arrays
+
+def is_binary_mesh_file(filename):
+    """Check if a file is a binary mesh file from its header."""
+    with open(filename,'rb') as f:
+        return f.read(len(BINARY_MESH_MAGIC)) == BINARY_MESH_MAGIC
+
+def is_mesh_ensemble_file(filename):
+    """Check if a path is a mesh ensemble (.emsh) file from its header."""
+    if not os.path.isfile(filename):
+        return False
+    with open(filename,'rb') as f:
+        return f.read(len(ENSEMBLE_MESH_MAGIC)) == ENSEMBLE_MESH_MAGIC
+
+def is_mesh_file(filename):
+    """Check if a filename is a text (.msh) or binary (.bmsh) mesh file by its extension."""
+    return filename.endswith(".msh") or filename.endswith(".bmsh")
+
+def list_mesh_files(directory_mesh):
+    """
+    List the mesh files in a folder, one file per frame: if a frame is stored both as text (.msh) and binary (.bmsh) file 
+    with the same name (e.g. after `convert_mesh_folder` into the same folder), only the binary file is listed, as in `find_mesh_file`.
+    The files are listed in the order of `os.listdir`.
+    """
+    filenames = [filename for filename in os.listdir(directory_mesh) if is_mesh_file(filename)]
+    binary = set(filename[:-len('.bmsh')] for filename in filenames if filename.endswith('.bmsh'))
+    return [filename for filename in filenames if filename.endswith('.bmsh') or filename[:-len('.msh')] not in binary]
+
+def find_mesh_file(prefix):
+    """Return the binary mesh file `prefix`.bmsh if it exists, otherwise the text mesh file `prefix`.msh."""
+    if os.path.exists(prefix + '.bmsh'):
+        return prefix + '.bmsh'
+    return prefix + '.msh'
+
+def read_meshes(directory_mesh):
+    """
+    Iterate through all meshes in a folder of .msh / .bmsh files, or in a mesh ensemble (.emsh) file.
+    
+    It yields the name of the mesh file (or the frame number for mesh ensemble) and the `mesh`.
+    """
+    if is_mesh_ensemble_file(directory_mesh):
+        with mesh_ensemble(directory_mesh) as ensemble:
+            for i, meshA in enumerate(ensemble):
+                yield i, meshA
+    else:
+        for filename in list_mesh_files(directory_mesh):
+            meshA = mesh()
+            meshA.read_mesh_file(filename=directory_mesh + '/' + filename)
+            yield filename, meshA
+
+def convert_mesh_folder_to_ensemble(directory_mesh, ensemble_file, verbose = False):
+    """
+    Collect all .msh / .bmsh files in a folder (one per frame, see `list_mesh_files`) into a mesh ensemble (.emsh) file, in the order of sorted filenames.
+
+    If `verbose` is set to True, the program prints progress in command prompt.
+    """
+    with mesh_ensemble(ensemble_file,mode='w') as ensemble:
+        for filename in sorted(list_mesh_files(directory_mesh)):
+            if verbose:
+                sys.stdout.write('Adding %s to %s...\r'%(filename,ensemble_file))
+                sys.stdout.flush()
+            meshA = mesh()
+            meshA.read_mesh_file(filename=directory_mesh + '/' + filename)
+            ensemble.append(meshA)
+    if verbose:
+        sys.stdout.write('\n')
+    return
+
+def convert_mesh_file(file_in, file_out, mmap=True):
+    """
+    Convert a mesh file between the text (.msh) and binary (.bmsh) formats.
+    
+    The format of `file_in` is detected from its header, and the format of `file_out` is determined by its extension.
+    """
+    meshA = mesh()
+    meshA.read_mesh_file(filename=file_in,mmap=mmap)
+    meshA.write_mesh_file(filename=file_out)
+    return
+
+def convert_mesh_folder(directory_in, directory_out = None, binary = True, verbose = False):
+    """
+    Convert all mesh files in a folder between the text (.msh) and binary (.bmsh) formats.
+    
+    If `binary` is set to True, .msh files are converted to .bmsh files, otherwise .bmsh files are converted to .msh files.
+    
+    `directory_out` is the folder for the converted files, default to be `directory_in` with suffix "_bmsh" (or "_msh" if `binary` is set to False), 
+    such that the folder of converted files contains each frame only once.
+
+    If `verbose` is set to True, the program prints progress in command prompt.
+    """
+    if directory_out == None:
+        directory_out = directory_in.rstrip('/') + ('_bmsh' if binary else '_msh')
+    if not os.path.exists(directory_out):
+        os.mkdir(directory_out)
+    if binary:
+        ext_in, ext_out = '.msh', '.bmsh'
+    else:
+        ext_in, ext_out = '.bmsh', '.msh'
+    for filename in os.listdir(directory_in):
+        if filename.endswith(ext_in):
+            if verbose:
+                sys.stdout.write('Converting %s...\r'%filename)
+                sys.stdout.flush()
+            convert_mesh_file(directory_in + '/' + filename, directory_out + '/' + filename[:-len(ext_in)] + ext_out)
+    if verbose:
+        sys.stdout.write('\n')
+    return
+
+def normalize_mesh_file(filename, rmax, vertices_file = None):
+    """
+    Divide the vertex coordinates of a mesh file by `rmax` in place, i.e. normalize a mesh constructed from unnormalized vertices (see `mesh.convert_vertices_to_mesh`).
+
+    Binary mesh (.bmsh) and mesh ensemble (.emsh) files are modified through a writable memory map of the vertex blocks, without touching edges and faces. 
+    For text mesh (.msh) files, only the vertex lines are rewritten, the edge and face lines are copied as they are.
+
+    `vertices_file` is a .npy file of the unnormalized vertices of a text mesh file, saved when the mesh was written. If provided, 
+    the vertices are read from it instead of the text file, so they are rounded only once, when the normalized vertices are written, 
+    and the file is removed afterwards.
+    """
+    if is_mesh_ensemble_file(filename):
+        with mesh_ensemble(filename) as ensemble:
+            index = ensemble.index
+        data = np.memmap(filename,dtype=np.uint8,mode='r+')
+        for offset, n_vertex, n_edge, n_face in index:
+            data[offset:offset+n_vertex*3*8].view('<f8')[:] /= rmax
+        data.flush()
+        del data
+    elif is_binary_mesh_file(filename):
+        with open(filename,'rb') as f:
+            n_vertex = int(np.frombuffer(f.read(BINARY_MESH_HEADER),dtype='<i8',count=1,offset=len(BINARY_MESH_MAGIC))[0])
+        vertices = np.memmap(filename,dtype='<f8',mode='r+',offset=BINARY_MESH_HEADER,shape=(n_vertex,3))
+        vertices /= rmax
+        vertices.flush()
+        del vertices
+    else:
+        with open(filename,'r') as f:
+            lines = f.readlines()
+        n_vertex = int(lines[0].split()[0])
+        if vertices_file == None:
+            vertices = np.array([line.split() for line in lines[1:n_vertex+1]],dtype=float).reshape(-1,3)
+        else:
+            vertices = np.load(vertices_file)
+        vertices /= rmax
+        lines[1:n_vertex+1] = ['%.6f %.6f %.6f\n'%(vertex[0],vertex[1],vertex[2]) for vertex in vertices]
+        with open(filename,'w') as f:
+            f.writelines(lines)
+        if vertices_file != None:
+            os.remove(vertices_file)
+    return
@@ -0,0 +1,192 @@
+#!/bin/python3
+
+import os, sys, json, hashlib, shutil
+
+def hash_file(filename):
+    """Hash of the content of the file `filename`"""
+    h = hashlib.blake2b(digest_size=20)
+    with open(filename,'rb') as f:
+        for block in iter(lambda: f.read(1<<20),b''):
+            h.update(block)
+    return h.hexdigest()
+
+def list_files(path):
+    """List of all files in `path`, which is either a file or a folder (searched recursively), in sorted order"""
+    if os.path.isfile(path):
+        return [path]
+    files = []
+    for root, dirs, filenames in os.walk(path):
+        dirs.sort()
+        for filename in sorted(filenames):
+            files.append(os.path.join(root,filename))
+    return files
+
+def scan_path(path, known = None):
+    """
+    Signatures of all files in `path` (a file or a folder), as a dictionary of file name to [size, modification time, hash].
+
+    `known` is a dictionary of signatures from a previous scan, the hash of a file is reused without reading the file
+    if its size and modification time are unchanged, so large unchanged inputs (e.g. trajectories) are not read again.
+
+    It returns None if `path` is None or does not exist.
+    """
+    if path == None or not os.path.exists(path):
+        return None
+    if known == None:
+        known = {}
+    signatures = {}
+    for filename in list_files(path):
+        stat = os.stat(filename)
+        key = os.path.relpath(filename,path) if os.path.isdir(path) else os.path.basename(filename)
+        previous = known.get(key)
+        if previous != None and previous[0] == stat.st_size and previous[1] == stat.st_mtime_ns:
+            signatures[key] = previous
+        else:
+            signatures[key] = [stat.st_size,stat.st_mtime_ns,hash_file(filename)]
+    return signatures
+
+def hash_signatures(signatures):
+    """Hash of a path from the signatures of its files, depending only on file names and contents"""
+    if signatures == None:
+        return None
+    h = hashlib.blake2b(digest_size=20)
+    for key in sorted(signatures):
+        h.update(key.encode())
+        h.update(signatures[key][2].encode())
+    return h.hexdigest()
+
+class pipeline:
+    """
+    Runner of named stages with checkpointing, for resuming a calculation.
+
+    After a stage is run, a manifest of its parameters, and of the hashes of its input and output files,
+    is written as a JSON file `<stage name>.json` in the folder `directory`.
+    When the calculation is run again, a stage is skipped if its parameters and the contents of its inputs are unchanged,
+    and its outputs still exist with the recorded contents. Stages read the outputs of earlier stages from files,
+    so a rerun resumes from the first stage whose inputs or parameters changed, and the later stages are rerun
+    only if the outputs they depend on changed.
+
+    Before a stage is run, its existing outputs are removed, so files left by an earlier run with other parameters
+    (e.g. more frames) are not picked up by the later stages. Outputs of a stage should therefore be the files and folders
+    written by that stage only.
+
+    Parameters of a stage must be serializable as JSON, and should only contain those that affect the outputs.
+    """
+
+    def __init__(self, directory, force = None, verbose = False):
+        self.directory = directory
+        """Folder of the manifests of the stages"""
+        self.force = force
+        """List of names of stages to rerun regardless of their manifests, all stages if the list is empty, none if None"""
+        self.verbose = verbose
+        """Verbose"""
+        if not os.path.exists(directory):
+            os.makedirs(directory,exist_ok=True)
+        return
+
+    def manifest_file(self, name):
+        """Name of the manifest file of stage `name`"""
+        return os.path.join(self.directory,'%s.json'%name)
+
+    def read_manifest(self, name):
+        """Read the manifest of stage `name`, None if it does not exist or cannot be read"""
+        filename = self.manifest_file(name)
+        if not os.path.exists(filename):
+            return None
+        try:
+            with open(filename,'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_manifest(self, name, manifest):
+        """Write the manifest of stage `name`, to a temporary file then renamed"""
+        filename = self.manifest_file(name)
+        with open(filename + '.tmp','w') as f:
+            json.dump(manifest,f,indent=1,sort_keys=True)
+        os.replace(filename + '.tmp',filename)
+        return
+
+    def scan(self, paths, known = None):
+        """Signatures and hashes of the files in `paths`, reusing the signatures in `known` from a previous manifest"""
+        if known == None:
+            known = {}
+        records = {}
+        for path in paths:
+            if path == None:
+                continue
+            previous = known.get(path)
+            signatures = scan_path(path,None if previous == None else previous['files'])
+            records[path] = {'hash':hash_signatures(signatures),'files':signatures}
+        return records
+
+    def clear(self, paths):
+        """Remove the files and folders in `paths` that exist"""
+        for path in paths:
+            if path == None or not os.path.exists(path):
+                continue
+            if self.verbose:
+                sys.stdout.write('Removing previous output %s\n'%path)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        return
+
+    def is_forced(self, name):
+        """Whether stage `name` is forced to rerun"""
+        return self.force != None and (len(self.force) == 0 or name in self.force)
+
+    def is_valid(self, name, manifest, parameters, inputs, outputs):
+        """Whether the manifest of stage `name` matches the parameters, inputs and current outputs, so the stage can be skipped"""
+        if manifest == None or self.is_forced(name):
+            return False
+        ## round trip through JSON so e.g. tuples compare equal to the lists in the manifest
+        if manifest.get('parameters') != json.loads(json.dumps(parameters)):
+            return False
+        outputs = [path for path in outputs if path != None]
+        if sorted(manifest.get('inputs',{})) != sorted(inputs) or sorted(manifest.get('outputs',{})) != sorted(outputs):
+            return False
+        for path, record in inputs.items():
+            if record['hash'] == None or record['hash'] != manifest['inputs'][path]['hash']:
+                return False
+        current = self.scan(outputs,manifest['outputs'])
+        for path in outputs:
+            if current[path]['hash'] == None or current[path]['hash'] != manifest['outputs'][path]['hash']:
+                return False
+        return True
+
+    def run(self, name, function, parameters = None, inputs = (), outputs = ()):
+        """
+        Run stage `name` by calling `function()` unless it can be skipped.
+
+        `parameters` is a dictionary of the parameters of the stage.
+
+        `inputs` is the list of files or folders read by the stage, None entries are ignored.
+
+        `outputs` is the list of files or folders written by the stage, None entries are ignored. They are removed before the stage is run.
+
+        It returns True if the stage is run, False if it is skipped.
+        """
+        if parameters == None:
+            parameters = {}
+        manifest = self.read_manifest(name)
+        known = None if manifest == None else manifest.get('inputs')
+        input_records = self.scan(inputs,known)
+        if self.is_valid(name,manifest,parameters,input_records,outputs):
+            if self.verbose:
+                sys.stdout.write('Skipping stage "%s", inputs and parameters unchanged.\n'%name)
+            return False
+        if self.verbose:
+            sys.stdout.write('Running stage "%s"...\n'%name)
+        ## remove the manifest first, so an interrupted stage is rerun next time
+        if manifest != None:
+            os.remove(self.manifest_file(name))
+        self.clear(outputs)
+        function()
+        manifest = {'stage':name,
+                'parameters':parameters,
+                'inputs':input_records,
+                'outputs':self.scan(outputs)}
+        self.write_manifest(name,manifest)
+        return True
@@ -5,37 +5,218 @@ import numpy as np
 from scipy.stats import rankdata
 from sinatra_pro.mesh import *
 
-def reconstruct_by_sorted_threshold(meshfile, directions, rates, n_filtration = 25, n_direction_per_cone = 1, ball_radius = 1.0, by_rank = False, verbose = False):
+def filtration_index(heights, n_filtration = 25, ball_radius = 1.0):
     """
-    Reconstruction algorithms
+    Same as `np.digitize(heights,np.linspace(-ball_radius,ball_radius,n_filtration))` for an array of heights of any shape, 
+    computed arithmetically from the uniform spacing of the filtration steps, then corrected by one step where rounding puts a height in the neighboring step.
     """
-    if verbose:
-        sys.stdout.write('Reconstructing for %s ...\r'%meshfile)
-        sys.stdout.flush()
+    radius = np.linspace(-ball_radius,ball_radius,n_filtration)
+    if n_filtration < 2:
+        return np.digitize(heights,radius)
+    index = np.floor((heights + ball_radius) * ((n_filtration - 1) / (2 * ball_radius))).astype(np.intp)
+    index += 1
+    np.clip(index,0,n_filtration,out=index)
+    bounds = np.concatenate(([-np.inf],radius,[np.inf]))
+    index -= heights < bounds[index]
+    index += heights >= bounds[index+1]
+    return index
+
+def reconstruct_vertices(vertices, directions, rates, n_filtration = 25, n_direction_per_cone = 1, ball_radius = 1.0, by_rank = False):
+    """
+    Vectorized reconstruction on vertex coordinates held in memory.
 
-    meshA = mesh()
-    meshA.read_mesh_file(filename=meshfile)
+    `vertices` is the (n_vertex, 3) array of vertex coordinates of one frame, or the (n_frame, n_vertex, 3) array of several frames with the same number of vertices.
 
+    The heights of all vertices along all directions are computed with one matrix product, and their filtration steps in one pass with `filtration_index`. 
+    The rates are then gathered with one index array (written into the height array), and reduced by the minimum over the directions in each cone 
+    and the maximum over cones. It returns an array of shape (n_vertex) or (n_frame, n_vertex) respectively.
+    """
     n_direction = directions.shape[0]
     n_cone = int(n_direction/n_direction_per_cone)
-    n_vertex = meshA.n_vertex
-    n_rates = rates.size
-    rates_vert = np.zeros((n_vertex,n_cone,n_direction_per_cone),dtype=float)
-    for i in range(n_cone):
-        for j in range(n_direction_per_cone):
-            k = i*n_direction_per_cone+j
-            vertex_function = np.dot(meshA.vertices,directions[k])
-            radius = np.linspace(-ball_radius,ball_radius,n_filtration)
-            filtration = np.digitize(vertex_function,radius)-1
-            rates_vert[:,i,j] = rates[k*n_filtration+filtration]
-    height = np.amax(np.amin(rates_vert[:,:,:],axis=2),axis=1)
+    vertices = np.asarray(vertices,dtype=float)
+    # heights laid out as (..., n_direction, n_vertex), so the reductions over directions run over contiguous rows
+    heights = directions @ np.swapaxes(vertices,-1,-2)
+    index = filtration_index(heights,n_filtration=n_filtration,ball_radius=ball_radius)
+    index += (np.arange(n_direction)*n_filtration - 1)[:,None]
+    np.take(rates,index,out=heights)
+    heights = heights.reshape(heights.shape[:-2]+(n_cone,n_direction_per_cone,heights.shape[-1]))
+    height = np.amax(np.amin(heights,axis=-2),axis=-2)
     if by_rank:
-        rank = rankdata(height,method='dense')
-        rank = rank/np.amax(rank)
+        rank = rankdata(height,method='dense',axis=-1).astype(float)
+        rank /= np.amax(rank,axis=-1,keepdims=True)
         return rank
     else:
         return height
 
+def reconstruct_by_sorted_threshold(meshfile, directions, rates, n_filtration = 25, n_direction_per_cone = 1, ball_radius = 1.0, by_rank = False, verbose = False):
+    """
+    Reconstruction algorithms
+
+    `meshfile` is the mesh file, a `mesh` already loaded in memory, or an array of vertex coordinates (see `reconstruct_vertices`).
+    """
+    if isinstance(meshfile,np.ndarray):
+        vertices = meshfile
+    elif isinstance(meshfile,mesh):
+        vertices = meshfile.vertices
+    else:
+        if verbose:
+            sys.stdout.write('Reconstructing for %s ...\r'%meshfile)
+            sys.stdout.flush()
+        meshA = mesh()
+        meshA.read_mesh_file(filename=meshfile)
+        vertices = meshA.vertices
+    return reconstruct_vertices(vertices, directions, rates, n_filtration = n_filtration, n_direction_per_cone = n_direction_per_cone, ball_radius = ball_radius, by_rank = by_rank)
+
+def reconstruct_frames(meshes, directions, rates, n_filtration = 25, n_direction_per_cone = 1, ball_radius = 1.0, by_rank = False, frames = None, batch_size = 16, verbose = False):
+    """
+    Generator of the reconstruction on a sequence of frames, reading one frame at a time.
+
+    If `frames` is provided, `meshes` is a mesh ensemble (.emsh) file, opened once, and `frames` the list of frames to reconstruct. 
+    Otherwise `meshes` is an iterable of mesh files, `mesh` objects or vertex arrays.
+
+    The vertices of up to `batch_size` consecutive frames with the same number of vertices are reconstructed at once with `reconstruct_vertices`, 
+    and the generator yields the (n_frame_in_batch, n_vertex) array of each batch.
+    """
+    ensemble = None
+    if frames is not None:
+        ensemble = mesh_ensemble(meshes)
+        meshes = (ensemble[frame] for frame in frames)
+    try:
+        batch = []
+        for meshA in meshes:
+            if isinstance(meshA,np.ndarray):
+                vertices = meshA
+            elif isinstance(meshA,mesh):
+                vertices = meshA.vertices
+            else:
+                if verbose:
+                    sys.stdout.write('Reconstructing for %s ...\r'%meshA)
+                    sys.stdout.flush()
+                meshB = mesh()
+                meshB.read_mesh_file(filename=meshA)
+                vertices = meshB.vertices
+            if len(batch) > 0 and (len(batch) == batch_size or vertices.shape != batch[0].shape):
+                yield reconstruct_vertices(np.stack(batch), directions, rates, n_filtration = n_filtration, n_direction_per_cone = n_direction_per_cone, ball_radius = ball_radius, by_rank = by_rank)
+                batch = []
+            batch.append(vertices)
+        if len(batch) > 0:
+            yield reconstruct_vertices(np.stack(batch), directions, rates, n_filtration = n_filtration, n_direction_per_cone = n_direction_per_cone, ball_radius = ball_radius, by_rank = by_rank)
+    finally:
+        ## release the memory map of the ensemble file, also if the generator is closed early
+        if ensemble is not None:
+            ensemble.close()
+
+def reconstruct_on_mesh_ensemble(ensemble_file, frames, directions, rates, n_filtration = 25, n_direction_per_cone = 1, ball_radius = 1.0, by_rank = False, verbose = False, batch_size = 16):
+    """Reconstruction on the list of frames `frames` of a mesh ensemble (.emsh) file, returns an array of shape (n_frame, n_vertex), see `reconstruct_frames`."""
+    if verbose:
+        sys.stdout.write('Reconstructing for %s ...\r'%ensemble_file)
+        sys.stdout.flush()
+    out_prob = list(reconstruct_frames(ensemble_file, directions, rates, n_filtration = n_filtration, n_direction_per_cone = n_direction_per_cone, ball_radius = ball_radius, by_rank = by_rank, frames = frames, batch_size = batch_size))
+    if len(out_prob) == 0:
+        return np.zeros((0,0),dtype=float)
+    return np.vstack(out_prob)
+
+class vertex_statistics:
+    """
+    Running statistics of the reconstructed values of each vertex over frames, updated one batch of frames at a time, 
+    so the memory usage does not grow with the number of frames.
+
+    The running mean and variance are updated with the pairwise update of Welford's algorithm (Chan et al. 1979). 
+    If `n_bin` is provided, a histogram of `n_bin` bins over `value_range` (min, max) is also kept for each vertex as a sketch of the distribution, 
+    from which quantiles are estimated by linear interpolation within bins. Values outside `value_range` are counted in the first or last bin.
+
+    `n_vertex` is the number of vertices.
+    """
+
+    def __init__(self, n_vertex, n_bin = None, value_range = (0.0,1.0)):
+        self.n_sample = 0
+        """Number of frames accumulated"""
+        self.mean = np.zeros(n_vertex,dtype=float)
+        """Running mean of each vertex"""
+        self.M2 = np.zeros(n_vertex,dtype=float)
+        """Running sum of squared deviations from the mean of each vertex"""
+        self.value_range = value_range
+        """Range (min, max) of the histogram"""
+        self.counts = None
+        """Histogram counts of each vertex, of shape (n_vertex, n_bin)"""
+        if n_bin != None:
+            self.counts = np.zeros((n_vertex,n_bin),dtype=np.int64)
+        return
+
+    def update(self, values):
+        """Add the values of a batch of frames, an array of shape (n_frame, n_vertex) or (n_vertex)"""
+        values = np.atleast_2d(values)
+        m = values.shape[0]
+        if m == 0:
+            return
+        batch_mean = np.mean(values,axis=0)
+        self.merge_moments(m,batch_mean,np.sum((values-batch_mean)**2,axis=0))
+        if self.counts is not None:
+            n_vertex, n_bin = self.counts.shape
+            vmin, vmax = self.value_range
+            bins = np.floor((values - vmin) * (n_bin / (vmax - vmin))).astype(np.intp)
+            np.clip(bins,0,n_bin-1,out=bins)
+            bins += np.arange(n_vertex)*n_bin
+            self.counts += np.bincount(bins.ravel(),minlength=n_vertex*n_bin).reshape(n_vertex,n_bin)
+        return
+
+    def merge(self, other):
+        """Merge the statistics of another `vertex_statistics`, e.g. from another worker"""
+        self.merge_moments(other.n_sample,other.mean,other.M2)
+        if self.counts is not None and other.counts is not None:
+            self.counts += other.counts
+        return
+
+    def merge_moments(self, m, mean, M2):
+        """Merge the statistics of `m` frames with mean `mean` and sum of squared deviations `M2`"""
+        if m == 0:
+            return
+        total = self.n_sample + m
+        delta = mean - self.mean
+        self.M2 += M2 + delta**2 * (self.n_sample*m/total)
+        self.mean += delta * (m/total)
+        self.n_sample = total
+        return
+
+    def variance(self, ddof = 0):
+        """Variance of each vertex over frames, same as `np.var(values,axis=0,ddof=ddof)`"""
+        return self.M2 / (self.n_sample - ddof)
+
+    def quantile(self, q):
+        """Estimated `q`-th quantile (0 <= `q` <= 1) of each vertex from the histogram, within one bin width of the inverse of the empirical distribution function"""
+        if self.counts is None:
+            raise ValueError("quantiles need a histogram, set n_bin in vertex_statistics")
+        n_vertex, n_bin = self.counts.shape
+        vmin, vmax = self.value_range
+        cumulative = np.cumsum(self.counts,axis=1)
+        target = q * cumulative[:,-1]
+        ## first non-empty bin where the cumulative count reaches the target, so that q = 0 gives the minimum
+        index = np.minimum(np.sum((cumulative < target[:,None]) | (cumulative == 0),axis=1),n_bin-1)
+        rows = np.arange(n_vertex)
+        below = np.where(index > 0,cumulative[rows,index-1],0)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            fraction = np.where(self.counts[rows,index] > 0,(target - below) / self.counts[rows,index],0.)
+        return vmin + (index + fraction) * ((vmax - vmin) / n_bin)
+
+def reconstruct_statistics(meshes, directions, rates, n_filtration = 25, n_direction_per_cone = 1, ball_radius = 1.0, by_rank = False, frames = None, n_bin = None, value_range = None, batch_size = 16, verbose = False):
+    """
+    Reconstruction on a sequence of frames (see `reconstruct_frames`), reduced on the fly into a `vertex_statistics` which is returned. 
+
+    `n_bin` and `value_range` are passed to `vertex_statistics`, the range of `rates` (or (0, 1) if `by_rank` is set to True) is used if `value_range` is not provided.
+
+    It raises a ValueError if there is no frame to reconstruct.
+    """
+    if value_range == None:
+        value_range = (0.0,1.0) if by_rank else (np.amin(rates),np.amax(rates))
+    statistics = None
+    for values in reconstruct_frames(meshes, directions, rates, n_filtration = n_filtration, n_direction_per_cone = n_direction_per_cone, ball_radius = ball_radius, by_rank = by_rank, frames = frames, batch_size = batch_size, verbose = verbose):
+        if statistics is None:
+            statistics = vertex_statistics(values.shape[1],n_bin=n_bin,value_range=value_range)
+        statistics.update(values)
+    if statistics is None:
+        raise ValueError("no frame to reconstruct")
+    return statistics
+
 def project_rate_on_nonvacuum(rates,not_vacuum):
     rates_new = np.zeros(not_vacuum.size,dtype=float)
     j = 0
@@ -45,7 +226,21 @@ def project_rate_on_nonvacuum(rates,not_vacuum):
             j += 1
     return rates_new
 
-def reconstruct_on_multiple_mesh(protA, protB, directions, rates, not_vacuum, n_sample = 101, n_direction_per_cone = 4, n_filtration = 25, ball_radius = 1.0, directory_mesh = None, sm_radius = 4.0, by_rank = False, parallel = False, n_core = -1, verbose = False):
+def reconstruct_on_multiple_mesh(protA, protB, directions, rates, not_vacuum, n_sample = 101, n_direction_per_cone = 4, n_filtration = 25, ball_radius = 1.0, directory_mesh = None, sm_radius = 4.0, by_rank = False, parallel = False, n_core = -1, verbose = False, n_bin = None, return_statistics = False):
+    """
+    Reconstruction on all frames of protein `protA`, averaged over frames. 
+
+    The frames are read from `directory_mesh`, a folder of mesh files or a mesh ensemble (.emsh) file, 
+    or the first `n_sample` frames in the folder "`protA`_`protB`/mesh/`protA`_`sm_radius`" if `directory_mesh` is not provided.
+
+    The frames are streamed through `reconstruct_statistics`, so only the running statistics are kept in memory instead of the values of all frames. 
+    If `parallel` is set to True, the frames are split into `n_core` contiguous chunks, each worker returns the statistics of its chunk, which are merged.
+
+    If `return_statistics` is set to True, the function returns the `vertex_statistics` with the mean, variance 
+    (and with the histograms for quantiles if `n_bin` is provided) instead of the average only.
+
+    It raises a ValueError if there is no frame in `directory_mesh`.
+    """
     if parallel:
         import multiprocessing
         from joblib import Parallel, delayed
@@ -53,34 +248,36 @@ def reconstruct_on_multiple_mesh(protA, protB, directions, rates, not_vacuum, n_
             n_core = multiprocessing.cpu_count()
 
     rates = project_rate_on_nonvacuum(rates,not_vacuum)
+    value_range = (0.0,1.0) if by_rank else (np.amin(rates),np.amax(rates))
+    frames = None
     if directory_mesh == None:
         directory_mesh = "%s_%s/mesh"%(protA,protB)
-        if parallel:
-            processed_list = Parallel(n_jobs=n_core)(delayed(reconstruct_by_sorted_threshold)('%s/%s_%.1f/%s_frame%d.msh'%(directory_mesh,protA,sm_radius,protA,frame), directions, rates, n_filtration, n_direction_per_cone, ball_radius, by_rank, verbose) for frame in range(n_sample))
-            out_prob = np.array(processed_list)
-        else:
-            meshProtein = mesh()
-            meshProtein.read_mesh_file(filename='%s/%s_%.1f/%s_frame0.msh'%(directory_mesh,protA,sm_radius,protA))
-            out_prob = np.zeros((n_sample,meshProtein.vertices.shape[0]),dtype=float)
-            for frame in range(n_sample):
-                filename='%s/%s_%.1f/%s_frame%d.msh'%(directory_mesh,protA,sm_radius,protA,frame)
-                out_prob[frame,:] = reconstruct_by_sorted_threshold('%s/%s_%.1f/%s_frame%d.msh'%(directory_mesh,protA,sm_radius,protA,frame), directions, rates, n_filtration = n_filtration, n_direction_per_cone = n_direction_per_cone, ball_radius = ball_radius, by_rank = by_rank, verbose = verbose)
-        average_prob = np.average(out_prob,axis=0)
+        meshes = [find_mesh_file('%s/%s_%.1f/%s_frame%d'%(directory_mesh,protA,sm_radius,protA,frame)) for frame in range(n_sample)]
+    elif is_mesh_ensemble_file(directory_mesh):
+        with mesh_ensemble(directory_mesh) as ensemble:
+            frames = np.arange(len(ensemble))
+        meshes = directory_mesh
     else:
-        if parallel:
-            processed_list = Parallel(n_jobs=n_core)(delayed(reconstruct_by_sorted_threshold)(directory_mesh + '/' + filename, directions, rates, n_filtration, n_direction_per_cone, ball_radius, by_rank, verbose) for filename in os.listdir(directory_mesh))
-            out_prob = np.array(processed_list)
+        meshes = [directory_mesh + '/' + filename for filename in list_mesh_files(directory_mesh)]
+    if (len(meshes) if frames is None else frames.size) == 0:
+        raise ValueError("no mesh frame found in %s"%directory_mesh)
+
+    if parallel:
+        if frames is not None:
+            chunks = [(meshes,chunk) for chunk in np.array_split(frames,min(n_core,frames.size))]
         else:
-            out_prob = []
-            for filename in os.listdir(directory_mesh):
-                if filename.endswith(".msh"):
-                    prob = reconstruct_by_sorted_threshold(directory_mesh + '/' + filename, directions, rates, n_filtration = n_filtration, n_direction_per_cone = n_direction_per_cone, ball_radius = ball_radius, by_rank = by_rank, verbose = verbose)
-                    out_prob.append(prob)
-            out_prob = np.array(out_prob)
-        average_prob = np.average(out_prob,axis=0)
+            chunks = [(list(chunk),None) for chunk in np.array_split(np.array(meshes,dtype=object),min(n_core,len(meshes)))]
+        processed_list = Parallel(n_jobs=n_core)(delayed(reconstruct_statistics)(chunk, directions, rates, n_filtration, n_direction_per_cone, ball_radius, by_rank, chunk_frames, n_bin, value_range, 16, verbose) for chunk, chunk_frames in chunks)
+        statistics = processed_list[0]
+        for partial in processed_list[1:]:
+            statistics.merge(partial)
+    else:
+        statistics = reconstruct_statistics(meshes, directions, rates, n_filtration = n_filtration, n_direction_per_cone = n_direction_per_cone, ball_radius = ball_radius, by_rank = by_rank, frames = frames, n_bin = n_bin, value_range = value_range, verbose = verbose)
     if verbose:
         sys.stdout.write('\n')
-    return average_prob
+    if return_statistics:
+        return statistics
+    return statistics.mean
 
 def write_vert_prob_on_pdb(vert_prob,protA=None,protB=None,pdb_in_file=None,pdb_out_file=None,selection="protein",by_rank=True):
     import MDAnalysis as mda
@@ -105,43 +302,94 @@ def write_vert_prob_on_pdb(vert_prob,protA=None,protB=None,pdb_in_file=None,pdb_
     protein.write(pdb_out_file)
     return
 
-def write_vert_prob_on_pdb_residue(vert_prob,protA=None,protB=None,selection="protein",pdb_in_file=None,pdb_out_file=None,by_rank=True):
+def atom_group_index(atoms, level = "resid"):
+    """
+    Index of the group of each atom in the `AtomGroup` `atoms`, numbered from 0 in order of first appearance.
+
+    `level` is the grouping, "resid" (by residue number only, the default), "residue" (by residue, distinguishing residues 
+    with the same number in different chains), "chain" (by chain ID, or segment if the topology has no chain IDs) or "segment".
+    """
+    if level == "residue":
+        keys = atoms.resindices
+    elif level == "resid":
+        keys = atoms.resids
+    elif level == "chain":
+        if hasattr(atoms,'chainIDs'):
+            keys = atoms.chainIDs
+        else:
+            keys = atoms.segindices
+    elif level == "segment":
+        keys = atoms.segindices
+    else:
+        raise ValueError("unknown group level %s, use residue, resid, chain or segment"%level)
+    unique_keys, first, group = np.unique(keys,return_index=True,return_inverse=True)
+    # renumber groups in order of first appearance instead of sorted keys
+    order = np.argsort(np.argsort(first))
+    return order[group.ravel()]
+
+def aggregate_vert_prob(vert_prob, group, reduction = "mean"):
+    """
+    Aggregate the values `vert_prob` of atoms into groups, where `group` is the group index of each atom (see `atom_group_index`).
+
+    `reduction` is "mean", "max" or "sum" of the values in each group. It returns the array of aggregated values of each group.
+    """
+    n_group = np.amax(group)+1
+    if reduction == "sum" or reduction == "mean":
+        value = np.bincount(group,weights=vert_prob,minlength=n_group)
+        if reduction == "mean":
+            value /= np.bincount(group,minlength=n_group)
+    elif reduction == "max":
+        order = np.argsort(group,kind='stable')
+        starts = np.searchsorted(group[order],np.arange(n_group))
+        value = np.maximum.reduceat(vert_prob[order],starts)
+    else:
+        raise ValueError("unknown reduction %s, use mean, max or sum"%reduction)
+    return value
+
+def write_vert_prob_on_pdb_groups(vert_prob, outputs, pdb_in_file = None, protA = None, protB = None, selection = "protein", by_rank = True):
+    """
+    Aggregate the atomic values `vert_prob` over residues, chains or segments, and write them into the temperature factor column of PDB files, 
+    all from one load of `pdb_in_file`.
+
+    `outputs` is a list of (PDB output file, group level, reduction), see `atom_group_index` and `aggregate_vert_prob` for the levels and reductions.
+
+    If `by_rank` is set to True, the aggregated values are replaced by their rank (scaled to 100), otherwise they are scaled to between 0 and 100.
+    """
     import MDAnalysis as mda
     if selection == None:
         selection = "protein"
     if pdb_in_file == None:
         pdb_in_file = "%s_%s/pdb/%s/%s_frame0.pdb"%(protA,protB,protA,protA)
-    if pdb_out_file == None:
-        pdb_out_file = "%s_%s/%s_reconstructed.pdb"%(protA,protB,protA)
     u = mda.Universe(pdb_in_file)
     protein = u.select_atoms(selection)
-    u.add_TopologyAttr('tempfactors') 
-    n_atom = len(protein)    
-    y = np.zeros(n_atom,dtype=float)
-    ag_res = u.atoms.groupby('resids')
-    rate_res = np.zeros(len(ag_res),dtype=float)
-    for i_r, res in enumerate(ag_res):
-        rate = 0
-        for a in ag_res[res]:
-            rate += vert_prob[a.ix]
-        rate /= len(ag_res[res])
-        rate_res[i_r] = rate
-    if by_rank:
-        rank_res = rankdata(rate_res,method='dense').astype(float)
-        rank_res *= 100.0/np.amax(rank_res)
-        for i_r, res in enumerate(ag_res):
-            for a in ag_res[res]:
-                y[a.ix] = rank_res[i_r]
-    else:
-        for i_r, res in enumerate(ag_res):
-            for a in ag_res[res]:
-                y[a.ix] = rate_res[i_r]
-        ymin = np.amin(y)
-        ymax = np.amax(y)
-        y = (vert_prob - ymin)/(ymax-ymin)*100
-    protein.tempfactors = y
-    protein.write(pdb_out_file)
+    u.add_TopologyAttr('tempfactors')
+    vert_prob = np.asarray(vert_prob,dtype=float)
+    groups = {}
+    for pdb_out_file, level, reduction in outputs:
+        if level not in groups:
+            groups[level] = atom_group_index(protein,level=level)
+        group = groups[level]
+        value = aggregate_vert_prob(vert_prob,group,reduction=reduction)
+        if by_rank:
+            value = rankdata(value,method='dense').astype(float)
+            value *= 100.0/np.amax(value)
+        else:
+            vmin = np.amin(value)
+            vmax = np.amax(value)
+            if vmax > vmin:
+                value = (value - vmin)/(vmax-vmin)*100
+            else:
+                value = np.zeros_like(value)
+        protein.tempfactors = value[group]
+        protein.write(pdb_out_file)
     return
 
-
-
+def write_vert_prob_on_pdb_residue(vert_prob,protA=None,protB=None,selection="protein",pdb_in_file=None,pdb_out_file=None,by_rank=True,level="resid",reduction="mean"):
+    """
+    Write the atomic values `vert_prob` averaged over each residue (or aggregated over another `level` with another `reduction`) into a PDB file, 
+    see `write_vert_prob_on_pdb_groups`.
+    """
+    if pdb_out_file == None:
+        pdb_out_file = "%s_%s/%s_reconstructed.pdb"%(protA,protB,protA)
+    write_vert_prob_on_pdb_groups(vert_prob,[(pdb_out_file,level,reduction)],pdb_in_file=pdb_in_file,protA=protA,protB=protB,selection=selection,by_rank=by_rank)
+    return
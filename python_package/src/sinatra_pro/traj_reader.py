@@ -8,7 +8,280 @@ from MDAnalysis.analysis.rms import rmsd
 from MDAnalysis.core.groups import AtomGroup
 from sinatra_pro.mesh import *
 
-def convert_traj_pdb_aligned(protA, protB, struct_file_A, traj_file_A, struct_file_B, traj_file_B, align_frame = 0, n_sample = 100, selection = None, directory = None, offset = 0, align_sequence = False, single = False, verbose = False):
+def sequence_alignment_selection(struct_file_A, struct_file_B, selection = 'protein'):
+    """
+    Align the sequences of protein A and B using the Needleman-Wunsch algorithm implemented by MDAnalysis, 
+    and return the lists of booleans for the residues of A and B respectively, True if the residue is aligned to a residue of the other protein.
+    """
+    seqselA = []
+    seqselB = []
+    u_A = mda.Universe(struct_file_A).select_atoms(selection)
+    u_B = mda.Universe(struct_file_B).select_atoms(selection)
+    seq_align = align.sequence_alignment(u_A,u_B)
+    seqA = seq_align[1]
+    seqB = seq_align[0]
+    nres = seq_align[4]
+    for i in range(nres):
+        if seqA[i] != '-' and seqB[i] != '-':
+            seqselA.append(True)
+            seqselB.append(True)
+        elif seqA[i] == '-' and seqB[i] != '-':
+            seqselB.append(False)
+        elif seqB[i] == '-' and seqA[i] != '-':
+            seqselA.append(False)
+    return seqselA, seqselB
+
+def select_aligned_atoms(u, selection = 'protein', seqsel = None):
+    """Select the atoms of `selection` in universe `u`, restricted to the residues marked True in `seqsel` (see `sequence_alignment_selection`) if provided."""
+    protein = u.select_atoms(selection)
+    if seqsel == None:
+        return protein
+    residues = protein.residues
+    mask = np.asarray(seqsel[:len(residues)],dtype=bool)
+    return residues[np.flatnonzero(mask)].atoms
+
+def superpose_frames(positions, mobile_index, ref_positions, weights = None, block_size = 256):
+    """
+    Batched weighted Kabsch superposition of the frames `positions` of shape (n_frame, n_atom, 3), overwritten in place with the aligned coordinates.
+
+    For each frame, the rotation which minimizes the weighted RMSD between the atoms `mobile_index` and the reference coordinates `ref_positions` 
+    (after moving both centers, weighted by `weights`, to the origin) is computed from the SVD of the 3x3 covariance matrices of all frames at once, 
+    then the rotation and translation onto the reference center are applied to all atoms of the frame, as `MDAnalysis.analysis.align.alignto` does frame by frame.
+
+    The frames are processed in blocks of `block_size` frames to bound the memory usage. It returns the RMSD of each frame after superposition.
+    """
+    if weights is None:
+        weights = np.ones(len(mobile_index),dtype=float)
+    weights = np.asarray(weights,dtype=float) / np.sum(weights)
+    ref = np.asarray(ref_positions,dtype=float)
+    ref_com = weights @ ref
+    ref = ref - ref_com
+    rmsds = np.zeros(positions.shape[0],dtype=float)
+    for i_start in range(0,positions.shape[0],block_size):
+        i_end = min(i_start+block_size,positions.shape[0])
+        frames = positions[i_start:i_end].astype(float)
+        mobile = frames[:,mobile_index,:]
+        mobile_com = np.einsum('fmi,m->fi',mobile,weights)
+        mobile -= mobile_com[:,None,:]
+        H = np.einsum('fmi,m,mj->fij',mobile,weights,ref)
+        U, S, Vt = np.linalg.svd(H)
+        d = np.sign(np.linalg.det(U @ Vt))
+        U[:,:,2] *= d[:,None]
+        R = U @ Vt # transposed rotation matrices, applied to row vectors
+        frames -= mobile_com[:,None,:]
+        frames = frames @ R
+        frames += ref_com
+        positions[i_start:i_end] = frames
+        diff = mobile @ R - ref
+        rmsds[i_start:i_end] = np.sqrt(np.einsum('fmi,m->f',diff**2,weights))
+    return rmsds
+
+def sample_frames(n_frame, n_sample, offset = 0, sampling = 'stride', seed = None):
+    """
+    Indices of `n_sample` frames drawn from a trajectory of `n_frame` frames, from frame `offset` on.
+
+    `sampling` is the sampling strategy: 
+
+    "stride" takes every nskip = int(`n_frame`/`n_sample`) frames, starting from frame `offset` modulo nskip, 
+    i.e. the frames kept by scanning the trajectory with (frame-`offset`) % nskip == 0, so runs with `offset` = 0, 1, ..., nskip-1 draw disjoint samples.
+
+    "uniform" spreads the samples evenly from frame `offset` to the last frame.
+
+    "random" draws the samples at random without replacement from frame `offset` on, with `seed` as the seed of the random number generator.
+
+    The frames are returned in increasing order. For RMSD-clustered representatives, see `sample_frames_rmsd_cluster`.
+    """
+    if sampling == 'stride':
+        nskip = int(n_frame/n_sample)
+        frames = np.arange(offset % nskip,n_frame,nskip)[:n_sample]
+    elif sampling == 'uniform':
+        frames = np.unique(np.linspace(offset,n_frame-1,n_sample).astype(int))
+    elif sampling == 'random':
+        rng = np.random.default_rng(seed)
+        frames = np.sort(rng.choice(np.arange(offset,n_frame),size=n_sample,replace=False))
+    else:
+        raise ValueError("unknown sampling strategy %s, use stride, uniform, random or rmsd_cluster"%sampling)
+    return frames
+
+def condensed_medoid(distances, n, members):
+    """
+    Medoid of the frames `members` (in increasing order), i.e. the frame with the smallest total distance to the other members, 
+    from the condensed distance matrix `distances` of `n` frames (as from `scipy.spatial.distance.pdist`), without forming the square matrix.
+    """
+    totals = np.zeros(members.size,dtype=float)
+    for k, i in enumerate(members):
+        i_low = np.minimum(members,i)
+        i_high = np.maximum(members,i)
+        index = n*i_low - i_low*(i_low+1)//2 + i_high - i_low - 1
+        totals[k] = np.sum(distances[index[members != i]])
+    return members[np.argmin(totals)]
+
+def sample_frames_rmsd_cluster(u, atoms, ref_positions, n_sample, offset = 0, weights = None, n_candidate = None, fit_index = None, verbose = False):
+    """
+    Indices of `n_sample` representative frames of trajectory of universe `u`, from RMSD clustering of a pool of candidate frames.
+
+    `n_candidate` frames (10 x `n_sample` by default) are spread evenly from frame `offset` to the last frame, and only those are decoded. 
+    The coordinates of `atoms` of the candidates are superposed onto `ref_positions` by the atoms `fit_index` of `atoms` (e.g. the C-alpha atoms, all atoms by default) 
+    with `superpose_frames`, the RMSD of the fitted atoms between every pair of superposed candidates (weighted by `weights`) is clustered 
+    into `n_sample` clusters by average linkage hierarchical clustering, and the medoid of each cluster, 
+    i.e. the frame with the smallest total RMSD to the other frames in the cluster, is taken as representative.
+
+    Only the condensed matrix of pairwise RMSD is stored. It returns the frames in increasing order, 
+    and the superposed coordinates of `atoms` in these frames, so they are not decoded again.
+    """
+    from scipy.cluster.hierarchy import linkage, cut_tree
+    from scipy.spatial.distance import pdist
+    n_frame = len(u.trajectory)
+    if n_candidate == None:
+        n_candidate = 10*n_sample
+    if fit_index is None:
+        fit_index = np.arange(len(atoms))
+    n_candidate = min(max(n_candidate,n_sample),n_frame-offset)
+    candidates = np.unique(np.linspace(offset,n_frame-1,n_candidate).astype(int))
+    if weights is None:
+        weights = np.ones(len(fit_index),dtype=float)
+    positions = np.zeros((candidates.size,len(atoms),3),dtype=np.float32)
+    for i, ts in enumerate(u.trajectory[candidates]):
+        if verbose:
+            sys.stdout.write("Reading candidate frames for clustering, t = %.1f\r"%ts.time)
+            sys.stdout.flush()
+        positions[i] = atoms.positions
+    superpose_frames(positions,fit_index,ref_positions,weights=weights)
+    if candidates.size <= n_sample:
+        return candidates, positions
+    # RMSD = Euclidean distance between coordinates scaled by sqrt of the normalized weights
+    scaled = positions[:,fit_index,:] * np.sqrt(np.asarray(weights,dtype=float)/np.sum(weights))[None,:,None]
+    distances = pdist(scaled.reshape(candidates.size,-1))
+    del scaled
+    labels = cut_tree(linkage(distances,method='average'),n_clusters=n_sample).ravel()
+    medoids = np.sort([condensed_medoid(distances,candidates.size,np.flatnonzero(labels == label)) for label in range(n_sample)])
+    return candidates[medoids], positions[medoids]
+
+def read_frames(u, mobile, mobile_index, frames, ref_positions, weights = None, prot = None, verbose = False):
+    """
+    Read the coordinates of atoms `mobile` of universe `u` in the frames `frames` (by random access to the trajectory), 
+    and superpose them onto `ref_positions` by the atoms `mobile_index` of `mobile` with `superpose_frames`. 
+    It returns an array of shape (n_frame, n_atom, 3) with the aligned coordinates.
+    """
+    positions = np.zeros((len(frames),len(mobile),3),dtype=np.float32)
+    for i_sample, ts in enumerate(u.trajectory[frames]):
+        if verbose:
+            sys.stdout.write("Reading frames for %s, t = %.1f\r"%(prot,ts.time))
+            sys.stdout.flush()
+        positions[i_sample] = mobile.positions
+    superpose_frames(positions,mobile_index,ref_positions,weights=weights)
+    return positions
+
+def write_frames_pdb(mobile, positions, directory_pdb, prot, i_start = 0, verbose = False):
+    """Write the frames `positions` of atoms `mobile` as PDB files `prot`_frame`i`.pdb in `directory_pdb`, numbered from `i_start`."""
+    for i_sample in range(positions.shape[0]):
+        if verbose:
+            sys.stdout.write("Writing pdb files for %s, frame %d\r"%(prot,i_start+i_sample))
+            sys.stdout.flush()
+        mobile.positions = positions[i_sample]
+        mobile.atoms.write('%s/%s_frame%d.pdb'%(directory_pdb,prot,i_start+i_sample))
+    return
+
+def read_aligned_chunk(prot, struct_file, traj_file, frames, ref_positions, weights = None, selection = 'protein', seqsel = None, align_frame = 0, directory_pdb = None, i_start = 0):
+    """
+    Read and align a chunk of frames `frames` of the trajectory in a worker process. 
+
+    The worker opens its own universe from `struct_file` and `traj_file`, selects the atoms as `read_aligned_frames` does, 
+    and aligns the frames onto the C-alpha coordinates `ref_positions` of the reference structure, weighted by `weights`.
+    If `directory_pdb` is provided, the aligned frames are also written as PDB files, numbered from `i_start`, 
+    the position of the chunk in the whole sample. It returns the aligned coordinates of the chunk.
+    """
+    u = mda.Universe(struct_file,traj_file)
+    u.trajectory[align_frame]
+    mobile = select_aligned_atoms(u,selection=selection,seqsel=seqsel)
+    mobile_index = np.searchsorted(mobile.ix,mobile.select_atoms('name CA').ix)
+    positions = read_frames(u,mobile,mobile_index,frames,ref_positions,weights=weights)
+    if directory_pdb != None:
+        write_frames_pdb(mobile,positions,directory_pdb,prot,i_start=i_start)
+    return positions
+
+def read_aligned_frames(prot, struct_file, traj_file, groundref, n_sample = 100, selection = 'protein', seqsel = None, align_frame = 0, offset = 0, sampling = 'stride', seed = None, frames = None, directory_pdb = None, parallel = False, n_core = -1, verbose = False):
+    """
+    Read `n_sample` frames drawn from the trajectory from frame `offset` on, 
+    and align each frame to the reference structure `groundref` by the C-alpha atoms, weighted by mass.
+
+    `seqsel` is the list of booleans for the residues from `sequence_alignment_selection` if the sequences are aligned, None otherwise. 
+    The selected atoms are determined once for all frames.
+
+    `sampling` is the strategy for drawing frames, "stride" (at even interval), "uniform", "random" (with `seed`) (see `sample_frames`), 
+    or "rmsd_cluster" (see `sample_frames_rmsd_cluster`). Alternatively, `frames` is the list of frames to read. 
+    Only the drawn frames are decoded, by random access to the trajectory. With "rmsd_cluster", the coordinates of the representative frames 
+    are kept from the clustering, so no frame is decoded twice, and the frames are written in serial.
+
+    The coordinates of the selected atoms of all frames are read first, then aligned at once with `superpose_frames`.
+    If `directory_pdb` is provided, the aligned frames are written as PDB files `prot`_frame`i`.pdb in `directory_pdb`, 
+    where `i` is the position of the frame in the sample.
+
+    If `parallel` is set to True, the drawn frames are split into `n_core` contiguous chunks, and each worker process 
+    opens its own universe to read, align (and write) its chunk (see `read_aligned_chunk`). The chunks are gathered in order, 
+    so the result and the file numbering are the same as in serial.
+
+    It returns the selected atoms (an `AtomGroup`), an array of shape (n_sample, n_atom, 3) with the aligned coordinates of the atoms in each frame, 
+    such that the frames can be written as PDB files or converted to meshes without going through files, and the array of frame indices.
+    """
+    u = mda.Universe(struct_file,traj_file)
+    u.trajectory[align_frame]
+    mobile = select_aligned_atoms(u,selection=selection,seqsel=seqsel)
+    mobileCA = mobile.select_atoms('name CA')
+    refCA = groundref.select_atoms('name CA')
+    if len(mobileCA) != len(refCA):
+        print("Number of C-alpha atoms of %s (%d) and of the reference structure (%d) differ!"%(prot,len(mobileCA),len(refCA)))
+        exit()
+    mobile_index = np.searchsorted(mobile.ix,mobileCA.ix) # atoms in `mobile` are ordered by index
+    
+    n_frame = len(u.trajectory)
+    
+    positions = None
+    if frames is None:
+        ## stride sampling wraps `offset` around the stride, other strategies draw from frame `offset` on
+        if n_sample > n_frame or (sampling != 'stride' and n_sample > n_frame - offset):
+            print("n_sample > number of frames in trajectory files!")
+            exit()
+        if sampling == 'rmsd_cluster':
+            ## the representative frames are read and superposed during clustering already
+            frames, positions = sample_frames_rmsd_cluster(u,mobile,refCA.positions,n_sample,offset=offset,weights=refCA.masses,fit_index=mobile_index,verbose=verbose)
+        else:
+            frames = sample_frames(n_frame,n_sample,offset=offset,sampling=sampling,seed=seed)
+    frames = np.asarray(frames,dtype=int)
+
+    if positions is None and parallel:
+        import multiprocessing
+        from joblib import Parallel, delayed
+        if n_core == -1:
+            n_core = multiprocessing.cpu_count()
+        chunks = np.array_split(frames,min(n_core,frames.size))
+        i_starts = np.cumsum([0]+[chunk.size for chunk in chunks[:-1]])
+        if verbose:
+            sys.stdout.write("Reading %d frames for %s in %d chunks...\r"%(frames.size,prot,len(chunks)))
+            sys.stdout.flush()
+        processed_list = Parallel(n_jobs=n_core)(delayed(read_aligned_chunk)(prot,struct_file,traj_file,chunk,refCA.positions,refCA.masses,selection,seqsel,align_frame,directory_pdb,i_start) for chunk, i_start in zip(chunks,i_starts))
+        positions = np.concatenate(processed_list,axis=0)
+    else:
+        if positions is None:
+            positions = read_frames(u,mobile,mobile_index,frames,refCA.positions,weights=refCA.masses,prot=prot,verbose=verbose)
+        if directory_pdb != None:
+            if verbose:
+                sys.stdout.write("\n")
+            write_frames_pdb(mobile,positions,directory_pdb,prot,verbose=verbose)
+    if verbose:
+        sys.stdout.write("\n") 
+    return mobile, positions, frames
+
+def reference_structure(struct_file_A, traj_file_A, align_frame = 0, selection = 'protein', seqselA = None):
+    """Reference structure for alignment, i.e. frame `align_frame` of protein A centered at the center of mass of its C-alpha atoms."""
+    refu = mda.Universe(struct_file_A,traj_file_A)
+    refu.trajectory[align_frame]
+    groundref = select_aligned_atoms(refu,selection=selection,seqsel=seqselA)
+    groundrefCA = groundref.select_atoms('name CA')
+    groundref.translate(-groundrefCA.center_of_mass())
+    return groundref
+
+def convert_traj_pdb_aligned(protA, protB, struct_file_A, traj_file_A, struct_file_B, traj_file_B, align_frame = 0, n_sample = 100, selection = None, directory = None, offset = 0, align_sequence = False, single = False, sampling = 'stride', seed = None, parallel = False, n_core = -1, verbose = False):
     """
     Convert MD simulation trajectory to aligned protein structures in PDB format
     
@@ -26,10 +299,17 @@ def convert_traj_pdb_aligned(protA, protB, struct_file_A, traj_file_A, struct_fi
     
     `offset` is the frame number to start drawing samples from the trajectory.
 
+    `sampling` is the strategy for drawing samples, "stride", "uniform", "random" (with `seed` for the random number generator) or "rmsd_cluster", 
+    see `read_aligned_frames`.
+
     If `align_sequence` is set to True, the program aligns the sequence using the Needleman-Wunsch algorithm implemented by MDAnalysis.
 
     If `single` is set to True, the program just names the folders containing the output files without the `offset` in the folder name.
 
+    The indices of the frames drawn are written to "`directory`/pdb/`prot`_frames.txt" (or "`prot`_offset_`offset`_frames.txt").
+
+    If `parallel` is set to True, the frames are read, aligned and written in contiguous chunks by `n_core` worker processes, see `read_aligned_frames`.
+
     If `verbose` is set to True, the program prints progress in command prompt.
     """
    
@@ -42,43 +322,15 @@ def convert_traj_pdb_aligned(protA, protB, struct_file_A, traj_file_A, struct_fi
     if not os.path.exists("%s/pdb"%directory):
         os.mkdir("%s/pdb"%directory)
     
-    seqselA = []
-    seqselB = []
-
     if selection == None:
         selection = 'protein'
 
     if align_sequence:
-        u_A = mda.Universe(struct_file_A).select_atoms(selection)
-        u_B = mda.Universe(struct_file_B).select_atoms(selection)
-        seq_align = align.sequence_alignment(u_A,u_B)
-        seqA = seq_align[1]
-        seqB = seq_align[0]
-        nres = seq_align[4]
-        for i in range(nres):
-            if seqA[i] != '-' and seqB[i] != '-':
-                seqselA.append(True)
-                seqselB.append(True)
-            elif seqA[i] == '-' and seqB[i] != '-':
-                seqselB.append(False)
-            elif seqB[i] == '-' and seqA[i] != '-':
-                seqselA.append(False)
-    refu = mda.Universe(struct_file_A,traj_file_A)
-    refu.trajectory[align_frame]
-
-    if align_sequence:
-        protein = refu.select_atoms(selection)
-        atoms_A = AtomGroup([],refu)
-        for i, a in enumerate(protein.residues):
-            if seqselA[i]:
-                atoms_A = atoms_A + a.atoms
-        groundref = atoms_A
-        groundrefCA = atoms_A.select_atoms('name CA')
+        seqselA, seqselB = sequence_alignment_selection(struct_file_A,struct_file_B,selection=selection)
     else:
-        groundref = refu.select_atoms(selection)
-        groundrefCA = refu.select_atoms('name CA and %s'%selection)
+        seqselA, seqselB = None, None
 
-    groundref.translate(-groundrefCA.center_of_mass())
+    groundref = reference_structure(struct_file_A,traj_file_A,align_frame=align_frame,selection=selection,seqselA=seqselA)
     
     for prot, seqsel, struct_file, traj_file in zip([protA,protB],[seqselA,seqselB],[struct_file_A,struct_file_B],[traj_file_A,traj_file_B]):
             
@@ -90,42 +342,85 @@ def convert_traj_pdb_aligned(protA, protB, struct_file_A, traj_file_A, struct_fi
         if not os.path.exists(directory_pdb):
             os.mkdir(directory_pdb)
 
-        u = mda.Universe(struct_file,traj_file)
-        u.trajectory[align_frame]
-        
-        rmsds = []
-        t = []
-        n_frame = len(u.trajectory)
-        
-        if n_sample > n_frame:
-            print("n_sample > number of frames in trajectory files!")
-            exit()
-        
-        nskip =  int(n_frame/n_sample)
-         
-        frame = 0
-        i_sample = 0
-        for ts in u.trajectory:
-            if (frame-offset) % nskip == 0:
-                if verbose:
-                    sys.stdout.write("Writing pdb files for %s, t = %.1f\r"%(prot,ts.time))
-                    sys.stdout.flush()
-                protein = u.select_atoms(selection)
-                if align_sequence:
-                    mobile = AtomGroup([],u)
-                    for i, a in enumerate(protein.residues):
-                        if seqsel[i]:
-                            mobile = mobile + a.atoms
-                else:
-                    mobile = protein.atoms
-                align.alignto(mobile,groundref,select="name CA",weights="mass")
-                mobile.atoms.write('%s/%s_frame%d.pdb'%(directory_pdb,prot,i_sample))
-                i_sample += 1
-                if i_sample == n_sample:
-                    break
-            frame += 1
-        if verbose:
-            sys.stdout.write("\n") 
+        mobile, positions, frames = read_aligned_frames(prot,struct_file,traj_file,groundref,n_sample=n_sample,selection=selection,seqsel=seqsel,align_frame=align_frame,offset=offset,sampling=sampling,seed=seed,directory_pdb=directory_pdb,parallel=parallel,n_core=n_core,verbose=verbose)
+        np.savetxt('%s_frames.txt'%directory_pdb,frames,fmt='%d')
+    return
+
+def convert_traj_mesh(protA, protB, struct_file_A, traj_file_A, struct_file_B, traj_file_B, sm_radius = 4.0, align_frame = 0, n_sample = 100, selection = None, directory = None, offset = 0, align_sequence = False, single = False, sampling = 'stride', seed = None, binary = False, ensemble = False, directory_mesh = None, parallel = False, n_core = -1, verbose = False):
+    """
+    Convert MD simulation trajectory directly to simplicial meshes of the aligned protein structures, without writing and parsing intermediate PDB files. 
+
+    Each trajectory is read once, the sampled frames are aligned in memory (see `read_aligned_frames`), the radius `rmax` for normalization 
+    is taken from the aligned coordinates, and the meshes are constructed from the coordinates. Only the meshes and the first frame of each protein 
+    (as PDB file for visualization, in the same folder as `convert_traj_pdb_aligned` would write it) are written.
+
+    The meshes are written to `directory_mesh` (default = `directory`/mesh/ as for `convert_pdb_mesh`), in the same layout as `convert_pdb_mesh`, 
+    i.e. as mesh ensemble files `protA`_`sm_radius`.emsh and `protB`_`sm_radius`.emsh if `ensemble` is set to True, or as folders 
+    `protA`_`sm_radius` and `protB`_`sm_radius` of mesh files (binary .bmsh files if `binary` is set to True) otherwise.
+
+    See `convert_traj_pdb_aligned` and `convert_pdb_mesh` for the other arguments.
+    """
+    if parallel:
+        import multiprocessing
+        from joblib import Parallel, delayed
+        if n_core == -1:    
+            n_core = multiprocessing.cpu_count()
+
+    if directory == None:
+        directory = "%s_%s"%(protA,protB)
+    if directory_mesh == None:
+        directory_mesh = "%s/mesh"%directory
+    for folder in [directory, "%s/pdb"%directory, directory_mesh]:
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+    
+    if selection == None:
+        selection = 'protein'
+
+    if align_sequence:
+        seqselA, seqselB = sequence_alignment_selection(struct_file_A,struct_file_B,selection=selection)
+    else:
+        seqselA, seqselB = None, None
+
+    groundref = reference_structure(struct_file_A,traj_file_A,align_frame=align_frame,selection=selection,seqselA=seqselA)
+
+    positions = []
+    for prot, seqsel, struct_file, traj_file in zip([protA,protB],[seqselA,seqselB],[struct_file_A,struct_file_B],[traj_file_A,traj_file_B]):
+        if not single:    
+            directory_pdb = "%s/pdb/%s_offset_%d"%(directory,prot,offset)
+        else:
+            directory_pdb = "%s/pdb/%s"%(directory,prot)
+        if not os.path.exists(directory_pdb):
+            os.mkdir(directory_pdb)
+        mobile, positions_prot, frames = read_aligned_frames(prot,struct_file,traj_file,groundref,n_sample=n_sample,selection=selection,seqsel=seqsel,align_frame=align_frame,offset=offset,sampling=sampling,seed=seed,parallel=parallel,n_core=n_core,verbose=verbose)
+        np.savetxt('%s_frames.txt'%directory_pdb,frames,fmt='%d')
+        mobile.positions = positions_prot[0]
+        mobile.atoms.write('%s/%s_frame0.pdb'%(directory_pdb,prot))
+        positions.append(positions_prot)
+
+    rmax = max([np.amax(np.linalg.norm(positions_prot,axis=2)) for positions_prot in positions])
+    if verbose:
+        sys.stdout.write('Rmax = %.3f\n'%rmax)
+
+    for prot, positions_prot in zip([protA,protB],positions):
+        if ensemble:
+            convert_vertices_mesh_ensemble("%s/%s_%.1f.emsh"%(directory_mesh,prot,sm_radius),positions_prot,sm_radius,rmax,parallel=parallel,n_core=n_core,verbose=verbose)
+        else:
+            directory_mesh_prot = "%s/%s_%.1f"%(directory_mesh,prot,sm_radius)
+            if not os.path.exists(directory_mesh_prot):
+                os.mkdir(directory_mesh_prot)
+            ext = 'bmsh' if binary else 'msh'
+            msh_files = ['%s/%s_frame%d.%s'%(directory_mesh_prot,prot,i_sample,ext) for i_sample in range(positions_prot.shape[0])]
+            if parallel:
+                Parallel(n_jobs=n_core)(delayed(convert_vertices_mesh)(vertices,sm_radius,rmax,msh_file) for vertices, msh_file in zip(positions_prot,msh_files))
+            else:
+                for vertices, msh_file in zip(positions_prot,msh_files):
+                    if verbose:
+                        sys.stdout.write('Constructing topology for %s...\r'%msh_file)
+                        sys.stdout.flush()
+                    convert_vertices_mesh(vertices,sm_radius,rmax,msh_file)
+    if verbose:
+        sys.stdout.write('\n')
     return
 
 def calc_radius_pdb(selection='protein',directory=None,prot=None,i_sample=None,directory_pdb=None,filename=None):
@@ -145,28 +440,117 @@ def calc_radius_pdb(selection='protein',directory=None,prot=None,i_sample=None,d
     meshA.vertices = protein.positions
     return meshA.calc_radius()
 
-def convert_pdb_mesh_single(sm_radius, rmax, directory = None, prot = None , i_sample = None, directory_mesh = None, directory_pdb = None, filename = None, selection='protein', verbose = False):
-    """Convert PDB structure to mesh by simplical construction."""
+def convert_pdb_mesh_single(sm_radius, rmax, directory = None, prot = None , i_sample = None, directory_mesh = None, directory_pdb = None, filename = None, selection='protein', binary = False, verbose = False):
+    """
+    Convert PDB structure to mesh by simplical construction, written as binary .bmsh file if `binary` is set to True.
+
+    The vertices are not normalized if `rmax` is None. In that case, for text mesh files, the unnormalized vertices are also saved 
+    at full precision to `msh_file`.npy, to be read by `mesh.normalize_mesh_file`. It returns the name of the mesh file and the radius of the mesh.
+    """
+    if binary:
+        ext = 'bmsh'
+    else:
+        ext = 'msh'
     if directory != None and prot != None and i_sample != None and directory_mesh != None:
         pdb_file = '%s/pdb/%s/%s_frame%d.pdb'%(directory,prot,prot,i_sample)
-        msh_file = '%s/%s_frame%d.msh'%(directory_mesh,prot,i_sample)
+        msh_file = '%s/%s_frame%d.%s'%(directory_mesh,prot,i_sample,ext)
         if verbose:
             sys.stdout.write('Constructing topology for %s for Frame %d...\r'%(prot,i_sample))
             sys.stdout.flush()
     if directory_mesh != None and directory_pdb != None and filename != None and prot != None:
         pdb_file = directory_pdb + '/' + filename
-        msh_file = '%s/%s.msh'%(directory_mesh,filename[:-4])
+        msh_file = '%s/%s.%s'%(directory_mesh,filename[:-4],ext)
         if verbose:
             sys.stdout.write('Constructing topology for %s for %s...\r'%(prot,filename))
             sys.stdout.flush()
+    meshA = convert_pdb_file_mesh(pdb_file,sm_radius,rmax,selection=selection)
+    meshA.write_mesh_file(filename=msh_file)
+    if rmax == None and not binary:
+        np.save(msh_file + '.npy',meshA.vertices)
+    return msh_file, meshA.calc_radius()
+
+def convert_pdb_file_mesh(pdb_file, sm_radius, rmax, selection='protein', msh_file=None):
+    """
+    Convert PDB structure file to mesh by simplical construction, the mesh is written to `msh_file` if provided and returned otherwise.
+
+    If `rmax` is None, the vertices are not normalized, so that the mesh can be normalized afterwards (see `mesh.normalize_mesh_file`).
+    """
     u = mda.Universe(pdb_file)
     protein = u.select_atoms(selection)
     meshA = mesh()
     meshA.vertices = protein.positions
+    if rmax == None:
+        rmax = 1.0
     meshA.convert_vertices_to_mesh(sm_radius=sm_radius,msh_file=msh_file,rmax=rmax)
+    if msh_file == None:
+        return meshA
     return
 
-def convert_pdb_mesh(protA = "protA", protB = "protB", n_sample = 101, sm_radius = 4.0, directory_pdb_A = None, directory_pdb_B = None, directory_mesh = None, parallel = False, n_core = -1, verbose = False):
+def convert_vertices_mesh(vertices, sm_radius, rmax, msh_file=None):
+    """Convert an array of vertex coordinates to mesh by simplical construction, the mesh is written to `msh_file` if provided and returned otherwise."""
+    meshA = mesh()
+    meshA.vertices = np.array(vertices,dtype=float)
+    meshA.convert_vertices_to_mesh(sm_radius=sm_radius,msh_file=msh_file,rmax=rmax)
+    if msh_file == None:
+        return meshA
+    return
+
+def convert_vertices_mesh_ensemble(ensemble_file, positions, sm_radius, rmax, parallel = False, n_core = -1, verbose = False):
+    """
+    Convert the coordinates `positions` of shape (n_frame, n_vertex, 3) to meshes, stored as frames of a mesh ensemble (.emsh) file, 
+    in batches of 16 frames per core in parallel, see `convert_pdb_mesh_ensemble`.
+    """
+    if parallel:
+        import multiprocessing
+        from joblib import Parallel, delayed
+        if n_core == -1:    
+            n_core = multiprocessing.cpu_count()
+        n_batch = 16*n_core
+    else:
+        n_batch = 1
+    with mesh_ensemble(ensemble_file,mode='w') as ensemble:
+        for i_start in range(0,len(positions),n_batch):
+            if verbose:
+                sys.stdout.write('Constructing topology for %s frame %d...\r'%(ensemble_file,i_start))
+                sys.stdout.flush()
+            if parallel:
+                meshes = Parallel(n_jobs=n_core)(delayed(convert_vertices_mesh)(vertices,sm_radius,rmax) for vertices in positions[i_start:i_start+n_batch])
+            else:
+                meshes = [convert_vertices_mesh(vertices,sm_radius,rmax) for vertices in positions[i_start:i_start+n_batch]]
+            ensemble.extend(meshes)
+    return
+
+def convert_pdb_mesh_ensemble(ensemble_file, pdb_files, sm_radius, rmax, selection='protein', parallel = False, n_core = -1, verbose = False):
+    """
+    Convert a list of PDB structure files to meshes, stored in the same order as frames of a mesh ensemble (.emsh) file.
+
+    In parallel, structures are converted in batches of 16 structures per core, and the meshes of each batch are appended to the file by the main process.
+
+    The vertices are not normalized if `rmax` is None. It returns the list of radii of the meshes.
+    """
+    if parallel:
+        import multiprocessing
+        from joblib import Parallel, delayed
+        if n_core == -1:    
+            n_core = multiprocessing.cpu_count()
+        n_batch = 16*n_core
+    else:
+        n_batch = 1
+    r = []
+    with mesh_ensemble(ensemble_file,mode='w') as ensemble:
+        for i_start in range(0,len(pdb_files),n_batch):
+            if verbose:
+                sys.stdout.write('Constructing topology for %s...\r'%pdb_files[i_start])
+                sys.stdout.flush()
+            if parallel:
+                meshes = Parallel(n_jobs=n_core)(delayed(convert_pdb_file_mesh)(pdb_file,sm_radius,rmax,selection) for pdb_file in pdb_files[i_start:i_start+n_batch])
+            else:
+                meshes = [convert_pdb_file_mesh(pdb_file,sm_radius,rmax,selection) for pdb_file in pdb_files[i_start:i_start+n_batch]]
+            ensemble.extend(meshes)
+            r.extend([meshA.calc_radius() for meshA in meshes])
+    return r
+
+def convert_pdb_mesh(protA = "protA", protB = "protB", n_sample = 101, sm_radius = 4.0, directory_pdb_A = None, directory_pdb_B = None, directory_mesh = None, binary = False, ensemble = False, parallel = False, n_core = -1, verbose = False):
     """
     Convert the aligned protein structures in PDB format (e.g. from "convert_traj_pdb_aligned") to simplicial meshes
     
@@ -176,7 +560,13 @@ def convert_pdb_mesh(protA = "protA", protB = "protB", n_sample = 101, sm_radius
     
     `directory_pdb_B` is the directory for the input pdb files, default = protA_protB/pdb/protB if not specified.
     
-    `directory_mesh` is the directory for the input pdb files, default = protA_protB/mesh/ if not specified.
+    `directory_mesh` is the directory for the output mesh files, default = protA_protB/mesh/ if not specified.
+
+    If `binary` is set to True, meshes are written as binary .bmsh files instead of text .msh files.
+
+    If `ensemble` is set to True, meshes of each protein are written as frames of a single mesh ensemble file (see `mesh_ensemble`), 
+    i.e. `directory_mesh`/protA_`sm_radius`.emsh and `directory_mesh`/protB_`sm_radius`.emsh, instead of one file per structure. 
+    Frames are ordered by sample number, or by sorted filename if `directory_pdb_A` and `directory_pdb_B` are provided.
     """
 
     if parallel:
@@ -202,57 +592,49 @@ def convert_pdb_mesh(protA = "protA", protB = "protB", n_sample = 101, sm_radius
             if not os.path.exists(directory_mesh):
                 os.mkdir(directory_mesh)
 
-    r = np.array([])
     if verbose:
-        sys.stdout.write('Calculating sphere radius...\n')
-    if directory_pdb_A == None or directory_pdb_B == None:
-        for prot in [protA, protB]:
-            if parallel:
-                r_prots = Parallel(n_jobs=n_core)(delayed(calc_radius_pdb)(selection='protein',directory=directory,prot=prot,i_sample=i_sample) for i_sample in range(n_sample))
-                r = np.append(r,r_prots)
-            else:
-                for i_sample in range(n_sample):
-                    r_prots = calc_radius_pdb(selection='protein',directory=directory,prot=prot,i_sample=i_sample)
-                    r = np.append(r,r_prots)
-    else:
-        for directory_pdb in [directory_pdb_A,directory_pdb_B]:
-            if parallel:
-                r_prots = Parallel(n_jobs=n_core)(delayed(calc_radius_pdb)(selection='protein',directory_pdb=directory_pdb,filename=filename) for filename in os.listdir(directory_pdb))
-                r = np.append(r,r_prots)
-            else:
-                r_prots = []
-                for filename in os.listdir(directory_pdb):
-                    r_prot = calc_radius_pdb(selection='protein',directory_pdb=directory_pdb,filename=filename)
-                    r_prots.append(r_prot)
-                r = np.append(r,r_prots)
-            if len(r_prots) == 0:
+        sys.stdout.write('Constructing topology...\n')
+    r = []
+    msh_files = []
+    for prot, directory_pdb in zip([protA,protB],[directory_pdb_A,directory_pdb_B]):
+        if directory_pdb_A == None or directory_pdb_B == None:
+            pdb_files = ['%s/pdb/%s/%s_frame%d.pdb'%(directory,prot,prot,i_sample) for i_sample in range(n_sample)]
+        else:
+            pdb_files = [directory_pdb + '/' + filename for filename in sorted(os.listdir(directory_pdb)) if filename.endswith(".pdb")]
+            if len(pdb_files) == 0:
                 print("Folder %s is emply or contain no PDB files!"%directory_pdb)
                 exit()
+        if ensemble:
+            ensemble_file = '%s/%s_%.1f.emsh'%(directory_mesh,prot,sm_radius)
+            r += convert_pdb_mesh_ensemble(ensemble_file,pdb_files,sm_radius,None,selection='protein',parallel=parallel,n_core=n_core,verbose=verbose)
+            msh_files.append(ensemble_file)
+            continue
+        directory_mesh_prot = '%s/%s_%.1f/'%(directory_mesh,prot,sm_radius)
+        if not os.path.exists(directory_mesh_prot):
+            os.mkdir(directory_mesh_prot)
+        if directory_pdb_A == None or directory_pdb_B == None:
+            arguments = [dict(directory=directory,prot=prot,i_sample=i_sample,directory_mesh=directory_mesh_prot) for i_sample in range(n_sample)]
+        else:
+            arguments = [dict(directory_pdb=directory_pdb,filename=os.path.basename(pdb_file),directory_mesh=directory_mesh_prot,prot=prot) for pdb_file in pdb_files]
+        if parallel:
+            processed_list = Parallel(n_jobs=n_core)(delayed(convert_pdb_mesh_single)(sm_radius=sm_radius,rmax=None,selection='protein',binary=binary,verbose=verbose,**argument) for argument in arguments)
+        else:
+            processed_list = [convert_pdb_mesh_single(sm_radius=sm_radius,rmax=None,selection='protein',binary=binary,verbose=verbose,**argument) for argument in arguments]
+        for msh_file, radius in processed_list:
+            msh_files.append(msh_file)
+            r.append(radius)
 
+    ## normalize all meshes by the radius of the largest structure, in place
+    ## text meshes are normalized from the full precision vertices saved with them, as in a single pass with known rmax
     rmax = np.amax(r)
     if verbose:
-        sys.stdout.write('Rmax = %.3f\n'%rmax)
-    
-    if directory_pdb_A == None or directory_pdb_B == None:
-        for prot in [protA, protB]:
-            directory_mesh = "%s/mesh/%s_%.1f/"%(directory,prot,sm_radius)
-            if not os.path.exists(directory_mesh):
-                os.mkdir(directory_mesh)
-            if parallel:
-                tmp = Parallel(n_jobs=n_core)(delayed(convert_pdb_mesh_single)(sm_radius=sm_radius,rmax=rmax,directory=directory,prot=prot,i_sample=i_sample,directory_mesh=directory_mesh,selection='protein',verbose=verbose) for i_sample in range(n_sample)) 
-            else:
-                for i_sample in range(n_sample): 
-                    convert_pdb_mesh_single(sm_radius=sm_radius,rmax=rmax,directory=directory,prot=prot,i_sample=i_sample,directory_mesh=directory_mesh,selection='protein',verbose=verbose)
+        sys.stdout.write('\nRmax = %.3f\n'%rmax)
+    vertices_files = [None if binary or ensemble else msh_file + '.npy' for msh_file in msh_files]
+    if parallel and not ensemble:
+        Parallel(n_jobs=n_core)(delayed(normalize_mesh_file)(msh_file,rmax,vertices_file) for msh_file, vertices_file in zip(msh_files,vertices_files))
     else:
-        for prot, directory_pdb in zip([protA,protB],[directory_pdb_A,directory_pdb_B]):
-            directory_mesh_prot = '%s/%s_%.1f/'%(directory_mesh,prot,sm_radius)
-            if not os.path.exists(directory_mesh_prot):
-                os.mkdir(directory_mesh_prot)
-            if parallel:
-                tmp = Parallel(n_jobs=n_core)(delayed(convert_pdb_mesh_single)(sm_radius=sm_radius,rmax=rmax,directory_pdb=directory_pdb,filename=filename,directory_mesh=directory_mesh_prot,prot=prot,selection='protein',verbose=verbose) for filename in os.listdir(directory_pdb))
-            else:
-                for filename in os.listdir(directory_pdb):
-                    convert_pdb_mesh_single(sm_radius=sm_radius,rmax=rmax,directory_pdb=directory_pdb,filename=filename,directory_mesh=directory_mesh_prot,prot=prot,selection='protein',verbose=verbose)
+        for msh_file, vertices_file in zip(msh_files,vertices_files):
+            normalize_mesh_file(msh_file,rmax,vertices_file)
     if verbose:
         sys.stdout.write('\n')
 
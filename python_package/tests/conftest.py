@@ -0,0 +1,31 @@
+import os, sys
+import pytest
+
+## run the tests against the source tree without installing the package
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','src'))
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),'WT_R164S_65_230_2.0')
+"""Test data, aligned PDB structures and meshes of 10 frames of WT and R164S"""
+
+def load_test_mesh(prot = 'WT', frame = 0):
+    """Read frame `frame` of the meshes of `prot` in the test data"""
+    from sinatra_pro.mesh import mesh
+    meshA = mesh()
+    meshA.read_mesh_file(filename=os.path.join(DATA_DIR,'msh_offset_0','%s_2.0'%prot,'%s_frame%d.msh'%(prot,frame)))
+    return meshA
+
+@pytest.fixture
+def trajectories(tmp_path):
+    """Trajectories made of the 10 aligned PDB structures of each protein in the test data"""
+    mda = pytest.importorskip('MDAnalysis')
+    files = {}
+    for prot in ['WT','R164S']:
+        directory_pdb = os.path.join(DATA_DIR,'pdb','%s_offset_0'%prot)
+        pdb_files = [os.path.join(directory_pdb,'%s_frame%d.pdb'%(prot,i)) for i in range(10)]
+        u = mda.Universe(pdb_files[0],pdb_files)
+        traj_file = str(tmp_path/('%s.dcd'%prot))
+        with mda.Writer(traj_file,u.atoms.n_atoms) as writer:
+            for ts in u.trajectory:
+                writer.write(u.atoms)
+        files[prot] = (pdb_files[0],traj_file)
+    return files
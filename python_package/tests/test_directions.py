@@ -0,0 +1,104 @@
+import os
+import numpy as np
+import pytest
+
+from conftest import DATA_DIR
+from sinatra_pro.directions import *
+import sinatra_pro.directions
+
+def rodrigues_loop(z, r, j):
+    """Directions about a cone with the loop of the original code"""
+    z = z / np.linalg.norm(z)
+    z0 = np.zeros(3)
+    if np.any(z == 0):
+        z0[z == 0] = 1
+    else:
+        z0[0] = 2/z[0]
+        z0[1] = -1/z[1]
+        z0[2] = -1/z[2]
+    z0 /= np.linalg.norm(z0)
+    z0 *= r
+    z0 = z + z0
+    z0 /= np.linalg.norm(z0)
+    B = np.cross(z,z0)
+    C = np.dot(z,z0)*z
+    directions = np.zeros((j,3))
+    for i in range(j):
+        x = 2*np.pi*(i+1)/j
+        directions[i,:] = z0*np.cos(x)+B*np.sin(x)+C*(1-np.cos(x))
+    return directions
+
+def equidistributed_points_loop(desired_number, N, hemisphere = False):
+    """Equidistributed points with the loops and recursion of the original code"""
+    if hemisphere:
+        a = 2*np.pi/N
+        d = np.sqrt(a)
+        M_theta = int(round(np.pi*.5/d))
+        d_theta = np.pi*.5/M_theta
+    else:
+        a = 4*np.pi/N
+        d = np.sqrt(a)
+        M_theta = int(round(np.pi/d))
+        d_theta = np.pi/M_theta
+    d_phi = a/d_theta
+    points = []
+    for i in range(M_theta):
+        if hemisphere:
+            theta = np.pi * .5 * i / M_theta
+        else:
+            theta = np.pi * (i + 0.5) / M_theta
+        M_phi = int(round(2*np.pi*np.sin(theta)/d_phi))
+        for j in range(M_phi):
+            phi = 2*np.pi*j/M_phi
+            point = [np.sin(theta)*np.cos(phi),np.sin(theta)*np.sin(phi),np.cos(theta)]
+            point /= np.linalg.norm(point)
+            points.append(point)
+    points = np.array(points)
+    if points.shape[0] < desired_number:
+        return equidistributed_points_loop(desired_number,N+1,hemisphere)
+    return points
+
+def equidistributed_cones_loop(n_cone, cap_radius, n_direction_per_cone, hemisphere):
+    sphere = equidistributed_points_loop(n_cone,n_cone,hemisphere)
+    directions = []
+    for i in range(n_cone):
+        directions.append(sphere[i]/np.linalg.norm(sphere[i]))
+        if n_direction_per_cone > 1:
+            for direction in rodrigues_loop(sphere[i],cap_radius,n_direction_per_cone-1):
+                direction /= np.linalg.norm(direction)
+                directions.append(direction)
+    return np.array(directions)
+
+@pytest.mark.parametrize('hemisphere',[False,True])
+@pytest.mark.parametrize('n_point',[1,5,16,40,100])
+def test_equidistributed_points_match_loop(n_point, hemisphere):
+    np.testing.assert_array_equal(generate_equidistributed_points(n_point,n_point,hemisphere),equidistributed_points_loop(n_point,n_point,hemisphere))
+
+@pytest.mark.parametrize('hemisphere',[False,True])
+@pytest.mark.parametrize('n_cone,n_direction_per_cone',[(1,1),(5,3),(16,8),(40,4)])
+def test_equidistributed_cones_match_loop(n_cone, n_direction_per_cone, hemisphere):
+    directions = generate_equidistributed_cones(n_cone,cap_radius=0.8,n_direction_per_cone=n_direction_per_cone,hemisphere=hemisphere)
+    np.testing.assert_array_equal(directions,equidistributed_cones_loop(n_cone,0.8,n_direction_per_cone,hemisphere))
+    ## directions of the test data
+    if n_cone == 1 and n_direction_per_cone == 1 and not hemisphere:
+        np.testing.assert_array_equal(directions,np.loadtxt(os.path.join(DATA_DIR,'directions_1_1_0.80.txt'),ndmin=2))
+
+def test_cone_cache_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(sinatra_pro.directions,'cone_cache',{})
+    cache_dir = str(tmp_path/'directions')
+    directions = load_equidistributed_cones(5,cap_radius=0.8,n_direction_per_cone=3,cache_dir=cache_dir)
+    np.testing.assert_array_equal(directions,generate_equidistributed_cones(5,cap_radius=0.8,n_direction_per_cone=3))
+    assert [f for f in os.listdir(cache_dir) if not f.endswith('.npy')] == []
+    ## copies are returned, so changing them does not change the cached directions
+    directions[:] = 0
+    expected = generate_equidistributed_cones(5,cap_radius=0.8,n_direction_per_cone=3)
+    np.testing.assert_array_equal(load_equidistributed_cones(5,cap_radius=0.8,n_direction_per_cone=3),expected)
+    ## a new process reads the directions from the file instead of generating them
+    monkeypatch.setattr(sinatra_pro.directions,'cone_cache',{})
+    def fail(*args, **kwargs):
+        raise AssertionError("directions generated despite the cache file")
+    monkeypatch.setattr(sinatra_pro.directions,'generate_equidistributed_cones',fail)
+    np.testing.assert_array_equal(load_equidistributed_cones(5,cap_radius=0.8,n_direction_per_cone=3,cache_dir=cache_dir),expected)
+    ## other parameters are not read from the file of these ones
+    with pytest.raises(AssertionError):
+        load_equidistributed_cones(5,cap_radius=0.5,n_direction_per_cone=3,cache_dir=cache_dir)
@@ -0,0 +1,164 @@
+import os, shutil
+import numpy as np
+import pytest
+
+from conftest import DATA_DIR, load_test_mesh
+from sinatra_pro.euler import *
+
+def random_directions(n_direction = 8, seed = 0):
+    directions = np.random.RandomState(seed).normal(size=(n_direction,3))
+    return directions / np.linalg.norm(directions,axis=1)[:,None]
+
+@pytest.mark.parametrize('ec_type',['ECT','DECT','SECT'])
+@pytest.mark.parametrize('include_faces',[True,False])
+def test_batched_ec_matches_single_direction(ec_type, include_faces):
+    meshA = load_test_mesh()
+    directions = random_directions()
+    t, eulers = compute_ec_curve(meshA,directions,n_filtration=20,ec_type=ec_type,include_faces=include_faces)
+    t_batched, eulers_batched = compute_ec_curves_batched(meshA,directions,n_filtration=20,ec_type=ec_type,include_faces=include_faces,n_direction_block=3)
+    assert np.array_equal(t,t_batched)
+    assert np.array_equal(eulers,eulers_batched)
+
+@pytest.mark.parametrize('ec_type',['ECT','DECT','SECT'])
+@pytest.mark.parametrize('n_filtration',[10,25])
+def test_step_function_curves_match_batched(ec_type, n_filtration):
+    meshA = load_test_mesh()
+    directions = random_directions()
+    steps = compute_ec_step_function(meshA,directions,n_direction_block=3)
+    t, eulers = steps.curves(n_filtration=n_filtration,ec_type=ec_type)
+    t_batched, eulers_batched = compute_ec_curves_batched(meshA,directions,n_filtration=n_filtration,ec_type=ec_type)
+    assert np.array_equal(t,t_batched)
+    assert np.array_equal(eulers,eulers_batched)
+
+def brute_force_ec(meshA, direction, thresholds):
+    """EC of the closed sub-level sets counted simplex by simplex"""
+    heights = meshA.vertices @ direction
+    edge_heights = np.amax(heights[meshA.edges],axis=1)
+    face_heights = np.amax(heights[meshA.faces],axis=1)
+    return np.array([np.sum(heights <= t) - np.sum(edge_heights <= t) + np.sum(face_heights <= t) for t in thresholds],dtype=float)
+
+def test_step_function_exact_ec_and_integral():
+    meshA = load_test_mesh()
+    directions = random_directions(3)
+    steps = compute_ec_step_function(meshA,directions)
+    thresholds = np.linspace(-1.1,1.1,101)
+    eulers = steps.ect(thresholds)
+    for i, direction in enumerate(directions):
+        assert np.array_equal(eulers[i],brute_force_ec(meshA,direction,thresholds))
+    ## the EC is constant between the critical values, so a midpoint sum over a fine grid converges to the exact integral
+    grid = np.linspace(-0.5,0.5,200001)
+    midpoints = 0.5*(grid[1:]+grid[:-1])
+    integral = np.sum(steps.ect(midpoints),axis=1)*(grid[1]-grid[0])
+    assert np.allclose(steps.integral(-0.5,0.5),integral,rtol=0,atol=1e-3)
+
+def copy_test_meshes(directory, n_frame = 3):
+    """Copies of the first `n_frame` meshes of WT in the test data, as (mesh file, frame) pairs"""
+    os.makedirs(directory,exist_ok=True)
+    for frame in range(n_frame):
+        shutil.copy(os.path.join(DATA_DIR,'msh_offset_0','WT_2.0','WT_frame%d.msh'%frame),directory)
+    return list_mesh_frames(directory)
+
+def test_ec_cache_hit(tmp_path, monkeypatch):
+    mesh_frames = copy_test_meshes(str(tmp_path/'msh'))
+    directions = random_directions()
+    cache_dir = str(tmp_path/'cache')
+    expected = compute_ec_curve_frames(mesh_frames,directions,n_filtration=20,ec_type='DECT')
+    assert np.array_equal(compute_ec_curve_frames(mesh_frames,directions,n_filtration=20,ec_type='DECT',cache_dir=cache_dir),expected)
+    assert len(os.listdir(cache_dir)) == len(mesh_frames)
+    ## cached meshes are neither read nor computed again, and the key depends on the content of the mesh, not on the file name
+    shutil.copy(mesh_frames[0][0],str(tmp_path/'msh'/'copy.msh'))
+    def fail(*args, **kwargs):
+        raise AssertionError("EC curves computed despite a cache hit")
+    monkeypatch.setattr(mesh,'read_mesh_file',fail)
+    monkeypatch.setattr(sys.modules['sinatra_pro.euler'],'compute_ec_curves_batched',fail)
+    ecs = compute_ec_curve_frames(mesh_frames+[(str(tmp_path/'msh'/'copy.msh'),None)],directions,n_filtration=20,ec_type='DECT',cache_dir=cache_dir)
+    assert np.array_equal(ecs[:-1],expected)
+    assert np.array_equal(ecs[-1],expected[0])
+
+def test_ec_cache_keys(tmp_path):
+    mesh_frames = copy_test_meshes(str(tmp_path/'msh'),n_frame=2)
+    cache = ec_cache(str(tmp_path/'cache'))
+    directions = random_directions()
+    parameters = dict(n_filtration=20,ball_radius=1.0,ec_type='ECT',include_faces=True)
+    key = cache.parameter_key(directions,**parameters)
+    assert cache.parameter_key(directions.copy(),**parameters) == key
+    other_directions = directions.copy()
+    other_directions[0,0] = np.nextafter(other_directions[0,0],np.inf)
+    assert cache.parameter_key(other_directions,**parameters) != key
+    assert cache.parameter_key(directions[:-1],**parameters) != key
+    for name, value in [('n_filtration',21),('ball_radius',1.5),('ec_type','DECT'),('include_faces',False)]:
+        assert cache.parameter_key(directions,**dict(parameters,**{name:value})) != key
+    assert cache.mesh_key(mesh_frames[0][0]) != cache.mesh_key(mesh_frames[1][0])
+    ## changed parameters add new entries with the EC curves of the new parameters
+    cache_dir = str(tmp_path/'cache')
+    compute_ec_curve_frames(mesh_frames,directions,n_filtration=20,cache_dir=cache_dir)
+    for n_filtration, ec_directions in [(20,other_directions),(15,directions)]:
+        ecs = compute_ec_curve_frames(mesh_frames,ec_directions,n_filtration=n_filtration,cache_dir=cache_dir)
+        assert np.array_equal(ecs,compute_ec_curve_frames(mesh_frames,ec_directions,n_filtration=n_filtration))
+    assert len(os.listdir(cache_dir)) == 3*len(mesh_frames)
+
+def test_ec_cache_lru_eviction(tmp_path):
+    cache = ec_cache(str(tmp_path/'cache'))
+    ec = np.zeros((8,20))
+    for i in range(4):
+        cache.put('mesh%d'%i,'key',ec)
+        ## entries written one after another, from least to most recently used
+        os.utime(cache.filename('mesh%d'%i,'key'),(1000+i,1000+i))
+    entry_size = os.path.getsize(cache.filename('mesh0','key'))
+    assert cache.get('mesh0','key') is not None
+    ec_cache(cache.directory,max_size=2*entry_size).evict()
+    assert sorted(os.listdir(cache.directory)) == sorted(os.path.basename(cache.filename('mesh%d'%i,'key')) for i in [0,3])
+    assert cache.get('mesh1','key') is None
+    ec_cache(cache.directory).evict()
+    assert len(os.listdir(cache.directory)) == 2
+
+@pytest.mark.parametrize('parallel',[False,True])
+def test_sparse_path_matches_dense(parallel):
+    from sinatra_pro.gp import CovarianceMatrix
+    from sinatra_pro.RATE import RATE
+    directory_mesh = {prot:os.path.join(DATA_DIR,'msh_offset_0','%s_2.0'%prot) for prot in ['WT','R164S']}
+    directions = random_directions(6)
+    mesh_frames = list_mesh_frames(directory_mesh['WT']) + list_mesh_frames(directory_mesh['R164S'])
+    ecs = compute_ec_curve_frames(mesh_frames,directions,n_filtration=20,ec_type='DECT')
+    ecs_sparse, not_vacuum_sparse = compute_ec_curve_frames_sparse(mesh_frames,directions,n_filtration=20,ec_type='DECT')
+    assert np.array_equal(ecs_sparse.toarray(),ecs)
+    assert np.array_equal(not_vacuum_sparse,np.any(ecs != 0,axis=0))
+    data, not_vacuum = compute_ec_curve_folder(directions=directions,ec_type='DECT',n_filtration=20,directory_mesh_A=directory_mesh['WT'],directory_mesh_B=directory_mesh['R164S'],parallel=parallel,n_core=2)[::2]
+    data_sparse, label, not_vacuum_sparse = compute_ec_curve_folder(directions=directions,ec_type='DECT',n_filtration=20,directory_mesh_A=directory_mesh['WT'],directory_mesh_B=directory_mesh['R164S'],parallel=parallel,n_core=2,sparse=True)
+    assert np.array_equal(not_vacuum_sparse,not_vacuum)
+    ## sparse features are scaled but not centered
+    dense = data_sparse.toarray()
+    np.testing.assert_allclose(dense - np.mean(dense,axis=0),data,rtol=0,atol=1e-13)
+    np.testing.assert_allclose(standardize_ec_features_sparse(ecs_sparse)[0].toarray(),dense,rtol=0,atol=1e-13)
+    K = CovarianceMatrix(data.T,bandwidth=1.0)
+    np.testing.assert_allclose(CovarianceMatrix(data_sparse.T,bandwidth=1.0),K,rtol=0,atol=1e-13)
+    f_draws = np.random.RandomState(0).multivariate_normal(label - 0.5,K,size=200)
+    kld, rates, delta, eff_samp_size = RATE(data,f_draws=f_draws)
+    kld_sparse, rates_sparse, delta_sparse, eff_samp_size_sparse = RATE(data_sparse,f_draws=f_draws)
+    np.testing.assert_allclose(kld_sparse,kld,rtol=1e-9,atol=1e-12)
+    np.testing.assert_allclose(rates_sparse,rates,rtol=1e-9,atol=1e-12)
+
+@pytest.mark.parametrize('ensemble',[False,True])
+def test_ec_parallel_matches_serial(tmp_path, ensemble):
+    directory_mesh = {prot:os.path.join(DATA_DIR,'msh_offset_0','%s_2.0'%prot) for prot in ['WT','R164S']}
+    if ensemble:
+        for prot in ['WT','R164S']:
+            convert_mesh_folder_to_ensemble(directory_mesh[prot],str(tmp_path/('%s_2.0.emsh'%prot)))
+            directory_mesh[prot] = str(tmp_path/('%s_2.0.emsh'%prot))
+    directions = random_directions(6)
+    arguments = dict(directions=directions,ec_type='DECT',n_filtration=20,directory_mesh_A=directory_mesh['WT'],directory_mesh_B=directory_mesh['R164S'])
+    data, label, not_vacuum = compute_ec_curve_folder(**arguments)
+    data_parallel, label_parallel, not_vacuum_parallel = compute_ec_curve_folder(parallel=True,n_core=2,temp_dir=str(tmp_path),**arguments)
+    assert np.array_equal(data_parallel,data)
+    assert np.array_equal(label_parallel,label)
+    assert np.array_equal(not_vacuum_parallel,not_vacuum)
+    ## the memory-mapped matrix of the workers is removed
+    assert not any(filename.startswith('sinatra_ec_') for filename in os.listdir(str(tmp_path)))
+    ## rows written by chunks into a shared matrix file
+    mesh_frames = list_mesh_frames(directory_mesh['WT']) + list_mesh_frames(directory_mesh['R164S'])
+    ecs = compute_ec_curve_frames(mesh_frames,directions,n_filtration=20,ec_type='DECT')
+    ec_file = str(tmp_path/'ec.npy')
+    np.save(ec_file,np.zeros_like(ecs))
+    for i_start, i_end in [(0,7),(7,20)]:
+        compute_ec_curve_frames(mesh_frames[i_start:i_end],directions,n_filtration=20,ec_type='DECT',out=ec_file,row_start=i_start)
+    assert np.array_equal(np.load(ec_file),ecs)
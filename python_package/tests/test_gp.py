@@ -0,0 +1,126 @@
+import os
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+
+from conftest import DATA_DIR
+from sinatra_pro.gp import *
+
+def design_matrix():
+    """EC features of the test data, features in rows and observations in columns"""
+    X = np.loadtxt(os.path.join(DATA_DIR,'DECT_WT_R164S_1_1_0.80_20_norm_offset_0.txt'))
+    return X.T
+
+@pytest.mark.parametrize('block_size',[None,3,7])
+@pytest.mark.parametrize('n_core',[1,2])
+def test_covariance_matrix_matches_old(block_size, n_core):
+    x = design_matrix()
+    K_old = CovarianceMatrix_old(x,bandwidth=1.0)
+    K = CovarianceMatrix(x,bandwidth=1.0,block_size=block_size,n_core=n_core)
+    assert np.allclose(K,K_old,rtol=0,atol=1e-12)
+    assert np.array_equal(K,K.T)
+    assert np.all(np.diagonal(K) == 1)
+
+def test_covariance_matrix_single_precision():
+    x = design_matrix()
+    K = CovarianceMatrix(x,bandwidth=1.0,single_precision=True)
+    assert np.allclose(K,CovarianceMatrix_old(x,bandwidth=1.0),rtol=0,atol=1e-5)
+
+def test_covariance_matrix_sparse():
+    x = np.random.RandomState(0).normal(size=(40,12)) * (np.random.RandomState(1).uniform(size=(40,12)) < 0.3)
+    K = CovarianceMatrix(csr_matrix(x),bandwidth=1.0,block_size=5)
+    assert np.allclose(K,CovarianceMatrix_old(x,bandwidth=1.0),rtol=0,atol=1e-12)
+
+def labels():
+    return np.loadtxt(os.path.join(DATA_DIR,'WT_R164S_label.txt'))
+
+def kernel():
+    return CovarianceMatrix(design_matrix(),bandwidth=1.0)
+
+def test_cholesky_factor_matches_numpy():
+    K = kernel()
+    assert np.array_equal(cholesky_factor(K),np.linalg.cholesky(K))
+    ## samples from the prior with the factor are the same as with the Cholesky factor of numpy
+    y = labels()
+    assert np.array_equal(Elliptical_Slice_Sampling(K,y,n_mcmc=50,burn_in=10,seed=1),Elliptical_Slice_Sampling(K,y,n_mcmc=50,burn_in=10,seed=1,L=np.linalg.cholesky(K)))
+
+def test_cholesky_factor_not_positive_definite():
+    rng = np.random.default_rng(0)
+    ## singular covariance, factorized with a small jitter on the diagonal
+    A = rng.normal(size=(12,4))
+    K = A @ A.T
+    with pytest.raises(np.linalg.LinAlgError):
+        np.linalg.cholesky(K)
+    L = cholesky_factor(K)
+    assert np.array_equal(L,np.tril(L))
+    assert np.allclose(L @ L.T,K,rtol=0,atol=1e-6*np.mean(np.diag(K)))
+    ## indefinite matrix, factorized from the eigendecomposition with the negative eigenvalues set to zero
+    s, u = np.linalg.eigh(K)
+    s[0] = -1.0
+    K = (u * s) @ u.T
+    L = cholesky_factor(K,max_tries=2)
+    assert np.allclose(L @ L.T,(u * np.maximum(s,0)) @ u.T,rtol=0,atol=1e-10)
+
+def test_ess_single_chain_reproducible():
+    K, y = kernel(), labels()
+    samples = Elliptical_Slice_Sampling(K,y,n_mcmc=200,burn_in=50,seed=1,block_size=64)
+    assert samples.shape == (200,y.size)
+    assert np.array_equal(samples,Elliptical_Slice_Sampling(K,y,n_mcmc=200,burn_in=50,seed=1,block_size=64))
+
+@pytest.mark.parametrize('thin',[1,3])
+def test_ess_online_matches_samples(thin):
+    K, y = kernel(), labels()
+    samples = Elliptical_Slice_Sampling(K,y,n_mcmc=300,burn_in=40,seed=1,block_size=64,thin=thin)
+    moments = Elliptical_Slice_Sampling(K,y,n_mcmc=300,burn_in=40,seed=1,block_size=64,thin=thin,online=True)
+    assert moments.n_sample == samples.shape[0]
+    np.testing.assert_allclose(moments.mean,np.mean(samples,axis=0),rtol=0,atol=1e-12)
+    np.testing.assert_allclose(moments.covariance(),np.cov(samples,rowvar=False),rtol=0,atol=1e-12)
+
+def test_posterior_moments_blocks_and_rate():
+    rng = np.random.default_rng(0)
+    draws = rng.normal(size=(500,6)) @ rng.normal(size=(6,6)) + rng.normal(size=6)
+    moments = posterior_moments(6)
+    for block in np.array_split(draws,[1,37,200,201]):
+        moments.update(block)
+    np.testing.assert_allclose(moments.mean,np.mean(draws,axis=0),rtol=1e-12,atol=1e-12)
+    np.testing.assert_allclose(moments.covariance(),np.cov(draws,rowvar=False),rtol=1e-12,atol=1e-12)
+    np.testing.assert_allclose(moments.covariance(ddof=0),np.cov(draws,rowvar=False,bias=True),rtol=1e-12,atol=1e-12)
+    ## RATE only needs the moments of the draws
+    X = rng.normal(size=(6,10))
+    kld, rates, delta, eff_samp_size = RATE(X,f_draws=draws)
+    kld_moments, rates_moments, delta_moments, eff_samp_size_moments = RATE(X,f_draws=moments)
+    np.testing.assert_allclose(kld_moments,kld,rtol=1e-8,atol=1e-12)
+    np.testing.assert_allclose(rates_moments,rates,rtol=1e-8,atol=1e-12)
+
+def test_ess_chains_online_matches_samples():
+    K, y = kernel(), labels()
+    samples = Elliptical_Slice_Sampling(K,y,n_mcmc=400,burn_in=50,seed=1,block_size=64,n_chain=2,n_core=1)
+    moments = Elliptical_Slice_Sampling(K,y,n_mcmc=400,burn_in=50,seed=1,block_size=64,n_chain=2,n_core=1,online=True)
+    assert samples.shape == (400,y.size)
+    assert moments.n_sample == 400
+    assert np.allclose(moments.mean,np.mean(samples,axis=0),rtol=0,atol=1e-12)
+    assert np.allclose(moments.covariance(),np.cov(samples,rowvar=False),rtol=0,atol=1e-12)
+
+def test_ess_chains_resumed_in_rounds():
+    ## with a threshold that is never reached, the chains are advanced in rounds of check_interval steps until n_mcmc, 
+    ## which gives the same samples as running them in one round when the rounds start at multiples of block_size, 
+    ## since prior draws are generated per block of steps
+    K, y = kernel(), labels()
+    samples = Elliptical_Slice_Sampling(K,y,n_mcmc=400,burn_in=64,seed=1,block_size=32,n_chain=2,n_core=1)
+    samples_rounds, diagnostics = Elliptical_Slice_Sampling(K,y,n_mcmc=400,burn_in=64,seed=1,block_size=32,n_chain=2,n_core=1,rhat_threshold=0.0,check_interval=64,return_diagnostics=True)
+    assert np.array_equal(samples,samples_rounds)
+    assert diagnostics['n_sample'] == 400
+
+def test_convergence_diagnostics_independent_draws():
+    rng = np.random.default_rng(0)
+    chain_batches = []
+    for c in range(4):
+        draws = rng.normal(size=(4000,3))
+        batches = []
+        for i in range(0,4000,100):
+            batch = draws[i:i+100]
+            batches.append((100,np.mean(batch,axis=0),np.sum((batch-np.mean(batch,axis=0))**2,axis=0)))
+        chain_batches.append(batches)
+    rhat, ess = convergence_diagnostics(chain_batches)
+    assert np.all(np.abs(rhat-1) < 0.01)
+    assert np.all(ess > 0.5*16000) and np.all(ess < 2*16000)
@@ -0,0 +1,146 @@
+import os
+import numpy as np
+import pytest
+
+from conftest import DATA_DIR, load_test_mesh
+from sinatra_pro.mesh import *
+
+def sorted_rows(a):
+    a = np.sort(np.asarray(a,dtype=int).reshape(-1,3),axis=1)
+    return a[np.lexsort(a.T[::-1])]
+
+def random_mesh(n_vertex = 300, cutoff = 0.25, seed = 0):
+    meshA = mesh()
+    meshA.vertices = np.random.RandomState(seed).uniform(size=(n_vertex,3))
+    distance = np.linalg.norm(meshA.vertices[:,None,:] - meshA.vertices[None,:,:],axis=2)
+    i, j = np.nonzero(np.triu(distance < cutoff,k=1))
+    meshA.edges = np.column_stack((i,j))
+    return meshA
+
+@pytest.mark.parametrize('frame',[0,5])
+def test_edge_to_face_list_matches_old(frame):
+    meshA = load_test_mesh(frame=frame)
+    meshA.edge_to_face_list()
+    faces = meshA.faces.copy()
+    meshA.edge_to_face_list_old()
+    assert faces.shape[0] > 0
+    assert np.array_equal(faces,sorted_rows(faces))
+    assert np.array_equal(faces,sorted_rows(meshA.faces))
+
+@pytest.mark.parametrize('chunk_size',[1,100,1000000])
+def test_edge_to_face_list_random(chunk_size):
+    meshA = random_mesh()
+    meshA.edge_to_face_list(chunk_size=chunk_size)
+    faces = meshA.faces.copy()
+    meshA.edge_to_face_list_old()
+    assert np.array_equal(sorted_rows(faces),sorted_rows(meshA.faces))
+
+def test_edge_to_face_list_no_face():
+    meshA = mesh()
+    meshA.vertices = np.zeros((3,3))
+    meshA.edges = np.array([[0,1],[1,2]])
+    meshA.edge_to_face_list()
+    assert meshA.faces.shape == (0,3)
+
+def assert_same_mesh(meshA, meshB):
+    assert np.array_equal(meshA.vertices,meshB.vertices)
+    assert np.array_equal(meshA.edges,meshB.edges)
+    assert np.array_equal(meshA.faces,meshB.faces)
+
+@pytest.mark.parametrize('mmap',[True,False])
+def test_binary_mesh_round_trip(tmp_path, mmap):
+    meshA = load_test_mesh()
+    filename = str(tmp_path/'frame0.bmsh')
+    meshA.write_mesh_file(filename=filename)
+    assert is_binary_mesh_file(filename)
+    meshB = mesh()
+    meshB.read_mesh_file(filename=filename,mmap=mmap)
+    assert_same_mesh(meshA,meshB)
+    assert (meshB.n_vertex, meshB.n_edge, meshB.n_face) == (meshA.n_vertex, meshA.n_edge, meshA.n_face)
+
+def test_binary_mesh_copy_on_write(tmp_path):
+    meshA = load_test_mesh()
+    filename = str(tmp_path/'frame0.bmsh')
+    meshA.write_mesh_file(filename=filename)
+    meshB = mesh()
+    meshB.read_mesh_file(filename=filename)
+    meshB.vertices *= 2
+    meshC = mesh()
+    meshC.read_mesh_file(filename=filename)
+    assert np.array_equal(meshA.vertices,meshC.vertices)
+
+def test_convert_mesh_file_text_binary_text(tmp_path):
+    text_file = os.path.join(DATA_DIR,'msh_offset_0','WT_2.0','WT_frame0.msh')
+    binary_file, text_file_out = str(tmp_path/'frame0.bmsh'), str(tmp_path/'frame0.msh')
+    convert_mesh_file(text_file,binary_file)
+    convert_mesh_file(binary_file,text_file_out)
+    assert not is_binary_mesh_file(text_file_out)
+    meshA, meshB = mesh(), mesh()
+    meshA.read_mesh_file(filename=text_file)
+    meshB.read_mesh_file(filename=text_file_out)
+    assert_same_mesh(meshA,meshB)
+
+def test_mesh_ensemble_round_trip(tmp_path):
+    meshes = [load_test_mesh(frame=frame) for frame in range(3)]
+    filename = str(tmp_path/'WT.emsh')
+    with mesh_ensemble(filename,mode='w') as ensemble:
+        ensemble.extend(meshes[:2])
+    with mesh_ensemble(filename,mode='a') as ensemble:
+        ensemble.append(meshes[2])
+    assert is_mesh_ensemble_file(filename)
+    with mesh_ensemble(filename) as ensemble:
+        assert len(ensemble) == 3
+        for meshA, meshB in zip(meshes,ensemble):
+            assert_same_mesh(meshA,meshB)
+        assert_same_mesh(meshes[2],ensemble[-1])
+        with pytest.raises(IndexError):
+            ensemble[3]
+
+def test_convert_mesh_folder_to_ensemble(tmp_path):
+    directory_mesh = os.path.join(DATA_DIR,'msh_offset_0','WT_2.0')
+    filename = str(tmp_path/'WT.emsh')
+    convert_mesh_folder_to_ensemble(directory_mesh,filename)
+    filenames = sorted(filename for filename in os.listdir(directory_mesh) if is_mesh_file(filename))
+    frames = list(read_meshes(filename))
+    assert len(frames) == len(filenames)
+    for filename_mesh, (i, meshB) in zip(filenames,frames):
+        meshA = mesh()
+        meshA.read_mesh_file(filename=os.path.join(directory_mesh,filename_mesh))
+        assert_same_mesh(meshA,meshB)
+
+def test_reconstruct_frames_closes_ensemble(tmp_path, monkeypatch):
+    from sinatra_pro.reconstruction import reconstruct_frames
+    filename = str(tmp_path/'WT.emsh')
+    with mesh_ensemble(filename,mode='w') as ensemble:
+        ensemble.extend([load_test_mesh(frame=frame) for frame in range(2)])
+    closed = []
+    close = mesh_ensemble.close
+    monkeypatch.setattr(mesh_ensemble,'close',lambda self: closed.append(self) or close(self))
+    directions = np.array([[0.,0.,1.],[0.,1.,0.]])
+    rates = np.linspace(0,1,2*10)
+    list(reconstruct_frames(filename,directions,rates,n_filtration=10,frames=[0,1]))
+    generator = reconstruct_frames(filename,directions,rates,n_filtration=10,frames=[0,1],batch_size=1)
+    next(generator)
+    generator.close()
+    assert len(closed) == 2
+
+def test_convert_mesh_folder_keeps_frame_count(tmp_path):
+    import shutil
+    from sinatra_pro.euler import list_mesh_frames
+    directory_mesh = str(tmp_path/'WT_2.0')
+    shutil.copytree(os.path.join(DATA_DIR,'msh_offset_0','WT_2.0'),directory_mesh)
+    n_frame = len(os.listdir(directory_mesh))
+    ## default output folder is separate from the input folder
+    convert_mesh_folder(directory_mesh)
+    assert len(os.listdir(directory_mesh + '_bmsh')) == n_frame
+    assert len(list(read_meshes(directory_mesh + '_bmsh'))) == n_frame
+    ## converted into the same folder, each frame is still listed once, from the binary file
+    convert_mesh_folder(directory_mesh,directory_out=directory_mesh)
+    assert len(os.listdir(directory_mesh)) == 2*n_frame
+    frames = list_mesh_frames(directory_mesh)
+    assert len(frames) == n_frame
+    assert all(filename.endswith('.bmsh') for filename, frame in frames)
+    assert len(list(read_meshes(directory_mesh))) == n_frame
+    convert_mesh_folder_to_ensemble(directory_mesh,str(tmp_path/'WT.emsh'))
+    with mesh_ensemble(str(tmp_path/'WT.emsh')) as ensemble:
+        assert len(ensemble) == n_frame
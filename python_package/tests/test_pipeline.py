@@ -0,0 +1,75 @@
+import os, sys, subprocess
+import numpy as np
+import pytest
+
+from conftest import DATA_DIR
+from sinatra_pro.pipeline import pipeline
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','src')
+
+def write_file(filename, text):
+    with open(filename,'w') as f:
+        f.write(text)
+
+def test_stage_skipped_when_unchanged(tmp_path):
+    runner = pipeline(str(tmp_path/'manifest'))
+    infile, outfile = str(tmp_path/'in.txt'), str(tmp_path/'out.txt')
+    write_file(infile,'1')
+    calls = []
+    def stage():
+        calls.append(1)
+        write_file(outfile,'2')
+    assert runner.run('a',stage,parameters={'x':1},inputs=[infile],outputs=[outfile])
+    assert not runner.run('a',stage,parameters={'x':1},inputs=[infile],outputs=[outfile])
+    ## changed parameters, changed input and missing output
+    assert runner.run('a',stage,parameters={'x':2},inputs=[infile],outputs=[outfile])
+    write_file(infile,'3')
+    assert runner.run('a',stage,parameters={'x':2},inputs=[infile],outputs=[outfile])
+    os.remove(outfile)
+    assert runner.run('a',stage,parameters={'x':2},inputs=[infile],outputs=[outfile])
+    assert len(calls) == 4
+    assert pipeline(str(tmp_path/'manifest'),force=[]).run('a',stage,parameters={'x':2},inputs=[infile],outputs=[outfile])
+
+def test_none_paths_ignored(tmp_path):
+    runner = pipeline(str(tmp_path/'manifest'))
+    outfile = str(tmp_path/'out.txt')
+    stage = lambda: write_file(outfile,'1')
+    assert runner.run('a',stage,inputs=[None],outputs=[outfile,None])
+    assert not runner.run('a',stage,inputs=[None],outputs=[outfile,None])
+
+def test_outputs_cleared_before_rerun(tmp_path):
+    runner = pipeline(str(tmp_path/'manifest'))
+    folder = tmp_path/'frames'
+    def stage(n):
+        os.makedirs(str(folder),exist_ok=True)
+        for i in range(n):
+            write_file(str(folder/('frame%d.txt'%i)),str(i))
+    runner.run('a',lambda: stage(5),parameters={'n':5},outputs=[str(folder)])
+    runner.run('a',lambda: stage(3),parameters={'n':3},outputs=[str(folder)])
+    assert sorted(os.listdir(str(folder))) == ['frame0.txt','frame1.txt','frame2.txt']
+
+def run_main(trajectories, directory, n_sample):
+    command = [sys.executable,'-W','ignore','-m','sinatra_pro','-na','WT','-nb','R164S',
+            '-sa',trajectories['WT'][0],'-ta',trajectories['WT'][1],
+            '-sb',trajectories['R164S'][0],'-tb',trajectories['R164S'][1],
+            '-n',str(n_sample),'-r','2.0','-c','1','-d','2','-l','10','-nm','200','-dir',directory,'-v']
+    env = dict(os.environ,PYTHONPATH=os.path.abspath(SRC_DIR))
+    result = subprocess.run(command,env=env,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,universal_newlines=True)
+    assert result.returncode == 0, result.stdout
+    return result.stdout
+
+def test_rerun_with_fewer_samples(trajectories, tmp_path):
+    directory = str(tmp_path/'out')
+    run_main(trajectories,directory,5)
+    output = run_main(trajectories,directory,3)
+    assert 'Running stage "trajectory"' in output
+    ## frames of the first run must not be left in the folders
+    for prot in ['WT','R164S']:
+        assert len([f for f in os.listdir(os.path.join(directory,'pdb',prot)) if f.endswith('.pdb')]) == 3
+        assert len(os.listdir(os.path.join(directory,'msh','%s_2.0'%prot))) == 3
+    y = np.loadtxt(os.path.join(directory,'WT_R164S_label_all.txt'))
+    X = np.loadtxt(os.path.join(directory,'DECT_WT_R164S_2.0_1_2_0.80_10_norm_all.txt'),ndmin=2)
+    assert y.shape[0] == 6
+    assert X.shape[0] == 6
+    output = run_main(trajectories,directory,3)
+    assert 'Running stage' not in output
@@ -0,0 +1,62 @@
+import os
+import numpy as np
+import pytest
+
+from conftest import DATA_DIR
+from sinatra_pro.RATE import *
+
+def kld_inputs(p = 30, seed = 0):
+    rng = np.random.RandomState(seed)
+    A = rng.normal(size=(p,p))
+    Lambda = A @ A.T / p + np.eye(p)
+    V = rng.normal(size=(p,p)) / np.sqrt(p)
+    mu = rng.normal(size=p)
+    return mu, Lambda, V
+
+@pytest.mark.parametrize('block_size',[None,1,7])
+def test_kld_closed_form_matches_per_column(block_size):
+    mu, Lambda, V = kld_inputs()
+    kld_old = np.array([calc_kld(mu,Lambda,V,q) for q in range(mu.size)])
+    kld = calc_kld_batched(mu,Lambda,V,block_size=block_size)
+    assert np.allclose(kld,kld_old,rtol=1e-10,atol=1e-12)
+
+def test_kld_block_matches_per_column():
+    mu, Lambda, V = kld_inputs(p=12,seed=1)
+    kld_old = np.array([calc_kld(mu,Lambda,V,q) for q in range(3,8)])
+    assert np.allclose(calc_kld_block(mu,Lambda,V,3,8),kld_old,rtol=1e-10,atol=1e-12)
+
+@pytest.mark.parametrize('block_size',[None,4])
+def test_kld_parallel_matches_serial(tmp_path, block_size):
+    mu, Lambda, V = kld_inputs()
+    kld = calc_kld_parallel(mu,Lambda,V,n_core=2,block_size=block_size,temp_dir=str(tmp_path))
+    assert np.array_equal(kld,calc_kld_batched(mu,Lambda,V,block_size=block_size))
+    ## the temporary files of the shared matrices are removed
+    assert os.listdir(str(tmp_path)) == []
+
+def test_rate_parallel_matches_serial(tmp_path):
+    X = np.loadtxt(os.path.join(DATA_DIR,'DECT_WT_R164S_1_1_0.80_20_norm_offset_0.txt'))
+    f_draws = np.random.RandomState(0).normal(size=(200,X.shape[0]))
+    kld, rates, delta, eff_samp_size = RATE(X,f_draws=f_draws)
+    kld_parallel, rates_parallel, delta_parallel, eff_samp_size_parallel = RATE(X,f_draws=f_draws,parallel=True,n_core=2,temp_dir=str(tmp_path))
+    assert np.array_equal(kld,kld_parallel)
+    assert np.array_equal(rates,rates_parallel)
+
+@pytest.mark.parametrize('low_rank,prop_var',[(False,1),(True,0.5),(True,0.9),(True,1)])
+def test_randomized_svd_rate_matches_exact(low_rank, prop_var):
+    X = np.loadtxt(os.path.join(DATA_DIR,'DECT_WT_R164S_1_1_0.80_20_norm_offset_0.txt'))
+    f_draws = np.random.RandomState(0).normal(size=(200,X.shape[0]))
+    kld, rates, delta, eff_samp_size = RATE(X,f_draws=f_draws,low_rank=low_rank,prop_var=prop_var)
+    ## at full rank, the randomized SVD is exact and the components are truncated by the same rule
+    kld_svd, rates_svd, delta_svd, eff_samp_size_svd = RATE(X,f_draws=f_draws,low_rank=low_rank,prop_var=prop_var,svd_rank=min(X.shape))
+    np.testing.assert_allclose(kld_svd,kld,rtol=1e-8,atol=1e-12)
+    np.testing.assert_allclose(rates_svd,rates,rtol=1e-8,atol=1e-12)
+
+def test_prop_var_components():
+    s = np.array([4.,2.,1.,0.5])
+    total = np.sum(s**2)
+    assert np.array_equal(prop_var_components(s,total,0.9),np.cumsum(s**2)/total < 0.9)
+    ## the last component reaches the whole variance, also when the total differs by rounding errors
+    for scale in [1-2*np.finfo(float).eps,1.,1+2*np.finfo(float).eps]:
+        assert np.array_equal(prop_var_components(s,total*scale,1),[True,True,True,False])
+    ## leading components of a truncated SVD
+    assert np.array_equal(prop_var_components(s[:2],total,1),[True,True])
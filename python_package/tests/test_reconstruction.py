@@ -0,0 +1,142 @@
+import os
+import numpy as np
+import pytest
+from scipy.stats import rankdata
+
+from conftest import DATA_DIR, load_test_mesh
+from sinatra_pro.reconstruction import *
+
+def reconstruct_digitize(vertices, directions, rates, n_filtration, n_direction_per_cone, ball_radius, by_rank):
+    """Reconstruction of the original code, one `np.digitize` per direction"""
+    n_direction = directions.shape[0]
+    n_cone = int(n_direction/n_direction_per_cone)
+    rates_vert = np.zeros((vertices.shape[0],n_cone,n_direction_per_cone),dtype=float)
+    for i in range(n_cone):
+        for j in range(n_direction_per_cone):
+            k = i*n_direction_per_cone+j
+            vertex_function = np.dot(vertices,directions[k])
+            radius = np.linspace(-ball_radius,ball_radius,n_filtration)
+            filtration = np.digitize(vertex_function,radius)-1
+            rates_vert[:,i,j] = rates[k*n_filtration+filtration]
+    height = np.amax(np.amin(rates_vert,axis=2),axis=1)
+    if by_rank:
+        rank = rankdata(height,method='dense')
+        return rank/np.amax(rank)
+    return height
+
+@pytest.mark.parametrize('n_filtration',[1,2,20,25])
+def test_filtration_index_matches_digitize(n_filtration):
+    rng = np.random.default_rng(0)
+    radius = np.linspace(-1.0,1.0,n_filtration)
+    ## heights on and next to the filtration steps, and out of the ball
+    heights = np.concatenate((rng.uniform(-1.2,1.2,size=1000),radius,np.nextafter(radius,-np.inf),np.nextafter(radius,np.inf)))
+    np.testing.assert_array_equal(filtration_index(heights,n_filtration=n_filtration),np.digitize(heights,radius))
+    heights = rng.uniform(-1.2,1.2,size=(4,50))
+    np.testing.assert_array_equal(filtration_index(heights,n_filtration=n_filtration),np.digitize(heights,radius))
+
+@pytest.mark.parametrize('by_rank',[False,True])
+def test_reconstruct_vertices_matches_digitize(by_rank):
+    rng = np.random.default_rng(1)
+    n_filtration, n_direction_per_cone = 20, 3
+    directions = rng.normal(size=(12,3))
+    directions /= np.linalg.norm(directions,axis=1)[:,None]
+    rates = rng.uniform(size=directions.shape[0]*n_filtration)
+    frames = [load_test_mesh('WT',frame).vertices for frame in range(2)]
+    for vertices in frames:
+        expected = reconstruct_digitize(vertices,directions,rates,n_filtration,n_direction_per_cone,1.0,by_rank)
+        np.testing.assert_array_equal(reconstruct_vertices(vertices,directions,rates,n_filtration=n_filtration,n_direction_per_cone=n_direction_per_cone,by_rank=by_rank),expected)
+    ## frames stacked into one array
+    stacked = reconstruct_vertices(np.array(frames),directions,rates,n_filtration=n_filtration,n_direction_per_cone=n_direction_per_cone,by_rank=by_rank)
+    for vertices, result in zip(frames,stacked):
+        np.testing.assert_array_equal(result,reconstruct_digitize(vertices,directions,rates,n_filtration,n_direction_per_cone,1.0,by_rank))
+
+def reconstruction_inputs(n_filtration = 20, seed = 2):
+    rng = np.random.default_rng(seed)
+    directions = rng.normal(size=(8,3))
+    directions /= np.linalg.norm(directions,axis=1)[:,None]
+    rates = rng.uniform(size=directions.shape[0]*n_filtration)
+    return directions, rates
+
+@pytest.mark.parametrize('by_rank',[False,True])
+def test_streaming_statistics(by_rank):
+    directions, rates = reconstruction_inputs()
+    meshes = [load_test_mesh('WT',frame) for frame in range(10)]
+    values = np.vstack([reconstruct_vertices(meshA.vertices,directions,rates,n_filtration=20,n_direction_per_cone=2,by_rank=by_rank) for meshA in meshes])
+    n_bin = 64
+    statistics = reconstruct_statistics(meshes,directions,rates,n_filtration=20,n_direction_per_cone=2,by_rank=by_rank,n_bin=n_bin,batch_size=3)
+    assert statistics.n_sample == 10
+    np.testing.assert_allclose(statistics.mean,np.mean(values,axis=0),rtol=1e-12,atol=1e-14)
+    np.testing.assert_allclose(statistics.variance(),np.var(values,axis=0),rtol=1e-10,atol=1e-14)
+    np.testing.assert_allclose(statistics.variance(ddof=1),np.var(values,axis=0,ddof=1),rtol=1e-10,atol=1e-14)
+    vmin, vmax = statistics.value_range
+    for q in [0.0,0.1,0.5,0.9,1.0]:
+        expected = np.quantile(values,q,axis=0,method='inverted_cdf')
+        assert np.all(np.abs(statistics.quantile(q) - expected) <= (vmax - vmin) / n_bin)
+
+def test_statistics_merge_and_quantile():
+    rng = np.random.default_rng(3)
+    values = rng.beta(2.0,5.0,size=(500,7))
+    n_bin = 100
+    statistics = vertex_statistics(7,n_bin=n_bin)
+    other = vertex_statistics(7,n_bin=n_bin)
+    statistics.update(values[:123])
+    other.update(values[123:])
+    statistics.merge(other)
+    np.testing.assert_allclose(statistics.mean,np.mean(values,axis=0),rtol=1e-12)
+    np.testing.assert_allclose(statistics.variance(),np.var(values,axis=0),rtol=1e-10)
+    for q in np.linspace(0.0,1.0,11):
+        expected = np.quantile(values,q,axis=0,method='inverted_cdf')
+        assert np.all(np.abs(statistics.quantile(q) - expected) <= 1.0 / n_bin)
+
+def test_reconstruct_no_frames(tmp_path):
+    directions, rates = reconstruction_inputs()
+    not_vacuum = np.ones(rates.size,dtype=bool)
+    with pytest.raises(ValueError):
+        reconstruct_statistics([],directions,rates,n_filtration=20)
+    os.makedirs(str(tmp_path/'msh'))
+    for parallel in [False,True]:
+        with pytest.raises(ValueError):
+            reconstruct_on_multiple_mesh('WT','R164S',directions,rates,not_vacuum,n_direction_per_cone=2,n_filtration=20,directory_mesh=str(tmp_path/'msh'),parallel=parallel,n_core=2)
+    ensemble_file = str(tmp_path/'WT_2.0.emsh')
+    with mesh_ensemble(ensemble_file,mode='w') as ensemble:
+        pass
+    with pytest.raises(ValueError):
+        reconstruct_on_multiple_mesh('WT','R164S',directions,rates,not_vacuum,n_direction_per_cone=2,n_filtration=20,directory_mesh=ensemble_file)
+
+def residue_mean_loop(u, vert_prob):
+    """Mean of the atomic values over each residue, with the per-residue loop of the original code"""
+    ag_res = u.atoms.groupby('resids')
+    rate_res = np.zeros(len(ag_res),dtype=float)
+    for i_r, res in enumerate(ag_res):
+        rate = 0
+        for a in ag_res[res]:
+            rate += vert_prob[a.ix]
+        rate /= len(ag_res[res])
+        rate_res[i_r] = rate
+    return ag_res, rate_res
+
+def test_aggregate_vert_prob_matches_residue_loop(tmp_path):
+    mda = pytest.importorskip('MDAnalysis')
+    pdb_file = os.path.join(DATA_DIR,'pdb','WT_offset_0','WT_frame0.pdb')
+    u = mda.Universe(pdb_file)
+    protein = u.select_atoms('protein')
+    vert_prob = np.random.default_rng(4).uniform(size=len(protein))
+    ag_res, rate_res = residue_mean_loop(u,vert_prob)
+    group = atom_group_index(protein)
+    value = aggregate_vert_prob(vert_prob,group)
+    for i_r, res in enumerate(ag_res):
+        assert np.all(group[ag_res[res].ix] == group[ag_res[res].ix[0]])
+        np.testing.assert_allclose(value[group[ag_res[res].ix[0]]],rate_res[i_r],rtol=1e-12)
+    for reduction, function in [('max',np.amax),('sum',np.sum)]:
+        value = aggregate_vert_prob(vert_prob,group,reduction=reduction)
+        for res in ag_res:
+            np.testing.assert_allclose(value[group[ag_res[res].ix[0]]],function(vert_prob[ag_res[res].ix]),rtol=1e-12)
+    ## ranks of the residue means written as temperature factors, as in the original code
+    rank_res = rankdata(rate_res,method='dense').astype(float)
+    rank_res *= 100.0/np.amax(rank_res)
+    expected = np.zeros(len(protein),dtype=float)
+    for i_r, res in enumerate(ag_res):
+        expected[ag_res[res].ix] = rank_res[i_r]
+    pdb_out_file = str(tmp_path/'WT_reconstructed.pdb')
+    write_vert_prob_on_pdb_residue(vert_prob,pdb_in_file=pdb_file,pdb_out_file=pdb_out_file)
+    np.testing.assert_allclose(mda.Universe(pdb_out_file).atoms.tempfactors,expected,rtol=0,atol=0.005)
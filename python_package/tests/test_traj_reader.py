@@ -0,0 +1,158 @@
+import os
+import numpy as np
+import pytest
+
+from conftest import DATA_DIR
+
+mda = pytest.importorskip('MDAnalysis')
+from sinatra_pro.traj_reader import *
+
+def test_pdb_mesh_matches_single_pass(tmp_path):
+    ## single pass of the original code, rmax computed from the PDB structures before the meshes are constructed
+    directory_pdb = {prot:os.path.join(DATA_DIR,'pdb','%s_offset_0'%prot) for prot in ['WT','R164S']}
+    pdb_files = {prot:sorted(f for f in os.listdir(directory_pdb[prot]) if f.endswith('.pdb')) for prot in ['WT','R164S']}
+    r = []
+    for prot in ['WT','R164S']:
+        for filename in pdb_files[prot]:
+            positions = mda.Universe(os.path.join(directory_pdb[prot],filename)).select_atoms('protein').positions
+            r.append(np.amax(np.linalg.norm(positions,axis=1)))
+    rmax = np.amax(r)
+    convert_pdb_mesh(protA='WT',protB='R164S',sm_radius=2.0,directory_pdb_A=directory_pdb['WT'],directory_pdb_B=directory_pdb['R164S'],directory_mesh=str(tmp_path/'msh'))
+    for prot in ['WT','R164S']:
+        directory_mesh = os.path.join(str(tmp_path/'msh'),'%s_2.0'%prot)
+        ## full precision vertices are removed after normalization
+        assert sorted(os.listdir(directory_mesh)) == sorted(f[:-4] + '.msh' for f in pdb_files[prot])
+        for filename in pdb_files[prot]:
+            expected = str(tmp_path/'expected.msh')
+            convert_pdb_file_mesh(os.path.join(directory_pdb[prot],filename),2.0,rmax,msh_file=expected)
+            with open(expected) as f, open(os.path.join(directory_mesh,filename[:-4] + '.msh')) as g:
+                assert f.read() == g.read()
+
+def test_stride_offset_bound(trajectories):
+    struct_file, traj_file = trajectories['WT']
+    groundref = reference_structure(struct_file,traj_file)
+    ## stride sampling wraps the offset around the stride, so all frames can be drawn with an offset
+    mobile, positions, frames = read_aligned_frames('WT',struct_file,traj_file,groundref,n_sample=10,offset=1,sampling='stride')
+    assert np.array_equal(frames,np.arange(10))
+    assert positions.shape == (10,len(mobile),3)
+    with pytest.raises(SystemExit):
+        read_aligned_frames('WT',struct_file,traj_file,groundref,n_sample=11,sampling='stride')
+    with pytest.raises(SystemExit):
+        read_aligned_frames('WT',struct_file,traj_file,groundref,n_sample=10,offset=1,sampling='uniform')
+
+def test_condensed_medoid():
+    from scipy.spatial.distance import pdist, squareform
+    rng = np.random.default_rng(0)
+    distances = pdist(rng.normal(size=(30,4)))
+    square = squareform(distances)
+    for members in [np.arange(30),np.sort(rng.choice(30,size=7,replace=False)),np.array([4])]:
+        expected = members[np.argmin(np.sum(square[np.ix_(members,members)],axis=1))]
+        assert condensed_medoid(distances,30,members) == expected
+
+def test_rmsd_cluster_frames(trajectories):
+    from scipy.cluster.hierarchy import linkage, cut_tree
+    from scipy.spatial.distance import pdist, squareform
+    struct_file, traj_file = trajectories['WT']
+    groundref = reference_structure(struct_file,traj_file)
+    refCA = groundref.select_atoms('name CA')
+    mobile, positions, frames = read_aligned_frames('WT',struct_file,traj_file,groundref,n_sample=3,sampling='rmsd_cluster')
+    ## clustering of the superposed C-alpha coordinates with the square distance matrix, as in the original code
+    u = mda.Universe(struct_file,traj_file)
+    mobileCA = u.select_atoms('protein and name CA')
+    candidates = np.arange(10)
+    ca_positions = np.array([mobileCA.positions for ts in u.trajectory],dtype=np.float32)
+    superpose_frames(ca_positions,np.arange(len(mobileCA)),refCA.positions,weights=refCA.masses)
+    scaled = ca_positions * np.sqrt(refCA.masses/np.sum(refCA.masses))[None,:,None]
+    distances = pdist(scaled.reshape(10,-1))
+    labels = cut_tree(linkage(distances,method='average'),n_clusters=3).ravel()
+    square = squareform(distances)
+    expected = []
+    for label in range(3):
+        members = np.flatnonzero(labels == label)
+        expected.append(candidates[members[np.argmin(np.sum(square[np.ix_(members,members)],axis=1))]])
+    assert np.array_equal(frames,np.sort(expected))
+    ## coordinates kept from the clustering are those of the frames read again
+    mobile = u.select_atoms('protein')
+    mobile_index = np.searchsorted(mobile.ix,mobileCA.ix)
+    np.testing.assert_array_equal(positions,read_frames(u,mobile,mobile_index,frames,refCA.positions,weights=refCA.masses))
+
+def test_superpose_frames_alignto():
+    rng = np.random.default_rng(0)
+    n_atom, n_frame = 40, 6
+    ref_positions = rng.normal(scale=5.0,size=(n_atom,3)).astype(np.float32)
+    weights = rng.uniform(1.0,16.0,size=n_atom)
+    fit_index = np.arange(0,n_atom,2)
+    positions = np.zeros((n_frame,n_atom,3),dtype=np.float32)
+    for i in range(n_frame):
+        q, r = np.linalg.qr(rng.normal(size=(3,3)))
+        frame = ref_positions + rng.normal(scale=0.5,size=(n_atom,3))
+        ## odd frames are mirror images, for which the best orthogonal transform is a reflection rather than a rotation
+        if i % 2 == 1:
+            frame[:,0] *= -1
+        positions[i] = frame @ q.T + rng.normal(scale=10.0,size=3)
+    expected = positions.copy()
+    ref = mda.Universe.empty(n_atom,trajectory=True)
+    ref.atoms.positions = ref_positions
+    u = mda.Universe.empty(n_atom,trajectory=True)
+    for i in range(n_frame):
+        u.atoms.positions = positions[i]
+        align.alignto(u.atoms[fit_index],ref.atoms[fit_index],weights=weights[fit_index])
+        expected[i] = u.atoms.positions
+    rmsds = superpose_frames(positions,fit_index,ref_positions[fit_index],weights=weights[fit_index])
+    np.testing.assert_allclose(positions,expected,atol=1e-3)
+    ## proper rotations only, the RMSD of the mirror images is not reduced by reflecting them
+    for i in range(n_frame):
+        np.testing.assert_allclose(rmsds[i],rmsd(positions[i][fit_index],ref_positions[fit_index],weights=weights[fit_index]),atol=1e-3)
+
+def assert_close_mesh(meshA, meshB, atol):
+    ## the order of the edges from the neighbor search depends on the rounding of the coordinates
+    assert np.array_equal(np.unique(np.sort(meshA.edges,axis=1),axis=0),np.unique(np.sort(meshB.edges,axis=1),axis=0))
+    assert len(meshA.edges) == len(meshB.edges)
+    assert np.array_equal(meshA.faces,meshB.faces)
+    np.testing.assert_allclose(meshA.vertices,meshB.vertices,rtol=0,atol=atol)
+
+@pytest.mark.parametrize('ensemble',[False,True])
+def test_traj_mesh_matches_pdb_route(trajectories, tmp_path, ensemble):
+    arguments = dict(protA='WT',protB='R164S',struct_file_A=trajectories['WT'][0],traj_file_A=trajectories['WT'][1],
+            struct_file_B=trajectories['R164S'][0],traj_file_B=trajectories['R164S'][1],n_sample=10,single=True)
+    directory_pdb = str(tmp_path/'pdb_route')
+    convert_traj_pdb_aligned(directory=directory_pdb,**arguments)
+    convert_pdb_mesh(protA='WT',protB='R164S',sm_radius=2.0,directory_pdb_A=directory_pdb+'/pdb/WT',directory_pdb_B=directory_pdb+'/pdb/R164S',directory_mesh=directory_pdb+'/msh',ensemble=ensemble)
+    directory = str(tmp_path/'traj_route')
+    convert_traj_mesh(sm_radius=2.0,directory=directory,directory_mesh=directory+'/msh',ensemble=ensemble,**arguments)
+    ## coordinates of the PDB route are rounded to 1e-3 Angstrom in the PDB files, and the vertices of text meshes to 1e-6
+    r = mda.Universe(directory_pdb+'/pdb/WT/WT_frame0.pdb').atoms.positions
+    atol = 1e-3/np.amax(np.linalg.norm(r,axis=1)) + 1e-6
+    for prot in ['WT','R164S']:
+        if ensemble:
+            with mesh_ensemble('%s/msh/%s_2.0.emsh'%(directory_pdb,prot)) as pdb_meshes, mesh_ensemble('%s/msh/%s_2.0.emsh'%(directory,prot)) as traj_meshes:
+                assert len(pdb_meshes) == len(traj_meshes) == 10
+                for i in range(10):
+                    assert_close_mesh(traj_meshes[i],pdb_meshes[i],atol)
+        else:
+            assert sorted(os.listdir('%s/msh/%s_2.0'%(directory,prot))) == sorted(os.listdir('%s/msh/%s_2.0'%(directory_pdb,prot)))
+            for i in range(10):
+                meshA, meshB = mesh(), mesh()
+                meshA.read_mesh_file(filename='%s/msh/%s_2.0/%s_frame%d.msh'%(directory,prot,prot,i))
+                meshB.read_mesh_file(filename='%s/msh/%s_2.0/%s_frame%d.msh'%(directory_pdb,prot,prot,i))
+                assert_close_mesh(meshA,meshB,atol)
+        ## the first frame is written as PDB file by both routes
+        np.testing.assert_allclose(mda.Universe('%s/pdb/%s/%s_frame0.pdb'%(directory,prot,prot)).atoms.positions,
+                mda.Universe('%s/pdb/%s/%s_frame0.pdb'%(directory_pdb,prot,prot)).atoms.positions,rtol=0,atol=1e-3)
+
+@pytest.mark.parametrize('sampling',['stride','random'])
+def test_traj_pdb_parallel_matches_serial(trajectories, tmp_path, sampling):
+    arguments = dict(protA='WT',protB='R164S',struct_file_A=trajectories['WT'][0],traj_file_A=trajectories['WT'][1],
+            struct_file_B=trajectories['R164S'][0],traj_file_B=trajectories['R164S'][1],n_sample=5,offset=1,sampling=sampling,seed=3)
+    convert_traj_pdb_aligned(directory=str(tmp_path/'serial'),**arguments)
+    convert_traj_pdb_aligned(directory=str(tmp_path/'parallel'),parallel=True,n_core=2,**arguments)
+    for prot in ['WT','R164S']:
+        folder = 'pdb/%s_offset_1'%prot
+        filenames = sorted(os.listdir(str(tmp_path/'serial'/folder)))
+        assert len(filenames) == 5
+        assert sorted(os.listdir(str(tmp_path/'parallel'/folder))) == filenames
+        for filename in filenames:
+            with open(str(tmp_path/'serial'/folder/filename)) as f, open(str(tmp_path/'parallel'/folder/filename)) as g:
+                assert f.read() == g.read()
+        frames = np.loadtxt(str(tmp_path/'serial'/'pdb'/('%s_offset_1_frames.txt'%prot)),dtype=int)
+        assert np.array_equal(np.loadtxt(str(tmp_path/'parallel'/'pdb'/('%s_offset_1_frames.txt'%prot)),dtype=int),frames)